@@ -1,15 +1,30 @@
-from flask import Flask, render_template, request, redirect, session, jsonify, url_for
+from flask import Flask, render_template, request, redirect, session, g, jsonify, url_for, send_file, Response, stream_with_context, has_request_context
 import requests
 import json
 import time
+import base64
+import io
+import hashlib
+import hmac
 import re
+import math
+import unicodedata
 import ast
+import csv
+import tempfile
+import atexit
+import cProfile
+import pstats
 from datetime import datetime, timezone
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from functools import wraps
 from urllib.parse import unquote, quote
-from threading import Lock
+from threading import Lock, Thread, Event
 from collections import defaultdict
+from bisect import bisect_left, bisect_right
+from heapq import merge as heap_merge
+from concurrent.futures import ThreadPoolExecutor
+from verify_data import TableDigest, compare as digest_compare
 
 # ---------------- APP ----------------
 app = Flask(__name__)
@@ -18,7 +33,8 @@ import os
 app.secret_key = os.environ.get('SECRET_KEY', 'cpf_nurse_development_only')
 
 # ⭐ ใส่ URL ของ Google Apps Script ที่ Deploy แล้ว
-GAS_URL = "https://script.google.com/macros/s/AKfycbx8CTkhx73DptbxSyOWe9rOzfNrfvClTJhB_1-l_jX2gPjrxWROP9wByfmxXzYhu2wS2A/exec"
+# override ด้วย env GAS_URL ได้ เช่นชี้ไป gas_emulator.py (http://127.0.0.1:8765/exec) ตอนพัฒนา/ทดสอบ/benchmark
+GAS_URL = os.environ.get("GAS_URL", "https://script.google.com/macros/s/AKfycbx8CTkhx73DptbxSyOWe9rOzfNrfvClTJhB_1-l_jX2gPjrxWROP9wByfmxXzYhu2wS2A/exec")
 
 # ===== TIMEZONE PATCH (Asia/Bangkok) =====
 try:
@@ -154,6 +170,266 @@ def visit_date_for_input(value):
     return dt.strftime("%Y-%m-%dT%H:%M:%S")
 
 
+# ============================================
+# METRICS (/metrics แบบ Prometheus text)
+# ============================================
+# เก็บในหน่วยความจำของแต่ละ worker แล้ว flush เป็นไฟล์ <pid>.json ใน METRICS_DIR (ไม่เกินทุก 5 วิ)
+# /metrics รวมไฟล์ของทุก worker -> scraper เห็นค่ารวมไม่ว่าจะถูก route ไป worker ไหน
+# ไฟล์ของ worker ที่ตายไปแล้วเก็บไว้ (counter ไม่ถอยหลัง) gunicorn ล้างโฟลเดอร์ตอน start
+METRICS_DIR = os.environ.get("METRICS_DIR") or os.path.join(tempfile.gettempdir(), "cpf_metrics")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+# หลัง reverse proxy ในเครื่อง ทุก request มาจาก 127.0.0.1 -> เปิดเฉพาะเมื่อไม่มี proxy (scraper อยู่เครื่องเดียวกัน)
+METRICS_ALLOW_LOCAL = os.environ.get("METRICS_ALLOW_LOCAL", "0") == "1"
+_METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_METRIC_HELP = {
+    "gas_request_duration_seconds": ("histogram", "เวลาเรียก Apps Script ต่อ action/table"),
+    "gas_requests_total": ("counter", "จำนวนครั้งที่เรียก Apps Script แยกตาม HTTP status (error = ไม่ได้ response)"),
+    "gas_request_bytes_total": ("counter", "ขนาด payload ที่ส่งไป Apps Script"),
+    "gas_response_bytes_total": ("counter", "ขนาด response จาก Apps Script"),
+    "cache_requests_total": ("counter", "cache hit/miss ของ _GAS_CACHE (gas) และ _DASH_CACHE (dash)"),
+    "cache_evictions_total": ("counter", "รายการที่ถูกเอาออกจาก cache (expired/invalidated)"),
+    "cache_entries": ("gauge", "จำนวนรายการใน cache ตอน flush"),
+    "http_request_duration_seconds": ("histogram", "เวลาตอบ request ต่อ route"),
+    "http_requests_total": ("counter", "จำนวน request ต่อ route/status"),
+    "gas_n_plus_one_total": ("counter", "request ที่ยิง GAS ตารางเดียวกันเกิน GAS_TRACE_WARN ครั้ง"),
+}
+_METRICS = {"counters": defaultdict(float), "hist": {}, "flushed_at": 0.0}
+_METRICS_LOCK = Lock()
+
+
+def metric_inc(name, labels=(), value=1):
+    with _METRICS_LOCK:
+        _METRICS["counters"][(name, tuple(labels))] += value
+
+
+def metric_observe(name, labels, value):
+    key = (name, tuple(labels))
+    with _METRICS_LOCK:
+        h = _METRICS["hist"].get(key)
+        if h is None:
+            h = _METRICS["hist"][key] = [[0] * len(_METRIC_BUCKETS), 0.0, 0]
+        i = bisect_left(_METRIC_BUCKETS, value)
+        if i < len(_METRIC_BUCKETS):
+            h[0][i] += 1
+        h[1] += value
+        h[2] += 1
+
+
+def _metrics_snapshot():
+    with _METRICS_LOCK:
+        counters = [[n, list(map(list, l)), v] for (n, l), v in _METRICS["counters"].items()]
+        hist = [[n, list(map(list, l)), list(h[0]), h[1], h[2]] for (n, l), h in _METRICS["hist"].items()]
+    gauges = [["cache_entries", [["cache", "gas"]], len(_GAS_CACHE)],
+              ["cache_entries", [["cache", "dash"]], len(_DASH_CACHE)]]
+    return {"pid": os.getpid(), "counters": counters, "hist": hist, "gauges": gauges}
+
+
+def metrics_flush(force=False):
+    """เขียน snapshot ของ worker นี้ลงไฟล์ (atomic) ให้ /metrics ของ worker อื่นอ่านได้"""
+    now = time.time()
+    if not force and now - _METRICS["flushed_at"] < 5:
+        return
+    _METRICS["flushed_at"] = now
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        data = json.dumps(_metrics_snapshot(), ensure_ascii=False).encode("utf-8")
+        _atomic_write(os.path.join(METRICS_DIR, f"{os.getpid()}.json"), data)
+    except Exception as e:
+        print(f"metrics_flush error: {e}")
+
+
+def metrics_reset():
+    """ล้างค่าในหน่วยความจำ (worker หลัง fork ได้สำเนาของ master มา)"""
+    with _METRICS_LOCK:
+        _METRICS["counters"].clear()
+        _METRICS["hist"].clear()
+        _METRICS["flushed_at"] = 0.0
+
+
+# worker ปิดตัว -> flush ค่าสุดท้าย
+atexit.register(metrics_flush, True)
+
+
+def _metric_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+
+def metrics_render():
+    """รวม snapshot ทุก worker (ไฟล์ + ของ worker นี้สด ๆ) -> Prometheus text format"""
+    snaps = {os.getpid(): _metrics_snapshot()}
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        names = []
+    for fn in names:
+        if not fn.endswith(".json") or fn[:-5] == str(os.getpid()):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, fn), encoding="utf-8") as f:
+                snap = json.load(f)
+            snaps[snap.get("pid", fn)] = snap
+        except (OSError, ValueError):
+            continue   # กำลังถูกเขียน/เสีย -> รอบหน้า
+
+    series = defaultdict(dict)   # name -> {labels: value | [buckets, sum, count]}
+    for snap in snaps.values():
+        for n, l, v in snap.get("counters", []) + snap.get("gauges", []):
+            key = tuple(map(tuple, l))
+            series[n][key] = series[n].get(key, 0) + v
+        for n, l, b, s, c in snap.get("hist", []):
+            key = tuple(map(tuple, l))
+            cur = series[n].setdefault(key, [[0] * len(_METRIC_BUCKETS), 0.0, 0])
+            cur[0] = [x + y for x, y in zip(cur[0], b)]
+            cur[1] += s
+            cur[2] += c
+
+    lines = []
+    for name in sorted(series):
+        mtype, help_text = _METRIC_HELP.get(name, ("untyped", ""))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {mtype}")
+        for labels, v in sorted(series[name].items()):
+            if mtype == "histogram":
+                acc = 0
+                for le, n in zip(_METRIC_BUCKETS, v[0]):
+                    acc += n
+                    lines.append(f"{name}_bucket{_metric_labels(labels, [('le', le)])} {acc}")
+                lines.append(f"{name}_bucket{_metric_labels(labels, [('le', '+Inf')])} {v[2]}")
+                lines.append(f"{name}_sum{_metric_labels(labels)} {v[1]:.6f}")
+                lines.append(f"{name}_count{_metric_labels(labels)} {v[2]}")
+            else:
+                lines.append(f"{name}{_metric_labels(labels)} {v:g}")
+    return "\n".join(lines) + "\n"
+
+
+# ===== trace การเรียก GAS ต่อ request (Server-Timing + เตือน N+1) =====
+# ทุก gas_* ที่ถูกเรียกระหว่างตอบ request เก็บลง g.gas_trace (thread ที่ไม่มี request context ไม่นับ)
+# ตารางเดียวกันถูกยิงจริงเกิน GAS_TRACE_WARN ครั้งใน request เดียว -> print เตือน + นับใน metrics
+GAS_TRACE_WARN = int(os.environ.get("GAS_TRACE_WARN", "5"))
+
+
+def _trace(entry):
+    if has_request_context():
+        trace = g.get("gas_trace")
+        if trace is None:
+            trace = g.gas_trace = []
+        trace.append(entry)
+
+
+def _trace_summary(trace):
+    """-> (จำนวนที่ยิงจริงต่อ table, เวลารวม ms, hit, miss)"""
+    per_table = defaultdict(int)
+    dur = 0.0
+    hit = miss = 0
+    for e in trace:
+        if e["kind"] == "http":
+            per_table[e["table"]] += 1
+            dur += e["ms"]
+        elif e["hit"]:
+            hit += 1
+        else:
+            miss += 1
+    return per_table, dur, hit, miss
+
+
+@app.after_request
+def _gas_trace_finish(resp):
+    trace = g.get("gas_trace")
+    if not trace:
+        return resp
+    per_table, dur, hit, miss = _trace_summary(trace)
+    calls = sum(per_table.values())
+    timing = [f'gas;dur={dur:.1f};desc="{calls} calls"', f'gas-cache;desc="{hit} hit {miss} miss"']
+    for table, n in sorted(per_table.items(), key=lambda x: -x[1])[:5]:
+        calls_t = [e for e in trace if e["kind"] == "http" and e["table"] == table]
+        ms = sum(e["ms"] for e in calls_t)
+        kb = sum(e["sent"] + e["received"] for e in calls_t) / 1024
+        timing.append(f'gas-{re.sub(r"[^A-Za-z0-9_-]", "_", table) or "none"};dur={ms:.1f};desc="{n}x {kb:.1f}KB"')
+    resp.headers.add("Server-Timing", ", ".join(timing))
+
+    route = request.url_rule.rule if request.url_rule else request.path
+    for table, n in per_table.items():
+        if n > GAS_TRACE_WARN:
+            actions = defaultdict(int)
+            for e in trace:
+                if e["kind"] == "http" and e["table"] == table:
+                    actions[e["action"]] += 1
+            print(f"[gas N+1] {request.method} {route}: {n} calls to '{table}' "
+                  f"({', '.join(f'{a} x{c}' for a, c in actions.items())}) > GAS_TRACE_WARN={GAS_TRACE_WARN}")
+            metric_inc("gas_n_plus_one_total", (("route", route), ("table", table)))
+    return resp
+
+
+def _gas_request(method, params=None, json=None, timeout=30):
+    """
+    ยิง GAS จุดเดียว (ทุก gas_* เรียกผ่านนี้) + เก็บ latency / bytes / status ต่อ (action, table)
+    คืน requests.Response เหมือนเดิม ผู้เรียกจัดการ raise_for_status / json เอง
+    """
+    body = params if params is not None else (json or {})
+    labels = (("action", str(body.get("action", ""))), ("table", str(body.get("table", ""))))
+    status = "error"
+    r = None
+    t0 = time.perf_counter()
+    try:
+        if method == "GET":
+            r = requests.get(GAS_URL, params=params, timeout=timeout)
+        else:
+            r = requests.post(GAS_URL, json=json, timeout=timeout)
+        status = str(r.status_code)
+        return r
+    finally:
+        elapsed = time.perf_counter() - t0
+        sent = received = 0
+        metric_observe("gas_request_duration_seconds", labels, elapsed)
+        metric_inc("gas_requests_total", labels + (("status", status),))
+        if r is not None:
+            sent = len(getattr(getattr(r, "request", None), "body", None) or b"")
+            received = len(r.content or b"")
+            if sent:
+                metric_inc("gas_request_bytes_total", labels, sent)
+            metric_inc("gas_response_bytes_total", labels, received)
+        _trace({"kind": "http", "action": labels[0][1], "table": labels[1][1], "status": status,
+                "ms": elapsed * 1000, "sent": sent, "received": received})
+
+
+@app.before_request
+def _metrics_start():
+    g.metrics_t0 = time.perf_counter()
+
+
+@app.after_request
+def _metrics_record(resp):
+    t0 = getattr(g, "metrics_t0", None)
+    if t0 is not None:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        labels = (("route", route), ("method", request.method))
+        metric_observe("http_request_duration_seconds", labels, time.perf_counter() - t0)
+        metric_inc("http_requests_total", labels + (("status", str(resp.status_code)),))
+    metrics_flush()
+    return resp
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Prometheus text รวมทุก worker
+    อนุญาต: Authorization: Bearer <METRICS_TOKEN> / admin ที่ล็อกอินอยู่
+    / เครื่องเดียวกัน (127.0.0.1) เฉพาะเมื่อตั้ง METRICS_ALLOW_LOCAL=1
+    """
+    auth = request.headers.get("Authorization", "")
+    local = METRICS_ALLOW_LOCAL and request.remote_addr in ("127.0.0.1", "::1")
+    token_ok = bool(METRICS_TOKEN) and hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}")
+    admin_ok = session.get("role") == "admin" and session_valid()
+    if not (local or token_ok or admin_ok):
+        return "forbidden", 403
+    metrics_flush(force=True)
+    return Response(metrics_render(), mimetype="text/plain; version=0.0.4")
+
+
 # ============================================
 # GOOGLE SHEETS API HELPERS
 # ============================================
@@ -163,25 +439,145 @@ _GAS_CACHE = {}
 _DASH_CACHE = {}
 _DASH_LOCK = Lock()
 
+# สถานะ scheduler ที่สร้าง aggregate ล่วงหน้า (ดูหมวด DASHBOARD SCHEDULER)
+# alive = True -> โปรเซสนี้เป็นผู้รัน scheduler (ทั้งระบบมีตัวเดียว)
+#   key ที่ scheduler refresh อยู่ (keys) จะไม่หมดอายุตาม TTL ปกติ (สูงสุด max_stale วินาที)
+# read_at = เวลาที่มีคนอ่าน dashboard ล่าสุด (ไม่มีคนดู -> scheduler ไม่ต้องดึง GAS)
+_DASH_SCHED = {"alive": False, "max_stale": float(os.environ.get("DASH_MAX_STALE", "120")),
+               "gen": 0, "keys": set(), "read_at": 0.0}
+_DASH_PREBUILT = {"drug_master_remain_v2", "drug_used_month_index_v3", "drug_summary_v3",
+                  "month_bundle", "year_bundle", "monthly_cost"}
+
 def _dash_get(key, ttl=45):
     now = time.time()
+    if _DASH_SCHED["alive"] and key and key[0] in _DASH_PREBUILT:
+        _DASH_SCHED["read_at"] = now
+        if key in _DASH_SCHED["keys"]:
+            ttl = max(ttl, _DASH_SCHED["max_stale"])
+    name = str(key[0]) if isinstance(key, tuple) and key else str(key)
     with _DASH_LOCK:
         row = _DASH_CACHE.get(key)
         if not row:
+            metric_inc("cache_requests_total", (("cache", "dash"), ("key", name), ("result", "miss")))
             return None
         ts, data = row
         if now - ts > ttl:
             _DASH_CACHE.pop(key, None)
+            metric_inc("cache_evictions_total", (("cache", "dash"), ("reason", "expired")))
+            metric_inc("cache_requests_total", (("cache", "dash"), ("key", name), ("result", "miss")))
             return None
-        return data
+    metric_inc("cache_requests_total", (("cache", "dash"), ("key", name), ("result", "hit")))
+    return data
 
 def _dash_set(key, data):
     with _DASH_LOCK:
         _DASH_CACHE[key] = (time.time(), data)
 
-def _dash_clear():
+def _dash_peek(key):
+    with _DASH_LOCK:
+        row = _DASH_CACHE.get(key)
+        return row[1] if row else None
+
+def _dash_clear(keep=()):
     with _DASH_LOCK:
-        _DASH_CACHE.clear()
+        drop = [k for k in _DASH_CACHE if k not in keep]
+        for k in drop:
+            del _DASH_CACHE[k]
+    if drop:
+        metric_inc("cache_evictions_total", (("cache", "dash"), ("reason", "invalidated")), len(drop))
+
+def _dash_invalidate(tables=()):
+    """
+    เรียกเมื่อข้อมูลใน table ที่ dashboard ใช้เปลี่ยน
+    - โปรเซสนี้รัน scheduler: key ที่ scheduler ดูแลไม่ล้าง (ผู้ใช้ยังอ่านของเดิมได้) แต่ build ใหม่หลัง write burst
+      key อื่น (เช่นปีเก่า) ล้างทิ้ง
+    - ไม่ได้รัน: ล้างทิ้งเหมือนเดิม แล้วแจ้ง worker ที่รัน scheduler ว่า tables เปลี่ยน
+    """
+    if _DASH_SCHED["alive"]:
+        _dash_clear(keep=_DASH_SCHED["keys"])
+        dash_mark_dirty()
+    else:
+        _dash_clear()
+        _dash_signal(tables)
+
+# ===== TABLE VERSION (ใช้ทำ ETag) =====
+# version ต่อ table เพิ่มขึ้นทุกครั้งที่ข้อมูลเปลี่ยน (เขียนผ่าน gas_* หรือ refetch แล้วข้อมูลไม่เหมือนเดิม)
+# boot id กัน ETag ชนกันข้ามโปรเซส/worker ที่นับ version แยกกัน
+# ต่อ pid: --preload import ใน master แล้ว fork -> worker ทุกตัวได้ค่าเดียวกันถ้าสร้างตอน import
+_BOOT = {"pid": None, "id": ""}
+_BOOT_TS = time.time()
+_TABLE_VER = defaultdict(int)
+_TABLE_MTIME = {}
+_TABLE_VER_LOCK = Lock()
+
+def table_version_bump(table):
+    t = str(table).strip().lower()
+    with _TABLE_VER_LOCK:
+        _TABLE_VER[t] += 1
+        _TABLE_MTIME[t] = time.time()
+
+def table_version(table):
+    with _TABLE_VER_LOCK:
+        return _TABLE_VER[str(table).strip().lower()]
+
+def _boot_id():
+    pid = os.getpid()
+    if _BOOT["pid"] != pid:
+        _BOOT.update(pid=pid, id=os.urandom(4).hex())
+    return _BOOT["id"]
+
+def tables_etag(tables, *extra):
+    """ETag แบบ weak จาก version ของหลาย table (+ ค่าเสริม เช่น ปี/เดือน)"""
+    parts = [_boot_id()] + [f"{t}{table_version(t)}" for t in tables] + [str(x) for x in extra]
+    return "-".join(parts)
+
+def tables_last_modified(tables):
+    """เวลาที่ table ใดใน tables เปลี่ยนล่าสุด (ยังไม่เคยเปลี่ยน = เวลา boot)"""
+    with _TABLE_VER_LOCK:
+        ts = max([_TABLE_MTIME.get(str(t).strip().lower(), _BOOT_TS) for t in tables] or [_BOOT_TS])
+    return datetime.fromtimestamp(int(ts), tz=timezone.utc)
+
+def list_etag(specs, *extra):
+    """
+    specs = [(table, limit), ...] หรือ (table, limit, "desc") ตามที่ endpoint เรียก gas_list จริง
+    แตะ cache ก่อน (ถ้า TTL หมดจะดึงใหม่และขยับ version เมื่อข้อมูลเปลี่ยน)
+    กัน 304 ค้างเมื่อ worker อื่นเป็นคนเขียน
+    """
+    for table, limit, *order in specs:
+        gas_list(table, limit, *order)
+    return tables_etag([spec[0] for spec in specs], *extra)
+
+def _not_modified(etag, last_modified=None):
+    """True ถ้า If-None-Match ตรง (หรือไม่มี If-None-Match แต่ If-Modified-Since ยังใหม่กว่า)"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+def _conditional_json(etag_fn, build_body, tables=None):
+    """
+    ตอบ 304 ถ้า ETag ตรง (ไม่ต้อง build/serialize ใหม่)
+    ไม่ตรงค่อยเรียก build_body() -> Response/dict/list
+    etag_fn เรียกซ้ำหลัง build เผื่อการ build ไปดึงชีตใหม่จน version ขยับ
+    tables (ถ้าให้มา) ใช้คิด Last-Modified
+    """
+    etag = etag_fn()
+    last_modified = tables_last_modified(tables) if tables else None
+    if _not_modified(etag, last_modified):
+        resp = app.response_class(status=304)
+    else:
+        body = build_body()
+        resp = body if isinstance(body, app.response_class) else jsonify(body)
+        etag = etag_fn()
+        if tables:
+            last_modified = tables_last_modified(tables)
+    resp.set_etag(etag, weak=True)
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    # ให้ browser เก็บไว้ได้ แต่ต้อง revalidate ทุกครั้ง
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 def _visit_year_month(raw):
     s = str(raw or "").strip()
@@ -203,59 +599,113 @@ def _visit_year_month(raw):
             pass
     return dt.year, dt.month
 
-def gas_cache_invalidate(table=None):
-    """ล้าง cache เพื่อให้ข้อมูลใหม่แสดงทันทีหลังมีการเขียนข้อมูล"""
+def gas_cache_invalidate(table=None, signal=True):
+    """
+    ล้าง cache เพื่อให้ข้อมูลใหม่แสดงทันทีหลังมีการเขียนข้อมูล
+    signal=False -> ไม่ต้องแจ้ง scheduler ข้ามโปรเซส (ใช้ตอนรับแจ้งมาจากโปรเซสอื่นเอง)
+    """
     if table is None:
+        for t in {k[0] for k in list(_GAS_CACHE.keys())}:
+            table_version_bump(t)
+        n = len(_GAS_CACHE)
         _GAS_CACHE.clear()
-        _dash_clear()
+        _stock_invalidate()
+        metric_inc("cache_evictions_total", (("cache", "gas"), ("reason", "invalidated")), n)
+        _dash_invalidate(_DASH_TABLES if signal else ())
         return
 
+    table_version_bump(table)
+    n = 0
     for k in list(_GAS_CACHE.keys()):
-        if k[0] == table:
-            _GAS_CACHE.pop(k, None)
+        if k[0] == table and _GAS_CACHE.pop(k, None) is not None:
+            n += 1
+    if n:
+        metric_inc("cache_evictions_total", (("cache", "gas"), ("reason", "invalidated")), n)
 
-    # dashboard ใช้ข้อมูลกลุ่มนี้ -> เคลียร์ dashboard cache ด้วย
-    if str(table).strip().lower() in {"treatment", "medicine", "medicine_lot", "other_item", "other_lot"}:
-        _dash_clear()
+    # lot กับ ledger ใช้คู่กัน -> ทิ้ง snapshot ทั้งชุด
+    if str(table).strip().lower() in {"medicine_lot", "other_lot", "stock_ledger"}:
+        _stock_invalidate()
 
-
-def gas_list_raw(table, limit=1000):
-    """(RAW) ดึงข้อมูลทั้งหมดจาก Sheet แบบไม่ cache"""
+    # dashboard ใช้ข้อมูลกลุ่มนี้ -> เคลียร์ dashboard cache ด้วย
+    if str(table).strip().lower() in {"treatment", "medicine", "medicine_lot", "other_item", "other_lot", "stock_ledger"}:
+        _dash_invalidate((table,) if signal else ())
+
+
+def _gas_cache_key(table, limit, order="asc", fields=None, offset=0):
+    # asc ทุกคอลัมน์คง key เดิม (table, limit) / desc หรือ projection แยก key เพราะเป็นคนละชุดข้อมูล
+    if offset:
+        return (table, limit, order, tuple(fields or ()), offset)
+    if fields:
+        return (table, limit, order, tuple(fields))
+    return (table, limit) if order != "desc" else (table, limit, "desc")
+
+
+def gas_list_raw(table, limit=1000, order="asc", fields=None, offset=0):
+    """(RAW) ดึงข้อมูลจาก Sheet แบบไม่ cache / order="desc" = N แถวท้ายชีต ใหม่ -> เก่า
+    fields = ขอเฉพาะบางคอลัมน์ (GAS รุ่นเก่าไม่รองรับจะส่งมาทุกคอลัมน์ -> ตัดให้ที่นี่)
+    offset = (desc เท่านั้น) ข้าม offset แถวท้ายชีตก่อน (GAS รุ่นเก่าไม่รองรับจะได้ N แถวท้ายเหมือนไม่ใส่)"""
+    params = {
+        "action": "list",
+        "table": table,
+        "limit": limit
+    }
+    if order == "desc":
+        params["order"] = "desc"
+        if offset:
+            params["offset"] = offset
+    if fields:
+        params["fields"] = ",".join(fields)
     try:
-        r = requests.get(GAS_URL, params={
-            "action": "list",
-            "table": table,
-            "limit": limit
-        }, timeout=30)
+        r = _gas_request("GET", params=params, timeout=30)
         r.raise_for_status()
-        return r.json()
+        res = r.json()
+        if fields and isinstance(res, dict) and res.get("ok"):
+            res["data"] = [{k: row.get(k) for k in fields} for row in _unwrap_rows(res)]
+        return res
     except Exception as e:
         print(f"gas_list error: {e}")
         return {"ok": False, "data": [], "message": str(e)}
 
 
-def gas_list_cached(table, limit=5000, ttl=20):
+def gas_list_cached(table, limit=5000, ttl=20, order="asc", fields=None, offset=0):
     """ดึงข้อมูลแบบมี cache TTL สั้น ๆ กันการดึงชีตซ้ำ"""
-    key = (table, limit)
+    key = _gas_cache_key(table, limit, order, fields, offset)
     now = time.time()
 
+    labels = (("cache", "gas"), ("table", str(table)))
     if key in _GAS_CACHE:
         ts, res = _GAS_CACHE[key]
         if now - ts < ttl:
+            metric_inc("cache_requests_total", labels + (("result", "hit"),))
+            _trace({"kind": "cache", "table": str(table), "hit": True})
             return res
+        metric_inc("cache_evictions_total", (("cache", "gas"), ("reason", "expired")))
+    metric_inc("cache_requests_total", labels + (("result", "miss"),))
+    _trace({"kind": "cache", "table": str(table), "hit": False})
 
-    res = gas_list_raw(table, limit)
+    old = _GAS_CACHE.get(key)
+    res = gas_list_raw(table, limit, order, fields, offset)
 
     # cache เฉพาะผลลัพธ์ที่ ok
     if isinstance(res, dict) and res.get("ok"):
-        _GAS_CACHE[key] = (now, res)
+        _gas_cache_store(key, table, res, now, old)
 
     return res
 
 
-def gas_list(table, limit=1000):
-    """(DEFAULT) ให้ทุกจุดในระบบที่เรียก gas_list ได้ cache อัตโนมัติ"""
-    return gas_list_cached(table, limit=limit, ttl=20)
+def _gas_cache_store(key, table, res, now, old=None):
+    old = old if old is not None else _GAS_CACHE.get(key)
+    # TTL หมดแล้วดึงใหม่ได้ข้อมูลไม่เหมือนเดิม (เช่น worker อื่นเขียน) -> ขยับ version
+    if old is not None and old[1].get("data") != res.get("data"):
+        table_version_bump(table)
+    _GAS_CACHE[key] = (now, res)
+
+
+def gas_list(table, limit=1000, order="asc", fields=None, offset=0):
+    """(DEFAULT) ให้ทุกจุดในระบบที่เรียก gas_list ได้ cache อัตโนมัติ
+    order="desc" = limit แถวล่าสุด (ท้ายชีต) เรียงใหม่ -> เก่า โดยไม่ต้องดึงทั้งชีต (offset = หน้าที่เก่ากว่า)
+    fields = projection เฉพาะคอลัมน์ที่ใช้"""
+    return gas_list_cached(table, limit=limit, ttl=20, order=order, fields=fields, offset=offset)
 
 
 def norm_text(s):
@@ -360,6 +810,9 @@ def _pick_canonical_med_id(name: str, fallback_med_id=None):
 
     return sorted(set(ids), key=_sort_key)[0]
 
+# (table, limit) ของ medicine_lot ที่ /api/medicine_lots ใช้ทั้งสร้าง body และคิด ETag -> cache entry เดียวกัน
+_MED_LOT_SPEC = ("medicine_lot", 10000)
+
 def _get_shared_medicine_lots_by_name(name: str):
     """
     ดึง lot ของยาร่วมจากทุก medicine_id ที่ชื่อเดียวกัน
@@ -369,7 +822,7 @@ def _get_shared_medicine_lots_by_name(name: str):
     target_key = _norm_med_key(canon)
     target_ids = set(_find_medicine_ids_by_exact_name(canon))
 
-    rows = _unwrap_rows(gas_list("medicine_lot", 10000))
+    rows = _unwrap_rows(gas_list(*_MED_LOT_SPEC))
     out = []
     for r in rows:
         rid = str(r.get("id", "")).strip()
@@ -385,7 +838,7 @@ def _get_shared_medicine_lots_by_name(name: str):
 def gas_get(table, row_id):
     """ดึงข้อมูลตาม ID"""
     try:
-        r = requests.get(GAS_URL, params={
+        r = _gas_request("GET", params={
             "action": "get",
             "table": table,
             "id": str(row_id)
@@ -400,7 +853,7 @@ def gas_get(table, row_id):
 def gas_search(table, field, value):
     """ค้นหาข้อมูลตามฟิลด์"""
     try:
-        r = requests.get(GAS_URL, params={
+        r = _gas_request("GET", params={
             "action": "search",
             "table": table,
             "field": field,
@@ -416,7 +869,7 @@ def gas_search(table, field, value):
 def gas_append(table, payload):
     """เพิ่มข้อมูลใหม่"""
     try:
-        r = requests.post(GAS_URL, json={
+        r = _gas_request("POST", json={
             "action": "append",
             "table": table,
             "payload": payload
@@ -437,7 +890,7 @@ def gas_append(table, payload):
 def gas_update(table, row_id, payload):
     """แก้ไขข้อมูลตาม ID"""
     try:
-        r = requests.post(GAS_URL, json={
+        r = _gas_request("POST", json={
             "action": "update",
             "table": table,
             "id": str(row_id),
@@ -459,7 +912,7 @@ def gas_update(table, row_id, payload):
 def gas_update_field(table, row_id, field, value):
     """อัปเดตฟิลด์เดียว"""
     try:
-        r = requests.post(GAS_URL, json={
+        r = _gas_request("POST", json={
             "action": "update_field",
             "table": table,
             "id": str(row_id),
@@ -479,10 +932,35 @@ def gas_update_field(table, row_id, field, value):
         return {"ok": False, "message": str(e)}
 
 
+def gas_update_field_if(table, row_id, field, expected, value):
+    """อัปเดตฟิลด์เดียวเฉพาะเมื่อค่าปัจจุบัน == expected (compare-and-set)
+    ไม่ตรง -> {"ok": False, "conflict": True, "current": ...}"""
+    try:
+        r = _gas_request("POST", json={
+            "action": "update_field_if",
+            "table": table,
+            "id": str(row_id),
+            "field": field,
+            "expected": expected,
+            "value": value
+        }, timeout=30)
+        r.raise_for_status()
+        res = r.json()
+
+        # ✅ อัปเดตสำเร็จ -> ล้าง cache ของ table นี้
+        if isinstance(res, dict) and res.get("ok"):
+            gas_cache_invalidate(table)
+
+        return res
+    except Exception as e:
+        print(f"gas_update_field_if error: {e}")
+        return {"ok": False, "message": str(e)}
+
+
 def gas_delete(table, row_id):
     """ลบข้อมูลตาม ID"""
     try:
-        r = requests.post(GAS_URL, json={
+        r = _gas_request("POST", json={
             "action": "delete",
             "table": table,
             "id": str(row_id)
@@ -500,6 +978,44 @@ def gas_delete(table, row_id):
         return {"ok": False, "message": str(e)}
 
 
+def gas_delete_where(table, where=None, ids=None, ci=False):
+    """
+    ลบทุกแถวที่ตรงเงื่อนไขใน 1 request (GAS อ่านชีตรอบเดียว ลบล่างขึ้นบน)
+    where = {field: value} (ci=True ไม่สนตัวพิมพ์) / ids = [id, ...]
+    -> {"ok": True, "deleted": n, "ids": [...]}
+    """
+    if ids is not None:
+        body = {"action": "batch_delete", "table": table, "payload": {"ids": [str(x) for x in ids]}}
+    else:
+        body = {"action": "delete_where", "table": table, "payload": {"where": where or {}, "ci": bool(ci)}}
+    try:
+        r = _gas_request("POST", json=body, timeout=60)
+        r.raise_for_status()
+        res = r.json()
+
+        # ✅ ลบสำเร็จ -> ล้าง cache ของ table นี้ครั้งเดียว
+        if isinstance(res, dict) and res.get("ok") and res.get("deleted", 1):
+            gas_cache_invalidate(table)
+
+        return res
+    except Exception as e:
+        print(f"gas_delete_where error: {e}")
+        return {"ok": False, "message": str(e)}
+
+
+def _cascade_delete(table, where, ci=False):
+    """ลบ lot ลูกทั้งหมดของรายการ (GAS รุ่นเก่าที่ยังไม่มี delete_where -> ลบทีละแถวแบบเดิม)"""
+    res = gas_delete_where(table, where=where, ci=ci)
+    if res.get("message") != "Unknown action":
+        return res
+
+    norm = (lambda v: str(v or "").strip().lower()) if ci else (lambda v: str(v or "").strip())
+    for row in _unwrap_rows(gas_list(table, 5000)):
+        if all(norm(row.get(f)) == norm(v) for f, v in where.items()):
+            gas_delete(table, row.get("id"))
+    return {"ok": True}
+
+
 def _to_int(v, default=0):
     try:
         return int(float(str(v).replace(",", "").strip()))
@@ -520,7 +1036,7 @@ def gas_batch_get(table, ids):
             "table": table,
             "payload": {"ids": [str(x) for x in ids]}
         }
-        r = requests.post(GAS_URL, json=payload, timeout=30)
+        r = _gas_request("POST", json=payload, timeout=30)
         r.raise_for_status()
         return r.json()
     except Exception as e:
@@ -538,13 +1054,58 @@ def gas_batch_update_fields(table, updates):
             "table": table,
             "payload": {"updates": updates}
         }
-        r = requests.post(GAS_URL, json=payload, timeout=30)
+        r = _gas_request("POST", json=payload, timeout=30)
         r.raise_for_status()
-        return r.json()
+        res = r.json()
+
+        # ✅ อัปเดตสำเร็จ -> ล้าง cache ของ table นี้
+        if isinstance(res, dict) and res.get("ok"):
+            gas_cache_invalidate(table)
+
+        return res
     except Exception as e:
         print("gas_batch_update_fields error:", e)
         return {"ok": False, "message": str(e)}
 
+def gas_batch_append(table, rows, invalidate=True):
+    """
+    เพิ่มหลายแถวใน 1 request -> {"ok": True, "ids": [...]}
+    invalidate=False ให้ผู้เรียกจัดการ cache เอง (เช่น stock ledger ที่ต่อท้าย cache ในหน่วยความจำ)
+    """
+    try:
+        r = _gas_request("POST", json={
+            "action": "batch_append",
+            "table": table,
+            "payload": {"rows": rows}
+        }, timeout=30)
+        r.raise_for_status()
+        res = r.json()
+
+        if invalidate and isinstance(res, dict) and res.get("ok"):
+            gas_cache_invalidate(table)
+
+        return res
+    except Exception as e:
+        print("gas_batch_append error:", e)
+        return {"ok": False, "message": str(e)}
+
+def gas_stock_moves(rows):
+    """
+    ตรวจคงเหลือ + append ledger ใน script lock เดียวกันของ GAS (action stock_moves)
+    -> {"ok": True, "ids"} หรือ {"ok": False, "short"|"not_found": True, "lot_table", "lot_id", "remain"}
+    """
+    try:
+        r = _gas_request("POST", json={
+            "action": "stock_moves",
+            "table": STOCK_LEDGER,
+            "payload": {"rows": rows}
+        }, timeout=30)
+        r.raise_for_status()
+        return r.json()
+    except Exception as e:
+        print("gas_stock_moves error:", e)
+        return {"ok": False, "message": str(e)}
+
 # ===== Decimal / Money Helpers =====
 def _normalize_num_str(v):
     s = str(v or "").strip().replace(" ", "")
@@ -616,158 +1177,1046 @@ def _get_lots_by_field_fast(table, field, value, limit=5000):
 
 
 # ============================================
-# AUTH DECORATORS
+# STOCK LEDGER
 # ============================================
+# การตัดจ่าย/คืน/รับเข้า stock = append 1 แถวใน stock_ledger (ไม่อ่าน-แก้-เขียน qty_remain)
+# คงเหลือจริง = qty_remain ใน lot (base ที่ cache ไว้) + delta ของ ledger ที่ id > ledger_seq ของ lot
+# compaction (scheduler/GAS) รวม delta กลับเข้า qty_remain แล้วล้าง ledger เป็นระยะ (ทั้งระบบทีละโปรเซส)
+# lot + ledger อ่านเป็น snapshot ชุดเดียว ล้างพร้อมกัน -> คงเหลือไม่เพี้ยนตอน compaction
 
-def login_required(f):
-    @wraps(f)
-    def wrap(*args, **kwargs):
-        if "username" not in session:
-            return redirect("/")
-        return f(*args, **kwargs)
-    return wrap
+STOCK_LEDGER = "stock_ledger"
+_LOT_TABLES = ("medicine_lot", "other_lot")
+_LEDGER_LIMIT = 10000
+_STOCK_TTL = 20
+# snap = {"at", "idx": {(lot_table, lot_id): [(ledger_id, delta), ...]}, "lots": {lot_table: {id: row}}}
+# gen ขยับทุกครั้งที่ invalidate -> snapshot ที่ build ค้างอยู่ตอนนั้นไม่ถูกเก็บ
+_STOCK = {"snap": None, "gen": 0, "building": False, "recent": []}
+_STOCK_BUILD_LOCK = Lock()
+_STOCK_LOCK = Lock()
 
 
-def admin_required(f):
-    @wraps(f)
-    def wrap(*args, **kwargs):
-        if session.get("role") != "admin":
-            return redirect("/menu")
-        return f(*args, **kwargs)
-    return wrap
+def lot_table_for_type(item_type):
+    t = str(item_type or "").strip().lower()
+    return "other_lot" if t in ("other", "other_item", "อื่นๆ") else "medicine_lot"
 
 
-def catalog_required(f):
+def _ledger_add(idx, rows):
+    for r in rows:
+        key = (str(r.get("lot_table", "")).strip(), str(r.get("lot_id", "")).strip())
+        idx.setdefault(key, []).append((_to_int(r.get("id"), 0), _to_int(r.get("delta"), 0)))
+
+
+def _stock_invalidate():
+    """ทิ้ง snapshot ทั้งชุด (ledger + lot พร้อมกัน)"""
+    with _STOCK_LOCK:
+        _STOCK["gen"] += 1
+        _STOCK["snap"] = None
+        _STOCK["recent"] = []
+
+
+def _stock_snapshot():
     """
-    อนุญาตเฉพาะผู้ที่ล็อกอินและมี role = admin หรือ user
-    (ตาม requirement ใหม่: user ทั่วไปก็เพิ่ม/ลบได้)
+    ledger + lot ทั้ง 2 ตาราง อ่านเป็นชุดเดียว TTL เดียว ล้างพร้อมกัน
+    (lot กับ ledger คนละ TTL -> compaction ล้าง ledger ระหว่างนั้น delta ที่รวมไปแล้วจะหายจากคงเหลือ)
+    อ่าน ledger ก่อน lot: compaction แทรกกลางทาง lot ได้ ledger_seq ใหม่ -> delta เก่าถูกตัดด้วย seq ไม่นับซ้ำ/ไม่หาย
     """
-    @wraps(f)
-    def wrap(*args, **kwargs):
-        if "username" not in session:
-            return redirect("/")
-        role = str(session.get("role", "")).strip().lower()
-        if role not in ("admin", "user"):
-            return redirect("/menu")
-        return f(*args, **kwargs)
-    return wrap
-
+    snap = _STOCK["snap"]
+    if snap is not None and time.time() - snap["at"] < _STOCK_TTL:
+        return snap
+
+    with _STOCK_BUILD_LOCK:
+        snap = _STOCK["snap"]
+        if snap is not None and time.time() - snap["at"] < _STOCK_TTL:
+            return snap
+        with _STOCK_LOCK:
+            gen = _STOCK["gen"]
+            _STOCK["building"] = True
+            _STOCK["recent"] = []
+        try:
+            now = time.time()
+            srcs = {STOCK_LEDGER: gas_list_raw(STOCK_LEDGER, _LEDGER_LIMIT)}
+            for t in _LOT_TABLES:
+                srcs[t] = gas_list_raw(t, _LEDGER_LIMIT)
+        finally:
+            with _STOCK_LOCK:
+                _STOCK["building"] = False
+
+        idx = {}
+        lots = {}
+        for t, res in srcs.items():
+            if not (isinstance(res, dict) and res.get("ok")):
+                # ชีต ledger ยังไม่มี/GAS ล่ม -> ไม่มี delta (lot ใช้ rows ที่ผู้เรียกส่งมา)
+                continue
+            if t == STOCK_LEDGER:
+                _ledger_add(idx, _unwrap_rows(res))
+            else:
+                lots[t] = {str(r.get("id", "")).strip(): r for r in _unwrap_rows(res)}
 
-# ============================================
-# TEST ROUTES
-# ============================================
+        snap = {"at": now, "idx": idx, "lots": lots}
+        with _STOCK_LOCK:
+            # movement ที่ worker นี้เขียนระหว่าง build อาจไม่อยู่ใน ledger ที่อ่านมา -> เติมให้ (id ซ้ำข้าม)
+            seen = {lid for moves in idx.values() for lid, _ in moves}
+            _ledger_add(idx, [r for r in _STOCK["recent"] if _to_int(r.get("id"), 0) not in seen])
+            _STOCK["recent"] = []
+            if _STOCK["gen"] == gen:
+                _STOCK["snap"] = snap
+                # ใส่ cache ของ gas_list ด้วย (ชุดเดียวกัน ไม่ต้องดึงซ้ำ)
+                for t, res in srcs.items():
+                    if isinstance(res, dict) and res.get("ok"):
+                        _gas_cache_store(_gas_cache_key(t, _LEDGER_LIMIT), t, res, now)
+        return snap
 
-@app.get("/test-gas")
-def test_gas():
-    """ทดสอบการเชื่อมต่อ GAS"""
-    res = gas_list("users", 5)
-    return jsonify(res)
 
+def _ledger_pending(snap, lot_table, lot_id, seq):
+    moves = snap["idx"].get((lot_table, str(lot_id).strip()), ())
+    return sum(d for lid, d in moves if lid > seq)
 
-@app.get("/fix-admin")
-def fix_admin():
-    """สร้าง Admin สำรองกรณีเข้าไม่ได้"""
-    all_users = gas_list("users", 1000)
-    found = False
-    if all_users.get("ok"):
-        for u in all_users.get("data", []):
-            if str(u.get("username", "")).lower() == "admin":
-                found = True
-                break
 
-    if found:
-        return "<h1>Admin user already exists!</h1> <p>User: admin / Pass: 111</p> <a href='/'>Go to Login</a>"
+def lot_remain(lot_table, lot):
+    """
+    คงเหลือจริงของ lot (base + ledger ที่ยังไม่ถูก compact)
+    base/ledger_seq เอาจาก lot ใน snapshot ชุดเดียวกับ ledger (rows ที่ส่งมาอาจมาจาก cache คนละรอบ)
+    """
+    snap = _stock_snapshot()
+    lid = str(lot.get("id", "")).strip()
+    base_row = snap["lots"].get(lot_table, {}).get(lid, lot)
+    base = _to_int(base_row.get("qty_remain"), 0)
+    return base + _ledger_pending(snap, lot_table, lid, _to_int(base_row.get("ledger_seq"), 0))
+
+
+def lots_with_remain(lot_table, rows):
+    """คืน copy ของ lot rows ที่ qty_remain เป็นคงเหลือจริงแล้ว"""
+    snap = _stock_snapshot()
+    if not snap["idx"] and lot_table not in snap["lots"]:
+        return rows
+    out = []
+    for r in rows:
+        r = dict(r)
+        r["qty_remain"] = lot_remain(lot_table, r)
+        out.append(r)
+    return out
 
-    payload = {
-        "username": "admin",
-        "password": "111",
-        "name": "Admin Recovery",
-        "dept": "IT",
-        "role": "admin"
-    }
-    res = gas_append("users", payload)
-    return f"<h1>Created Admin!</h1> <pre>{res}</pre> <a href='/'>Go to Login</a>"
 
+def lot_rows_by_id(lot_table, ids=None):
+    """lot จาก snapshot เป็น dict id -> row (คงเหลือจริงแล้ว)"""
+    snap = _stock_snapshot()
+    if lot_table in snap["lots"]:
+        rows = list(snap["lots"][lot_table].values())
+    else:
+        rows = _unwrap_rows(gas_list(lot_table, _LEDGER_LIMIT))
+    if ids is not None:
+        want = {str(x).strip() for x in ids}
+        rows = [r for r in rows if str(r.get("id", "")).strip() in want]
+    return {str(r.get("id", "")).strip(): r for r in lots_with_remain(lot_table, rows)}
 
-# ============================================
-# LOGIN / LOGOUT
-# ============================================
 
-@app.route("/logout")
-def logout():
-    session.clear()
-    return redirect("/")
+def find_lots(keys):
+    """
+    keys = [(lot_table, lot_id), ...] -> {(lot_table, lot_id): (actual_table, row)}
+    อ่านจาก cache ทั้ง 2 ตาราง (ไม่ยิง GAS ต่อ lot) เผื่อ type เก่าคลาดเคลื่อนจะหาอีกตารางให้
+    lot ที่ไม่อยู่ใน cache (เพิ่งสร้าง) ค่อย gas_get ทีละตัว
+    """
+    by_table = {t: lot_rows_by_id(t) for t in _LOT_TABLES}
+    out = {}
+    for table, lot_id in keys:
+        lid = str(lot_id).strip()
+        other = "other_lot" if table == "medicine_lot" else "medicine_lot"
+        for t in (table, other):
+            if lid in by_table[t]:
+                out[(table, lot_id)] = (t, by_table[t][lid])
+                break
+        else:
+            for t in (table, other):
+                r = gas_get(t, lid)
+                if r.get("ok") and r.get("data"):
+                    row = dict(r["data"])
+                    row["qty_remain"] = lot_remain(t, row)
+                    out[(table, lot_id)] = (t, row)
+                    break
+    return out
 
 
-@app.route("/", methods=["GET", "POST"])
-def login():
-    if request.method == "POST":
-        username = request.form.get("username", "").strip()
-        password = request.form.get("password", "").strip()
+def _ledger_cache_append(rows):
+    """ต่อท้าย ledger ที่ cache ไว้ในหน่วยความจำ (snapshot + gas_list) แทนการดึงทั้งตารางใหม่"""
+    with _STOCK_LOCK:
+        snap = _STOCK["snap"]
+        if snap is not None:
+            _ledger_add(snap["idx"], rows)
+        if _STOCK["building"]:
+            _STOCK["recent"].extend(rows)
 
-        res = gas_list("users", 1000)
-        found_user = None
+    for key, (ts, res) in list(_GAS_CACHE.items()):
+        if key[0] != STOCK_LEDGER:
+            continue
+        if len(key) > 2:
+            # ชุด desc (ใหม่ -> เก่า) ต่อท้ายไม่ได้ -> ทิ้งให้ดึงใหม่
+            _GAS_CACHE.pop(key, None)
+            metric_inc("cache_evictions_total", (("cache", "gas"), ("reason", "invalidated")))
+            continue
+        data = _unwrap_rows(res)
+        room = max(0, key[1] - len(data))
+        _GAS_CACHE[key] = (ts, {**res, "data": data + rows[:room]})
 
-        if res.get("ok"):
-            for user in res.get("data", []):
-                if str(user.get("username", "")).strip().lower() == username.lower():
-                    found_user = user
-                    break
 
-        if found_user:
-            if str(found_user.get("password", "")).strip() == password:
-                session["username"] = found_user["username"]
-                session["role"] = found_user.get("role", "user")
-                session["user_name"] = found_user.get("name", "")
-                return redirect("/menu")
+def stock_moves(moves, reason, ref=""):
+    """
+    moves = [(lot_table, lot_id, delta), ...]  delta < 0 = ตัดจ่าย, > 0 = คืน/รับเข้า
+    เขียน ledger 1 request ต่อครั้ง (ทุกรายการรวมกัน) GAS ตรวจคงเหลือใต้ script lock ก่อนเขียน
+    lot ใดติดลบ -> ไม่เขียนทั้งชุด คืน short (ไม่ใช้ cache ของ worker ตัดสิน)
+    """
+    now_s = th_now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = [{
+        "lot_table": t,
+        "lot_id": str(lot_id),
+        "delta": int(delta),
+        "reason": reason,
+        "ref": str(ref or ""),
+        "created_at": now_s,
+    } for t, lot_id, delta in moves if int(delta) != 0]
+    if not rows:
+        return {"ok": True, "ids": []}
+
+    res = gas_stock_moves(rows)
+    if not (isinstance(res, dict) and res.get("ok")):
+        if isinstance(res, dict) and res.get("short"):
+            # cache ของ worker นี้เก่ากว่าของจริง -> ดึงใหม่รอบหน้า
+            gas_cache_invalidate(STOCK_LEDGER)
+        return res
 
-        return render_template("login.html", error="ชื่อผู้ใช้หรือรหัสผ่านไม่ถูกต้อง")
+    ids = res.get("ids") or []
+    if len(ids) == len(rows):
+        for r, new_id in zip(rows, ids):
+            r["id"] = new_id
+        _ledger_cache_append(rows)
+    else:
+        gas_cache_invalidate(STOCK_LEDGER)
 
-    return render_template("login.html")
+    # คงเหลือจริงของ lot เปลี่ยน -> ETag ของ list lot / dashboard ต้องเปลี่ยนด้วย
+    table_version_bump(STOCK_LEDGER)
+    for t in {m[0] for m in moves}:
+        table_version_bump(t)
+    _dash_invalidate((STOCK_LEDGER,))
+    return res
 
 
-# ============================================
-# MENU
-# ============================================
+# ===== concurrency: lock striping ต่อ lot + CAS =====
+# lock ต่อ (lot_table, lot_id) แบบ striped (จำนวน lock คงที่) ใช้ร่วมทุก thread ใน worker
+# คนละ lot ส่วนใหญ่ได้คนละ stripe -> จ่ายยาพร้อมกันได้ ไม่ติด lock กลางตัวเดียว
+# lock นี้แค่ลดการยิงซ้อนกันใน worker เดียว ตัวตัดสินว่าพอหรือไม่คือ GAS (stock_moves / CAS) ที่เห็นทุก worker
+_LOT_LOCK_STRIPES = [Lock() for _ in range(64)]
+_STOCK_CAS_RETRIES = 3
 
-@app.route("/menu")
-@login_required
-def menu():
-    return render_template("menu.html", role=session.get("role"))
 
+class lot_locks:
+    """with lot_locks(keys): ... ล็อกทุก stripe ที่ keys ใช้ เรียงลำดับเสมอกัน deadlock"""
 
-# ============================================
-# USER MANAGEMENT (ADMIN)
-# ============================================
+    def __init__(self, keys):
+        n = len(_LOT_LOCK_STRIPES)
+        self.idx = sorted({hash((str(t), str(i).strip())) % n for t, i in keys})
 
-@app.route("/users", methods=["GET", "POST"])
-@admin_required
-def users():
-    if request.method == "POST":
-        payload = {
-            "username": request.form.get("username", "").strip(),
-            "password": request.form.get("password", "").strip(),
-            "name": request.form.get("name", "").strip(),
-            "dept": request.form.get("dept", "").strip(),
-            "role": request.form.get("role", "user").strip()
-        }
-        gas_append("users", payload)
+    def __enter__(self):
+        for i in self.idx:
+            _LOT_LOCK_STRIPES[i].acquire()
+        return self
 
-    res = gas_list("users", 1000)
-    users_list = res.get("data", []) if res.get("ok") else []
-    return render_template("users.html", users=users_list)
+    def __exit__(self, *exc):
+        for i in reversed(self.idx):
+            _LOT_LOCK_STRIPES[i].release()
+        return False
 
 
-@app.route("/users/delete/<int:id>")
+def _stock_write_cas(moves):
+    """
+    fallback เมื่อ GAS ยังไม่รองรับ ledger: เขียน qty_remain ตรง ๆ ด้วย compare-and-set
+    conflict -> ใช้ค่าปัจจุบันที่ GAS ส่งกลับมาคำนวณใหม่ (retry จำกัดครั้ง)
+    ล้มกลางทาง -> คืนค่ารายการที่เขียนไปแล้ว
+    """
+    done = []
+    for t, lot_id, delta in moves:
+        r = gas_get(t, lot_id)
+        if not r.get("ok") or not r.get("data"):
+            res = {"ok": False, "not_found": True, "lot_table": t, "lot_id": str(lot_id),
+                   "message": f"ไม่พบ Lot: {lot_id}"}
+            break
+        current = _to_int(r["data"].get("qty_remain"), 0)
+        # movement ใน ledger ที่ยังไม่ถูก compact นับรวมด้วย (CAS เขียนเฉพาะ base) ตัดด้วย ledger_seq ของแถวที่เพิ่งอ่าน
+        pending = _ledger_pending(_stock_snapshot(), t, lot_id, _to_int(r["data"].get("ledger_seq"), 0))
+        for attempt in range(_STOCK_CAS_RETRIES):
+            if delta < 0 and current + pending + delta < 0:
+                res = {"ok": False, "short": True, "lot_table": t, "lot_id": str(lot_id),
+                       "remain": current + pending, "message": f"จำนวนคงเหลือไม่พอ (Lot {lot_id})"}
+                break
+            res = gas_update_field_if(t, lot_id, "qty_remain", current, current + delta)
+            if res.get("ok") or not res.get("conflict"):
+                break
+            current = _to_int(res.get("current"), 0)
+            time.sleep(0.05 * (attempt + 1))
+        else:
+            res = {"ok": False, "message": f"stock ถูกแก้พร้อมกันหลายครั้ง (Lot {lot_id}) กรุณาลองใหม่"}
+
+        if res.get("message") == "Unknown action":
+            # GAS รุ่นเก่ามาก: ไม่มีทั้ง ledger และ CAS -> ไม่เขียนทับตรง ๆ (จะเสีย stock เมื่อเขียนพร้อมกัน) ให้อัปเดต gas_code.js
+            print(f"stock write refused: GAS has neither stock_moves nor update_field_if (Lot {t}/{lot_id})")
+            metric_inc("stock_write_unsupported_total", (("table", t),))
+            res = {"ok": False, "message": "GAS ยังไม่รองรับการตัด stock แบบปลอดภัย กรุณาอัปเดต gas_code.js"}
+        if not res.get("ok"):
+            break
+        done.append((t, lot_id, delta))
+    else:
+        return {"ok": True}
+
+    for t, lot_id, delta in reversed(done):
+        _stock_write_cas([(t, lot_id, -delta)])
+    return res
+
+
+def stock_apply(deltas, reason, ref="", skip_missing=False):
+    """
+    ตรวจ + เขียน stock หลาย lot ภายใต้ lock ของ lot เหล่านั้น
+    deltas = {(lot_table, lot_id): delta}  (delta < 0 = ตัดจ่าย)
+    คืน {"ok": True, "moves": [...]} หรือ
+        {"ok": False, "error": "not_found"|"short"|"write", "key", "lot", "message"}
+    """
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return {"ok": True, "moves": []}
+
+    # cache ใช้แค่หา table จริงของ lot / คงเหลือตัดสินที่ GAS
+    found = find_lots(deltas.keys())
+    moves, key_of = [], {}
+    for key, delta in deltas.items():
+        if key not in found:
+            if skip_missing:
+                continue
+            return {"ok": False, "error": "not_found", "key": key, "message": f"ไม่พบ Lot: {key[1]}"}
+        actual_table = found[key][0]
+        lot_id = str(key[1]).strip()
+        moves.append((actual_table, lot_id, delta))
+        key_of[(actual_table, lot_id)] = key
+    if not moves:
+        return {"ok": True, "moves": []}
+
+    with lot_locks([(t, lot_id) for t, lot_id, _ in moves]):
+        res = stock_moves(moves, reason, ref=ref)
+        via = "ledger"
+        if not res.get("ok") and res.get("message") == "Unknown action":
+            # gas_code.js รุ่นที่ยังไม่มี stock_moves: CAS ทีละ lot (ตรวจกับค่าใน GAS)
+            res = _stock_write_cas(moves)
+            via = "cas"
+    if res.get("ok"):
+        return {"ok": True, "moves": moves, "via": via}
+
+    key = key_of.get((str(res.get("lot_table") or ""), str(res.get("lot_id") or "").strip()))
+    if res.get("not_found") and key is not None:
+        if skip_missing:
+            # lot ถูกลบหลัง cache -> ข้ามแล้วทำส่วนที่เหลือ
+            rest = {k: v for k, v in deltas.items() if k != key}
+            return stock_apply(rest, reason, ref=ref, skip_missing=True)
+        return {"ok": False, "error": "not_found", "key": key, "message": f"ไม่พบ Lot: {key[1]}"}
+    if res.get("short"):
+        lot = dict(found[key][1]) if key is not None else {}
+        if "remain" in res:
+            lot["qty_remain"] = _to_int(res.get("remain"), 0)
+        return {"ok": False, "error": "short", "key": key or (res.get("lot_table"), res.get("lot_id")), "lot": lot,
+                "message": f"จำนวนคงเหลือไม่พอ (Lot {res.get('lot_id')})"}
+    return {"ok": False, "error": "write", "message": res.get("message") or "อัปเดต stock ไม่สำเร็จ"}
+
+
+def stock_revert(applied, reason="rollback", ref=""):
+    """
+    compensating batch: กลับรายการที่ stock_apply เขียนไปแล้ว (ใช้เมื่อขั้นถัดไปล้ม)
+    applied = ผลลัพธ์ ok ของ stock_apply
+    """
+    inverse = [(t, lot_id, -delta) for t, lot_id, delta in applied.get("moves") or []]
+    if not inverse:
+        return {"ok": True}
+    with lot_locks([(t, lot_id) for t, lot_id, _ in inverse]):
+        if applied.get("via") == "cas":
+            res = _stock_write_cas(inverse)
+        else:
+            res = stock_moves(inverse, reason, ref=ref)
+    if not res.get("ok"):
+        print(f"stock_revert error ({ref}): {res.get('message')} moves={inverse}")
+    return res
+
+
+# ===== FEFO: จัดสรร lot อัตโนมัติ (หมดอายุก่อน จ่ายก่อน) =====
+# index ในหน่วยความจำ: (lot_table, item_key) -> lot rows เรียงตามวันหมดอายุ
+# สร้างใหม่เมื่อ cache ของ medicine / lot เปลี่ยน (คงเหลือจริงคิดจาก ledger ตอนจัดสรร)
+_FEFO_LIMIT = 10000
+_FEFO_IDX = {"src": None, "idx": {}, "mid_by_name": {}}
+_FEFO_LOCK = Lock()
+
+
+def _fefo_item_key(lot_table, name, medicine_id=""):
+    """
+    pool ของ lot ที่จ่ายแทนกันได้ ให้ตรงกับ lot ที่หน้าฟอร์มแสดง (_build_medicine_lots)
+    - ยาร่วม (_SHARED_MED_RULES) -> ชื่อ canonical เดียวกัน = pool เดียวกันข้ามทุก medicine_id
+    - ยาอื่น -> ต่อ medicine_id (ชื่อซ้ำ/คล้ายกันคนละรายการไม่ปนกัน)
+    - other_lot -> ต่อชื่อ item
+    """
+    if lot_table == "medicine_lot":
+        if is_shared_medicine_name(name):
+            return "name:" + _norm_med_key(canonical_medicine_name(name))
+        mid = str(medicine_id or "").strip()
+        return "id:" + mid if mid else None
+    return norm_text(name).lower()
+
+
+def _expire_sort_key(value):
+    """วันหมดอายุเร็วสุดก่อน / อ่านไม่ออกต่อท้าย / ไม่ระบุไว้ท้ายสุด"""
+    s = str(value or "").strip()
+    if not s:
+        return (2, "")
+    d = _parse_any_datetime(s)
+    if d is None:
+        return (1, s)
+    return (0, d.strftime("%Y-%m-%d"))
+
+
+def _fefo_index():
+    """คืน (idx, mid_by_name) / idx = {(lot_table, key): [lot เรียง FEFO]} / mid_by_name = norm_key(ชื่อยา) -> medicine_id"""
+    srcs = (
+        gas_list("medicine", 5000),
+        gas_list("medicine_lot", _FEFO_LIMIT),
+        gas_list("other_lot", _FEFO_LIMIT),
+    )
+    if not all(isinstance(s, dict) and s.get("ok") for s in srcs):
+        return {}, {}
+
+    with _FEFO_LOCK:
+        old = _FEFO_IDX["src"]
+        if old is not None and all(a is b for a, b in zip(old, srcs)):
+            return _FEFO_IDX["idx"], _FEFO_IDX["mid_by_name"]
+
+        med_name = {
+            str(m.get("id", "")).strip(): m.get("name", "")
+            for m in _unwrap_rows(srcs[0])
+            if str(m.get("type", "")).strip().lower() == "medicine"
+        }
+        # ชื่อ -> medicine_id แบบเดียวกับ _build_medicine_lots (ตัวแรกที่ชื่อตรง)
+        mid_by_name = {}
+        for m in _unwrap_rows(srcs[0]):
+            mid = str(m.get("id", "")).strip()
+            if mid:
+                mid_by_name.setdefault(norm_key(m.get("name", "")), mid)
+
+        idx = defaultdict(dict)
+        for r in _unwrap_rows(srcs[1]):
+            rid = str(r.get("id", "")).strip()
+            if not rid:
+                continue
+            mid = str(r.get("medicine_id", "")).strip()
+            keys = {_fefo_item_key("medicine_lot", "", mid)}
+            # ยาร่วม: เหมือน _get_shared_medicine_lots_by_name ตรงที่ item_name หรือชื่อของ medicine_id
+            for n in (r.get("item_name"), med_name.get(mid)):
+                if n and is_shared_medicine_name(n):
+                    keys.add(_fefo_item_key("medicine_lot", n))
+            for k in keys:
+                if k:
+                    idx[("medicine_lot", k)][rid] = r
+        for r in _unwrap_rows(srcs[2]):
+            rid = str(r.get("id", "")).strip()
+            k = _fefo_item_key("other_lot", r.get("item_name"))
+            if rid and k:
+                idx[("other_lot", k)][rid] = r
+
+        out = {}
+        for key, rows in idx.items():
+            out[key] = sorted(
+                rows.values(),
+                key=lambda r: (_expire_sort_key(r.get("expire_date")), _to_int(r.get("id"), 0)),
+            )
+        _FEFO_IDX.update(src=srcs, idx=out, mid_by_name=mid_by_name)
+        return out, mid_by_name
+
+
+def allocate_fefo(name, qty, item_type="", reserved=None, medicine_id=""):
+    """
+    เลือก lot ให้ (name, qty) แบบ FEFO แตกหลาย lot ได้ ข้าม lot ที่หมดอายุแล้ว
+    reserved = {(lot_table, lot_id): qty} ที่จองไว้แล้วในคำขอเดียวกัน
+    medicine_id = ระบุรายการยาตรง ๆ (ไม่ระบุ = หาจากชื่อ)
+    คืน {"ok": True, "lot_table", "allocations": [{lot_id, lot_name, qty, ...}]}
+       หรือ {"ok": False, "error": "short", "available", "message"}
+    """
+    qty = _to_int(qty, 0)
+    table = lot_table_for_type(item_type)
+    if qty <= 0:
+        return {"ok": False, "error": "qty", "message": "จำนวนต้องมากกว่า 0"}
+
+    reserved = reserved or {}
+    today = th_now().strftime("%Y-%m-%d")
+    left = qty
+    plan = []
+    idx, mid_by_name = _fefo_index()
+    if table == "medicine_lot" and not medicine_id:
+        medicine_id = mid_by_name.get(norm_key(name), "")
+    for r in idx.get((table, _fefo_item_key(table, name, medicine_id)), ()):
+        exp = _expire_sort_key(r.get("expire_date"))
+        if exp[0] == 0 and exp[1] < today:
+            continue
+        lid = str(r.get("id", "")).strip()
+        avail = lot_remain(table, r) - reserved.get((table, lid), 0)
+        if avail <= 0:
+            continue
+        take = min(avail, left)
+        plan.append({
+            "lot_id": lid,
+            "lot_name": r.get("lot_name"),
+            "expire_date": r.get("expire_date", ""),
+            "qty": take,
+            "price_per_unit": r.get("price_per_unit"),
+        })
+        left -= take
+        if not left:
+            break
+
+    if left:
+        return {"ok": False, "error": "short", "available": qty - left,
+                "message": f"จำนวนคงเหลือไม่พอ ({name}) ต้องการ {qty} คงเหลือ {qty - left}"}
+    return {"ok": True, "lot_table": table, "allocations": plan}
+
+
+def expand_auto_lots(items, need):
+    """
+    รายการยาที่ไม่ได้ระบุ lot (lot_id ว่าง/"auto") -> แตกเป็นรายการต่อ lot ตาม FEFO
+    need = {(lot_table, lot_id): qty} ของรายการที่ระบุ lot แล้ว (ถูกเพิ่มยอดที่จัดสรรให้ด้วย)
+    คืน (items ใหม่, None) หรือ (None, ข้อความ error)
+    """
+    out = []
+    for it in items:
+        lot_id = str(it.get("lot_id") or "").strip()
+        if lot_id and lot_id.lower() != "auto":
+            out.append(it)
+            continue
+        name = it.get("name") or it.get("item_name") or ""
+        item_type = str(it.get("type") or it.get("item_type") or "").strip().lower()
+        alloc = allocate_fefo(name, it.get("qty"), item_type, reserved=need, medicine_id=it.get("medicine_id") or "")
+        if not alloc.get("ok"):
+            return None, alloc["message"]
+        for a in alloc["allocations"]:
+            out.append(dict(it, lot_id=a["lot_id"], lot=a["lot_name"], qty=a["qty"],
+                            price_per_unit=_to_float(a["price_per_unit"], 0.0)))
+            key = (alloc["lot_table"], a["lot_id"])
+            need[key] = need.get(key, 0) + a["qty"]
+    return out, None
+
+
+# ===== lock ข้ามโปรเซส (ไฟล์ + flock) สำหรับงานที่ต้องมีโปรเซสเดียวทำ (compaction / scheduler) =====
+try:
+    import fcntl
+except Exception:
+    fcntl = None
+
+LOCK_DIR = os.environ.get("LOCK_DIR") or os.path.join(tempfile.gettempdir(), "cpf_locks")
+
+
+class proc_lock:
+    """
+    with proc_lock(name) as got: ...  flock แบบไม่รอ got=False = โปรเซสอื่นถืออยู่
+    ไม่มี fcntl (Windows/dev) -> ได้เสมอ (โปรเซสเดียวอยู่แล้ว)
+    """
+
+    def __init__(self, name):
+        self.path = os.path.join(LOCK_DIR, f"{name}.lock")
+        self.f = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def acquire(self):
+        """ลองถือ lock (ไม่รอ) ถือไว้จนกว่าจะ __exit__ หรือโปรเซสจบ"""
+        if fcntl is None:
+            return True
+        try:
+            os.makedirs(LOCK_DIR, exist_ok=True)
+            fresh = not os.path.exists(self.path)
+            self.f = open(self.path, "a+")
+            if fresh:
+                os.utime(self.path, (0, 0))   # ยังไม่เคย touch -> age() ไม่นับเวลาที่สร้างไฟล์
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+            return False
+
+    def __exit__(self, *exc):
+        if self.f is not None:
+            self.f.close()   # ปิดไฟล์ = ปล่อย flock
+            self.f = None
+        return False
+
+    def age(self):
+        """วินาทีตั้งแต่ touch() ล่าสุด (ทุกโปรเซสเห็นค่าเดียวกัน)"""
+        try:
+            return time.time() - os.path.getmtime(self.path)
+        except OSError:
+            return float("inf")
+
+    def touch(self):
+        try:
+            os.utime(self.path)
+        except OSError:
+            pass
+
+
+def gas_compact_ledger(min_interval=0):
+    """
+    รวม ledger เข้า qty_remain (ทำฝั่ง GAS ใต้ lock) แล้วล้าง cache ที่เกี่ยวข้อง
+    ทั้งระบบ compaction ได้ทีละโปรเซส (flock) / min_interval = ข้ามถ้าโปรเซสใดทำไปแล้วเมื่อไม่นานนี้
+    """
+    lock = proc_lock("stock_compact")
+    with lock as got:
+        if not got:
+            return {"ok": True, "skipped": "busy", "message": "compaction กำลังทำงานอยู่ในโปรเซสอื่น"}
+        if min_interval and lock.age() < min_interval:
+            return {"ok": True, "skipped": "recent"}
+        res = _gas_compact_ledger()
+        if res.get("ok"):
+            lock.touch()
+        return res
+
+
+def _gas_compact_ledger():
+    try:
+        r = _gas_request("POST", json={
+            "action": "compact_ledger",
+            "table": STOCK_LEDGER,
+        }, timeout=120)
+        r.raise_for_status()
+        res = r.json()
+
+        if isinstance(res, dict) and res.get("ok") and res.get("rows"):
+            for t in (STOCK_LEDGER,) + _LOT_TABLES:
+                gas_cache_invalidate(t)
+
+        return res
+    except Exception as e:
+        print(f"gas_compact_ledger error: {e}")
+        return {"ok": False, "message": str(e)}
+
+
+# ============================================
+# USER DIRECTORY
+# ============================================
+# index username (lower) -> user สร้างจากตาราง users ที่ cache ไว้ (สร้างใหม่เมื่อ cache เปลี่ยน)
+# GAS ช้า/ล่ม -> ใช้ index ชุดล่าสุดต่อ (login ได้ตามข้อมูลเดิม)
+# session เก็บ role + uv (stamp ของ user ตอน login) -> ตรวจสิทธิ์จาก session + index ในหน่วยความจำ
+# index refresh ตาม TTL ของ cache users (ไม่เกิน 1 ครั้ง/_USER_TTL ต่อ worker ไม่ใช่ทุก request)
+# role/รหัสผ่านเปลี่ยน หรือ user ถูกลบ (จาก worker ไหนก็ได้) -> ภายใน _USER_TTL stamp ไม่ตรง -> session ถูกยกเลิก
+_USER_LIMIT = 1000
+_USER_TTL = 60
+_USER_RETRY = 20   # GAS ล่ม -> ใช้ index เดิม ไม่ยิงซ้ำทุก request
+_USER_DIR = {"src": None, "idx": {}, "by_id": {}, "miss_at": 0.0}
+_USER_LOCK = Lock()
+
+
+def _user_stamp(user):
+    raw = "|".join(str(user.get(k, "")).strip() for k in ("id", "username", "role", "password"))
+    return hmac.new(str(app.secret_key).encode(), raw.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+
+def user_directory():
+    """{username.lower(): user} จาก cache ของตาราง users"""
+    if time.time() - _USER_DIR["miss_at"] < _USER_RETRY:
+        return _USER_DIR["idx"]
+    res = gas_list_cached("users", _USER_LIMIT, ttl=_USER_TTL)
+    if not (isinstance(res, dict) and res.get("ok")):
+        _USER_DIR["miss_at"] = time.time()
+        return _USER_DIR["idx"]
+    with _USER_LOCK:
+        if _USER_DIR["src"] is not res:
+            idx, by_id = {}, {}
+            for u in _unwrap_rows(res):
+                name = str(u.get("username", "")).strip().lower()
+                if name and name not in idx:   # ชื่อซ้ำ -> แถวแรกชนะ (เหมือน scan เดิม)
+                    idx[name] = u
+                uid = str(u.get("id", "")).strip()
+                if uid:
+                    by_id[uid] = u
+            _USER_DIR.update(src=res, idx=idx, by_id=by_id)
+        return _USER_DIR["idx"]
+
+
+def find_user(username):
+    return user_directory().get(str(username or "").strip().lower())
+
+
+def find_user_by_id(user_id):
+    user_directory()
+    return _USER_DIR["by_id"].get(str(user_id).strip())
+
+
+@app.template_filter("user_stamp")
+def user_stamp_filter(user):
+    """ใช้ในหน้ารายชื่อ: แนบ stamp ของ user ไปกับลิงก์ลบ"""
+    return _user_stamp(user)
+
+
+def login_session(user):
+    session["username"] = user["username"]
+    session["role"] = user.get("role", "user")
+    session["user_name"] = user.get("name", "")
+    session["uv"] = _user_stamp(user)
+
+
+def session_valid():
+    """
+    session ยังตรงกับ user ปัจจุบันไหม (index ในหน่วยความจำ refresh ตาม TTL ของ cache users)
+    ยังสร้าง index ไม่ได้ (GAS ล่มตั้งแต่ start) -> เชื่อ session ที่ sign แล้ว
+    """
+    idx = user_directory()
+    if _USER_DIR["src"] is None:
+        return True
+    user = idx.get(str(session.get("username", "")).strip().lower())
+    if user is None:
+        return False
+    if "uv" not in session:
+        # session ก่อนมี stamp -> เทียบ role อย่างเดียว
+        return str(user.get("role", "user")) == str(session.get("role", ""))
+    return hmac.compare_digest(_user_stamp(user), str(session["uv"]))
+
+
+# ============================================
+# AUTH DECORATORS
+# ============================================
+
+def login_required(f):
+    @wraps(f)
+    def wrap(*args, **kwargs):
+        if "username" not in session:
+            return redirect("/")
+        if not session_valid():
+            session.clear()
+            return redirect("/")
+        return f(*args, **kwargs)
+    return wrap
+
+
+def admin_required(f):
+    @wraps(f)
+    def wrap(*args, **kwargs):
+        if session.get("role") != "admin":
+            return redirect("/menu")
+        if not session_valid():
+            session.clear()
+            return redirect("/")
+        return f(*args, **kwargs)
+    return wrap
+
+
+def catalog_required(f):
+    """
+    อนุญาตเฉพาะผู้ที่ล็อกอินและมี role = admin หรือ user
+    (ตาม requirement ใหม่: user ทั่วไปก็เพิ่ม/ลบได้)
+    """
+    @wraps(f)
+    def wrap(*args, **kwargs):
+        if "username" not in session:
+            return redirect("/")
+        role = str(session.get("role", "")).strip().lower()
+        if role not in ("admin", "user"):
+            return redirect("/menu")
+        if not session_valid():
+            session.clear()
+            return redirect("/")
+        return f(*args, **kwargs)
+    return wrap
+
+
+# ============================================
+# TEST ROUTES
+# ============================================
+
+@app.get("/test-gas")
+def test_gas():
+    """ทดสอบการเชื่อมต่อ GAS"""
+    res = gas_list("users", 5)
+    return jsonify(res)
+
+
+@app.get("/fix-admin")
+def fix_admin():
+    """สร้าง Admin สำรองกรณีเข้าไม่ได้"""
+    if find_user("admin"):
+        return "<h1>Admin user already exists!</h1> <p>User: admin / Pass: 111</p> <a href='/'>Go to Login</a>"
+
+    payload = {
+        "username": "admin",
+        "password": "111",
+        "name": "Admin Recovery",
+        "dept": "IT",
+        "role": "admin"
+    }
+    res = gas_append("users", payload)
+    return f"<h1>Created Admin!</h1> <pre>{res}</pre> <a href='/'>Go to Login</a>"
+
+
+# ============================================
+# LOGIN / LOGOUT
+# ============================================
+
+@app.route("/logout")
+def logout():
+    session.clear()
+    return redirect("/")
+
+
+@app.route("/", methods=["GET", "POST"])
+def login():
+    if request.method == "POST":
+        username = request.form.get("username", "").strip()
+        password = request.form.get("password", "").strip()
+
+        found_user = find_user(username)
+
+        if found_user:
+            if str(found_user.get("password", "")).strip() == password:
+                session.clear()
+                login_session(found_user)
+                return redirect("/menu")
+
+        return render_template("login.html", error="ชื่อผู้ใช้หรือรหัสผ่านไม่ถูกต้อง")
+
+    return render_template("login.html")
+
+
+# ============================================
+# MENU
+# ============================================
+
+@app.route("/menu")
+@login_required
+def menu():
+    return render_template("menu.html", role=session.get("role"))
+
+
+# ============================================
+# USER MANAGEMENT (ADMIN)
+# ============================================
+
+@app.route("/users", methods=["GET", "POST"])
+@admin_required
+def users():
+    if request.method == "POST":
+        payload = {
+            "username": request.form.get("username", "").strip(),
+            "password": request.form.get("password", "").strip(),
+            "name": request.form.get("name", "").strip(),
+            "dept": request.form.get("dept", "").strip(),
+            "role": request.form.get("role", "user").strip()
+        }
+        gas_append("users", payload)
+
+    user_directory()
+    users_list = _unwrap_rows(_USER_DIR["src"]) if _USER_DIR["src"] else []
+    return render_template("users.html", users=users_list)
+
+
+@app.route("/users/delete/<int:id>")
 @admin_required
 def delete_user(id):
-    res = gas_get("users", id)
-    if res.get("ok") and res.get("data"):
-        if res["data"].get("role") != "admin":
-            gas_delete("users", id)
+    # กันลบ admin: ใช้ index (TTL) / ไม่อยู่ใน index หรือ uv จากหน้ารายชื่อไม่ตรง (ข้อมูลเปลี่ยนหลังเปิดหน้า)
+    # -> อ่านค่าจริงในชีต
+    user = find_user_by_id(id)
+    if user is None or not hmac.compare_digest(_user_stamp(user), request.args.get("uv", "")):
+        res = gas_get("users", id)
+        user = res.get("data") if res.get("ok") else None
+    if user and user.get("role") != "admin":
+        gas_delete("users", id)
     return redirect("/users")
 
 
+@app.route("/admin/verify_cache")
+@admin_required
+def verify_cache():
+    """
+    ตรวจ cache ในหน่วยความจำ (รวม ledger ที่ต่อท้ายเอง) เทียบกับชีตจริงด้วย hash ต่อแถว/block
+    ?table=... เฉพาะตาราง / ?drop=1 ล้าง cache ของตารางที่ไม่ตรง
+    """
+    want = request.args.get("table", "").strip()
+    drop = str(request.args.get("drop", "")).lower() in ("1", "true", "yes")
+    out = []
+    for key, (ts, res) in list(_GAS_CACHE.items()):
+        # ชุด desc / projection เป็นส่วนย่อยของตาราง ข้าม
+        if len(key) != 2 or (want and key[0] != want):
+            continue
+        table, limit = key
+        fresh = gas_list_raw(table, limit)
+        if not fresh.get("ok"):
+            out.append({"table": table, "limit": limit, "ok": False, "message": fresh.get("message", "")})
+            continue
+        cached = {str(r.get("id", "")).strip(): r for r in _unwrap_rows(res)}
+        live = {str(r.get("id", "")).strip(): r for r in _unwrap_rows(fresh)}
+        cols = sorted({c for r in cached.values() for c in r} | {c for r in live.values() for c in r})
+        d = digest_compare(TableDigest(cached, cols), TableDigest(live, cols), cols)
+        out.append({
+            "table": table, "limit": limit, "ok": True, "age": round(time.time() - ts, 1),
+            "match": d["match"], "root": d["root_right"],
+            "stale_in_cache": d["missing_right"], "missing_in_cache": d["missing_left"],
+            "mismatched": d["mismatched"],
+        })
+        if drop and not d["match"]:
+            gas_cache_invalidate(table)
+    return jsonify({"ok": True, "tables": out})
+
+
+# ============================================
+# PROFILER (admin เปิดเองทีละ request)
+# ============================================
+# ?_profile=1 หรือ header X-Profile: 1 -> รัน request ใต้ cProfile แล้วเขียน .prof (pstats) ลง PROFILE_DIR
+# ?_profile=sampling -> pyinstrument (ถ้าติดตั้ง) เขียน .speedscope.json (เปิดที่ speedscope.app)
+# ปิดอยู่ = เช็ค query/header ต่อ request เท่านั้น ไม่แตะ session ไม่มี hook profiler
+# cProfile วัดเฉพาะ thread ที่ตอบ request (งานใน ThreadPoolExecutor ไม่ถูกนับ)
+# ไม่บังคับ: sampling profiler (?_profile=sampling) ไม่ติดตั้งก็ใช้ cProfile
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except Exception:
+    SamplingProfiler = None
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "cpf_profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+_PROFILE_NAME = re.compile(r"^[0-9]{8}-[0-9]{6}-[0-9]{3}_[A-Z]+_[A-Za-z0-9_]+_[0-9]+ms\.(prof|speedscope\.json)$")
+
+
+def _profile_mode():
+    v = request.args.get("_profile") or request.headers.get("X-Profile")
+    if not v or session.get("role") != "admin":
+        return None
+    if str(v).lower() == "sampling" and SamplingProfiler is not None:
+        return "sampling"
+    return "cprofile"
+
+
+@app.before_request
+def _profile_start():
+    if "_profile" not in request.args and "X-Profile" not in request.headers:
+        return
+    mode = _profile_mode()
+    if mode is None:
+        return
+    try:
+        if mode == "sampling":
+            prof = SamplingProfiler()
+            prof.start()
+        else:
+            prof = cProfile.Profile()
+            prof.enable()
+    except (ValueError, RuntimeError) as e:
+        # profiler อื่นทำงานอยู่ (Python 3.12+ เปิดได้ทีละตัวทั้งโปรเซส)
+        g.profile_error = str(e)
+        return
+    g.profiler = (mode, prof, time.perf_counter())
+
+
+def _profile_stop():
+    state = g.pop("profiler", None)
+    if state is None:
+        return None
+    mode, prof, t0 = state
+    if mode == "sampling":
+        prof.stop()
+    else:
+        prof.disable()
+    return mode, prof, time.perf_counter() - t0
+
+
+def _profile_prune():
+    try:
+        files = sorted((e for e in os.scandir(PROFILE_DIR) if _PROFILE_NAME.match(e.name)),
+                       key=lambda e: e.stat().st_mtime, reverse=True)
+    except FileNotFoundError:
+        return
+    for e in files[PROFILE_KEEP:]:
+        try:
+            os.remove(e.path)
+        except OSError:
+            pass
+
+
+@app.after_request
+def _profile_finish(resp):
+    if g.get("profile_error"):
+        resp.headers["X-Profile-Error"] = g.profile_error
+    stopped = _profile_stop()
+    if stopped is None:
+        return resp
+    mode, prof, elapsed = stopped
+
+    route = request.url_rule.rule if request.url_rule else request.path
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_")[:60] or "root"
+    now = th_now()
+    name = f"{now:%Y%m%d-%H%M%S}-{now.microsecond // 1000:03d}_{request.method}_{slug}_{int(elapsed * 1000)}ms"
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if mode == "sampling":
+            name += ".speedscope.json"
+            data = SpeedscopeRenderer().render(prof.last_session).encode("utf-8")
+            _atomic_write(os.path.join(PROFILE_DIR, name), data)
+        else:
+            name += ".prof"
+            prof.dump_stats(os.path.join(PROFILE_DIR, name))
+        _profile_prune()
+        resp.headers["X-Profile-File"] = name
+    except Exception as e:
+        print(f"profile dump error: {e}")
+        resp.headers["X-Profile-Error"] = str(e)
+    return resp
+
+
+@app.teardown_request
+def _profile_teardown(exc):
+    # request ล้มกลางทาง (after_request ไม่ถูกเรียก) -> ปิด profiler ไม่ให้ค้าง
+    if exc is not None:
+        _profile_stop()
+
+
+@app.route("/admin/profiles")
+@admin_required
+def profile_list():
+    items = []
+    try:
+        entries = [e for e in os.scandir(PROFILE_DIR) if _PROFILE_NAME.match(e.name)]
+    except FileNotFoundError:
+        entries = []
+    for e in sorted(entries, key=lambda e: e.stat().st_mtime, reverse=True):
+        stamp, method, rest = e.name.split("_", 2)
+        route, ms = rest.rsplit("_", 1)
+        items.append({
+            "name": e.name,
+            "at": datetime.strptime(stamp[:15], "%Y%m%d-%H%M%S").strftime("%Y-%m-%d %H:%M:%S"),
+            "method": method,
+            "route": route,   # slug ของ route (/ และอักขระพิเศษเป็น _)
+            "ms": int(ms.split("ms", 1)[0]),
+            "kind": "pstats" if e.name.endswith(".prof") else "speedscope",
+            "size_kb": round(e.stat().st_size / 1024, 1),
+        })
+    return render_template("profiles.html", profiles=items, profile_dir=PROFILE_DIR,
+                           sampling=SamplingProfiler is not None)
+
+
+@app.route("/admin/profiles/<name>")
+@admin_required
+def profile_get(name):
+    """ดาวน์โหลดไฟล์ / ?top=1 สรุป pstats 40 ฟังก์ชันแรก (cumulative) เป็นข้อความ"""
+    if not _PROFILE_NAME.match(name):
+        return "ไม่พบไฟล์", 404
+    path = os.path.join(PROFILE_DIR, name)
+    if not os.path.exists(path):
+        return "ไม่พบไฟล์", 404
+    if request.args.get("top") and name.endswith(".prof"):
+        out = io.StringIO()
+        sort = request.args.get("sort", "cumulative")
+        if sort not in ("cumulative", "tottime", "ncalls"):
+            sort = "cumulative"
+        pstats.Stats(path, stream=out).strip_dirs().sort_stats(sort).print_stats(40)
+        return Response(out.getvalue(), mimetype="text/plain; charset=utf-8")
+    return send_file(path, as_attachment=True, download_name=name)
+
+
 # ============================================
 # MEDICINE TYPE / GROUP
 # ============================================
@@ -940,11 +2389,7 @@ def other_delete_item(item_id):
 
     item_name = str(item_res["data"].get("name", "")).strip()
 
-    lots_res = gas_list("other_lot", 5000)
-    if lots_res.get("ok"):
-        for l in lots_res.get("data", []):
-            if str(l.get("item_name", "")).strip().lower() == item_name.lower():
-                gas_delete("other_lot", l.get("id"))
+    _cascade_delete("other_lot", {"item_name": item_name}, ci=True)
 
     gas_delete("other_item", item_id)
     return redirect("/medicine/list/" + quote("อื่นๆ"))
@@ -961,11 +2406,7 @@ def medicine_delete(med_id):
         group_name = str(med_res["data"].get("group_name", "")).strip()
         mtype = str(med_res["data"].get("type", "")).strip().lower()
 
-    lots_res = gas_list("medicine_lot", 5000)
-    if lots_res.get("ok"):
-        for l in lots_res.get("data", []):
-            if str(l.get("medicine_id", "")) == str(med_id):
-                gas_delete("medicine_lot", l.get("id"))
+    _cascade_delete("medicine_lot", {"medicine_id": med_id})
 
     gas_delete("medicine", med_id)
 
@@ -999,6 +2440,7 @@ def other_item_detail(item_name):
 
     lots = _get_lots_by_field_fast("other_lot", "item_name", item_name, limit=10000)
     lots = [l for l in lots if norm_text(l.get("item_name", "")).lower() == item_name.lower()]
+    lots = lots_with_remain("other_lot", lots)
     lots.sort(key=lambda x: str(x.get("expire_date", "")))
 
     back_url = url_for("medicine_list", group="อื่นๆ")
@@ -1037,16 +2479,18 @@ def other_add_lot(item_name):
 
     if existing:
         new_qty_total = _to_int(existing.get("qty_total"), 0) + qty
-        new_qty_remain = _to_int(existing.get("qty_remain"), 0) + qty
+        new_qty_remain = lot_remain("other_lot", existing) + qty
         new_price_per_lot = _to_float(existing.get("price_per_lot"), 0.0) + price
         new_price_per_unit = (new_price_per_lot / new_qty_total) if new_qty_total > 0 else 0
 
+        # qty_remain เพิ่มผ่าน ledger (receipt) ไม่เขียนทับตรง ๆ
         upd = gas_update("other_lot", existing["id"], {
             "qty_total": new_qty_total,
-            "qty_remain": new_qty_remain,
             "price_per_lot": new_price_per_lot,
             "price_per_unit": round(new_price_per_unit, 4)
         })
+        if upd.get("ok"):
+            upd = stock_apply({("other_lot", str(existing["id"])): qty}, "receipt")
         if not upd.get("ok"):
             if _wants_json_response():
                 return jsonify({"success": False, "message": upd.get("message", "update failed")}), 500
@@ -1136,6 +2580,7 @@ def medicine_detail(med_id):
                 if str(l.get("medicine_id", "")) == str(med_id):
                     lots.append(l)
 
+    lots = lots_with_remain("medicine_lot", lots)
     lots.sort(key=lambda x: (str(x.get("expire_date", "")).strip() == "", str(x.get("expire_date", ""))))
 
     mtype = str(med.get("type", "")).strip().lower()
@@ -1192,13 +2637,13 @@ def add_lot(med_id):
 
     if existing:
         new_qty_total = _to_int(existing.get("qty_total"), 0) + qty
-        new_qty_remain = _to_int(existing.get("qty_remain"), 0) + qty
+        new_qty_remain = lot_remain("medicine_lot", existing) + qty
         new_price_per_lot = _to_float(existing.get("price_per_lot"), 0.0) + price
         new_price_per_unit = (new_price_per_lot / new_qty_total) if new_qty_total > 0 else 0
 
+        # qty_remain เพิ่มผ่าน ledger (receipt) ไม่เขียนทับตรง ๆ
         upd_payload = {
             "qty_total": new_qty_total,
-            "qty_remain": new_qty_remain,
             "price_per_lot": new_price_per_lot,
             "price_per_unit": round(new_price_per_unit, 4),
             "item_name": item_name
@@ -1207,6 +2652,8 @@ def add_lot(med_id):
             upd_payload["medicine_id"] = target_med_id
 
         upd = gas_update("medicine_lot", existing["id"], upd_payload)
+        if upd.get("ok"):
+            upd = stock_apply({("medicine_lot", str(existing["id"])): qty}, "receipt")
         if not upd.get("ok"):
             if _wants_json_response():
                 return jsonify({"success": False, "message": upd.get("message", "update failed")}), 500
@@ -1242,23 +2689,316 @@ def add_lot(med_id):
                 return jsonify({"success": False, "message": ap.get("message", "append failed")}), 500
             return "บันทึกไม่สำเร็จ", 500
 
-        lot_id = ap.get("id")
-        lot_obj = {
-            "id": lot_id,
-            "lot_name": lot_name,
-            "expire_date": expire_date or "",
-            "qty_total": qty,
-            "qty_remain": qty,
-            "price_per_lot": round(price, 2),
-            "price_per_unit": round(price_per_unit, 4),
-        }
+        lot_id = ap.get("id")
+        lot_obj = {
+            "id": lot_id,
+            "lot_name": lot_name,
+            "expire_date": expire_date or "",
+            "qty_total": qty,
+            "qty_remain": qty,
+            "price_per_lot": round(price, 2),
+            "price_per_unit": round(price_per_unit, 4),
+        }
+
+    if _wants_json_response():
+        return jsonify({"success": True, "lot": lot_obj})
+
+    return redirect(f"/medicine/{med_id}")
+
+
+
+
+# ===== รับเข้าหลาย lot จาก CSV (bulk receiving) =====
+# CSV คอลัมน์: item_name, expire_date, qty, price (+ medicine_id ถ้าชื่อซ้ำหลายกลุ่ม)
+# resolve ชื่อผ่าน canonical name (ยาร่วมไปรวมที่ medicine_id ตัวหลัก) แล้วรวม lot วันหมดอายุเดียวกันแบบ add_lot
+# เขียน: append lot ใหม่ 1 request + อัปเดต lot เดิม 1 request ต่อตาราง + รับเข้า ledger 1 batch
+_RECEIVE_COLS = {
+    "item_name": ("item_name", "name", "ชื่อ", "ชื่อยา", "รายการ"),
+    "expire_date": ("expire_date", "expire", "exp", "วันหมดอายุ"),
+    "qty": ("qty", "quantity", "จำนวน"),
+    "price": ("price", "price_per_lot", "ราคา"),
+    "medicine_id": ("medicine_id", "med_id"),
+}
+_RECEIVE_MAX_ROWS = 2000
+
+
+def _receive_expire(value):
+    """วันหมดอายุเป็น YYYY-MM-DD (รับ D/M/YYYY และปี พ.ศ.) / ว่างได้ / รูปแบบผิด -> None"""
+    s = str(value or "").strip()
+    if not s:
+        return ""
+    m = re.fullmatch(r"(\d{4})-(\d{1,2})-(\d{1,2})", s) or re.fullmatch(r"(\d{1,2})/(\d{1,2})/(\d{4})", s)
+    if not m:
+        return None
+    a, b, c = (int(x) for x in m.groups())
+    y, mo, d = (a, b, c) if "-" in s else (c, b, a)
+    if y > 2400:
+        y -= 543
+    try:
+        return datetime(y, mo, d).strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+def _receive_name_index():
+    """
+    canonical name key -> [(lot_table, medicine_id, ชื่อที่ใช้บันทึก), ...]
+    ยา/เวชภัณฑ์ -> medicine_lot, รายการอื่นๆ -> other_lot (ชื่อซ้ำกับยา ใช้ฝั่งยา)
+    """
+    idx = defaultdict(list)
+    for m in _unwrap_rows(gas_list("medicine", 5000)):
+        name = norm_text(m.get("name", ""))
+        mid = str(m.get("id", "")).strip()
+        if name and mid:
+            idx[_norm_med_key(canonical_medicine_name(name))].append(("medicine_lot", mid, name))
+    for it in _unwrap_rows(gas_list("other_item", 5000)):
+        name = norm_text(it.get("name", ""))
+        k = _norm_med_key(name)
+        if name and k not in idx:
+            idx[k].append(("other_lot", "", name))
+    return idx
+
+
+def _receive_resolve(idx, name, med_id=""):
+    """ชื่อใน CSV -> (lot_table, medicine_id, item_name) หรือ (None, None, ข้อความ error)"""
+    canon = canonical_medicine_name(name)
+    hits = idx.get(_norm_med_key(canon)) or []
+    if not hits:
+        return None, None, f"ไม่พบรายการ '{name}'"
+    if hits[0][0] == "other_lot":
+        return hits[0]
+    if is_shared_medicine_name(canon):
+        # ยาร่วม -> lot ศูนย์กลางที่ medicine_id ตัวหลัก (เหมือน add_lot)
+        return "medicine_lot", _pick_canonical_med_id(canon), canon
+    if med_id:
+        hits = [h for h in hits if h[1] == str(med_id).strip()]
+        if not hits:
+            return None, None, f"medicine_id {med_id} ไม่ตรงกับ '{name}'"
+    if len(hits) > 1:
+        return None, None, f"'{name}' มีหลายรายการ ({', '.join(h[1] for h in hits)}) ระบุ medicine_id"
+    return hits[0]
+
+
+def _receive_lot_groups(lot_table, rows):
+    """lot เดิมจัดกลุ่มตามสินค้า: medicine_id (ยา) / ชื่อ (อื่นๆ) -> [lot, ...]"""
+    groups = defaultdict(list)
+    for r in rows:
+        if lot_table == "medicine_lot":
+            groups[str(r.get("medicine_id", "")).strip()].append(r)
+        else:
+            groups[_norm_med_key(r.get("item_name", ""))].append(r)
+    return groups
+
+
+def _receive_existing_lots(lot_table, groups, med_id, item_name):
+    if lot_table == "other_lot":
+        return groups.get(_norm_med_key(item_name), [])
+    if is_shared_medicine_name(item_name):
+        return _get_shared_medicine_lots_by_name(item_name)
+    return groups.get(str(med_id), [])
+
+
+def _parse_receive_csv(text):
+    """CSV -> (rows, errors) rows = [{"line", "item_name", "expire_date", "qty", "price", "medicine_id"}]"""
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, None) or []
+    keys = [norm_key(h) for h in header]
+    col = {}
+    for field, names in _RECEIVE_COLS.items():
+        for n in names:
+            if norm_key(n) in keys:
+                col[field] = keys.index(norm_key(n))
+                break
+    missing = [f for f in ("item_name", "qty", "price") if f not in col]
+    if missing:
+        return [], [{"line": 1, "message": "ไม่พบคอลัมน์ " + ", ".join(missing)}]
+
+    rows, errors = [], []
+    for line, rec in enumerate(reader, start=2):
+        if not any(str(v).strip() for v in rec):
+            continue
+        get = lambda f: rec[col[f]] if f in col and col[f] < len(rec) else ""
+        name = norm_text(get("item_name"))
+        qty = _to_int(get("qty"), 0)
+        price = _to_float(get("price"), 0.0)
+        exp = _receive_expire(get("expire_date"))
+        if not name:
+            errors.append({"line": line, "message": "ไม่มีชื่อรายการ"})
+        elif qty <= 0 or price <= 0:
+            errors.append({"line": line, "item_name": name, "message": "จำนวนหรือราคาไม่ถูกต้อง"})
+        elif exp is None:
+            errors.append({"line": line, "item_name": name, "message": "วันหมดอายุไม่ถูกต้อง (YYYY-MM-DD)"})
+        else:
+            rows.append({"line": line, "item_name": name, "expire_date": exp, "qty": qty,
+                         "price": price, "medicine_id": str(get("medicine_id")).strip()})
+        if len(rows) + len(errors) > _RECEIVE_MAX_ROWS:
+            errors.append({"line": line, "message": f"เกิน {_RECEIVE_MAX_ROWS} แถวต่อไฟล์"})
+            break
+    return rows, errors
+
+
+def receive_lots_plan(rows):
+    """
+    วางแผนรับเข้า (ยังไม่เขียน): ต่อ lot_table ->
+      {"append": [payload lot ใหม่], "update": {lot_id: {field: value}}, "receipt": {lot_id: qty}}
+    + รายการผลต่อแถว / errors
+    แถวใน CSV ที่สินค้า+วันหมดอายุเดียวกันรวมเป็น lot เดียว
+    """
+    idx = _receive_name_index()
+    groups = {t: _receive_lot_groups(t, lots_with_remain(t, _unwrap_rows(gas_list(t, 10000))))
+              for t in _LOT_TABLES}
+    plan = {t: {"append": [], "update": {}, "receipt": defaultdict(int)} for t in _LOT_TABLES}
+    lots = {}        # (lot_table, item, expire) -> lot state
+    lot_counts = {}  # (lot_table, item) -> จำนวน lot (ตั้งชื่อ LOT n)
+    results, errors = [], []
+    now_s = th_now().strftime("%Y-%m-%d %H:%M:%S")
+
+    for r in rows:
+        lot_table, med_id, item_name = _receive_resolve(idx, r["item_name"], r["medicine_id"])
+        if lot_table is None:
+            errors.append({"line": r["line"], "item_name": r["item_name"], "message": item_name})
+            continue
+        item_key = (lot_table, med_id if lot_table == "medicine_lot" else _norm_med_key(item_name))
+        if item_key not in lot_counts:
+            existing = _receive_existing_lots(lot_table, groups[lot_table], med_id, item_name)
+            lot_counts[item_key] = len(existing)
+            for lot in existing:
+                exp = str(lot.get("expire_date", "")).strip()
+                # รวม lot เดิมเฉพาะที่มีวันหมดอายุ (เหมือน add_lot) lot แรกที่ตรงชนะ
+                if exp and item_key + (exp,) not in lots:
+                    lots[item_key + (exp,)] = {
+                        "id": str(lot.get("id", "")).strip(), "lot_name": lot.get("lot_name", ""),
+                        "qty_total": _to_int(lot.get("qty_total"), 0),
+                        "qty_remain": _to_int(lot.get("qty_remain"), 0),
+                        "price_per_lot": _to_float(lot.get("price_per_lot"), 0.0),
+                    }
+
+        p = plan[lot_table]
+        key = item_key + (r["expire_date"],)
+        cur = lots.get(key) if r["expire_date"] else None
+        if cur is None:
+            lot_counts[item_key] += 1
+            cur = {"id": None, "slot": len(p["append"]), "lot_name": f"LOT {lot_counts[item_key]}",
+                   "qty_total": 0, "qty_remain": 0, "price_per_lot": 0.0}
+            payload = {"item_name": item_name, "lot_name": cur["lot_name"], "expire_date": r["expire_date"],
+                       "created_at": now_s}
+            if lot_table == "medicine_lot":
+                payload["medicine_id"] = med_id
+            p["append"].append(payload)
+            if r["expire_date"]:
+                lots[key] = cur
+
+        cur["qty_total"] += r["qty"]
+        cur["qty_remain"] += r["qty"]
+        cur["price_per_lot"] += r["price"]
+        ppu = round(cur["price_per_lot"] / cur["qty_total"], 4) if cur["qty_total"] > 0 else 0
+        vals = {"qty_total": cur["qty_total"], "price_per_lot": round(cur["price_per_lot"], 2),
+                "price_per_unit": ppu}
+        if cur["id"] is None:
+            # lot ใหม่: qty_remain เริ่มต้นเขียนตรงไปกับแถว
+            p["append"][cur["slot"]].update(vals, qty_remain=cur["qty_total"])
+        else:
+            # lot เดิม: qty_remain เพิ่มผ่าน ledger (receipt) ไม่เขียนทับตรง ๆ
+            upd = p["update"].setdefault(cur["id"], {})
+            upd.update(vals, item_name=item_name)
+            if lot_table == "medicine_lot" and is_shared_medicine_name(item_name):
+                upd["medicine_id"] = med_id
+            p["receipt"][cur["id"]] += r["qty"]
+
+        results.append({"line": r["line"], "item_name": item_name, "lot_table": lot_table,
+                        "lot_id": cur["id"], "lot_name": cur["lot_name"], "expire_date": r["expire_date"],
+                        "qty": r["qty"], "merged": cur["id"] is not None, "_lot": cur})
+    return plan, results, errors
 
-    if _wants_json_response():
-        return jsonify({"success": True, "lot": lot_obj})
 
-    return redirect(f"/medicine/{med_id}")
+def receive_lots_apply(plan, ref=""):
+    """
+    เขียนตามแผน: ต่อ lot_table append 1 + batch update 1 แล้วรับเข้า ledger รวมครั้งเดียว
+    ขั้นหลังล้ม -> ลบ lot ที่เพิ่ง append / กลับรายการ receipt (compensating)
+    คืน {"ok": True, "ids": {lot_table: [id ใหม่, ...]}} หรือ {"ok": False, "message"}
+    """
+    new_ids = {}
+    for t, p in plan.items():
+        if not p["append"]:
+            continue
+        ap = gas_batch_append(t, p["append"])
+        ids = ap.get("ids") or []
+        if not ap.get("ok") or len(ids) != len(p["append"]):
+            _receive_undo(new_ids)
+            return {"ok": False, "message": f"append {t}: " + str(ap.get("message", "failed"))}
+        new_ids[t] = [str(x) for x in ids]
+
+    receipts = {(t, lot_id): qty for t, p in plan.items() for lot_id, qty in p["receipt"].items()}
+    applied = stock_apply(receipts, "receipt", ref=ref)
+    if not applied.get("ok"):
+        _receive_undo(new_ids)
+        return {"ok": False, "message": applied.get("message", "receipt failed")}
+
+    for t, p in plan.items():
+        if not p["update"]:
+            continue
+        updates = [{"id": lot_id, "field": f, "value": v}
+                   for lot_id, vals in p["update"].items() for f, v in vals.items()]
+        upd = gas_batch_update_fields(t, updates)
+        if not upd.get("ok"):
+            stock_revert(applied, ref=ref)
+            _receive_undo(new_ids)
+            return {"ok": False, "message": f"update {t}: " + str(upd.get("message", "failed"))}
+    return {"ok": True, "ids": new_ids}
+
+
+def _receive_undo(new_ids):
+    for t, ids in new_ids.items():
+        res = gas_delete_where(t, ids=ids)
+        if not res.get("ok"):
+            print(f"receive undo error ({t}): {res.get('message')} ids={ids}")
 
 
+@app.route("/lot/receive_csv", methods=["POST"])
+@catalog_required
+def lot_receive_csv():
+    """
+    รับเข้าหลาย lot จากไฟล์ CSV (field "file") หรือ body text/csv
+    ?dry_run=1 = ตรวจ + แสดงแผนโดยไม่บันทึก
+    แถวไหนผิด -> ไม่บันทึกทั้งไฟล์ (ส่ง errors ต่อแถวกลับไป)
+    """
+    f = request.files.get("file")
+    raw = f.read() if f else request.get_data()
+    try:
+        text = raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = raw.decode("cp874", errors="replace")   # Excel ภาษาไทย (Windows) บันทึก CSV เป็น TIS-620
+
+    rows, errors = _parse_receive_csv(text)
+    if not rows and not errors:
+        return jsonify({"success": False, "message": "ไม่มีข้อมูลในไฟล์"}), 400
+
+    plan, results, plan_errors = receive_lots_plan(rows) if rows else ({}, [], [])
+    errors += plan_errors
+    if errors:
+        errors.sort(key=lambda e: e["line"])
+        return jsonify({"success": False, "message": f"ข้อมูลไม่ถูกต้อง {len(errors)} แถว", "errors": errors}), 400
+
+    dry_run = str(request.args.get("dry_run", "")).lower() in ("1", "true", "yes")
+    if not dry_run:
+        res = receive_lots_apply(plan, ref="csv:" + str(session.get("username", "")))
+        if not res.get("ok"):
+            return jsonify({"success": False, "message": res.get("message", "บันทึกไม่สำเร็จ")}), 500
+        for r in results:
+            lot = r["_lot"]
+            if lot["id"] is None:
+                lot["id"] = res["ids"][r["lot_table"]][lot["slot"]]
+
+    for r in results:
+        r["lot_id"] = r.pop("_lot")["id"]
+    return jsonify({
+        "success": True,
+        "dry_run": dry_run,
+        "rows": len(results),
+        "created": sum(len(p["append"]) for p in plan.values()),
+        "merged": sum(len(p["update"]) for p in plan.values()),
+        "results": results,
+    })
 
 
 @app.route("/lot/<int:lot_id>/delete", methods=["POST"])
@@ -1350,7 +3090,7 @@ def treatment_menu():
 @app.route("/treatment/register")
 @login_required
 def treatment_register():
-    res = gas_list("treatment", 300)
+    res = gas_list("treatment", 300, order="desc")
     rows = res.get("data", []) if res.get("ok") else []
     return render_template("treatment_register.html", rows=rows)
 
@@ -1381,7 +3121,8 @@ def treatment_form():
 
             form_group = (request.form.get("symptom_group") or request.form.get("group") or "").strip()
 
-            # ตรวจ stock และตัด stock (จะทำเฉพาะเมื่อมีรายการยา)
+            # ตรวจ stock (จะทำเฉพาะเมื่อมีรายการยา)
+            need = defaultdict(int)   # (lot_table, lot_id) -> qty รวม
             for it in items:
                 # ✅ canonical name เพื่อให้ dashboard รวมเป็นรายการเดียว
                 raw_name = it.get("name") or it.get("item_name") or ""
@@ -1390,31 +3131,28 @@ def treatment_form():
                     it["name"] = canon_name
                     it["item_name"] = canon_name
 
-                lot_id = it.get("lot_id")
+                lot_id = str(it.get("lot_id") or "").strip()
                 qty = int(it.get("qty") or 0)
 
-                if not lot_id or qty <= 0:
+                if qty <= 0 or (not lot_id and not canon_name):
                     return "ข้อมูล Lot/จำนวนไม่ถูกต้อง", 400
 
                 item_type = str(it.get("type") or it.get("item_type") or "").strip().lower()
 
                 if not item_type and form_group in ("other", "อื่นๆ"):
                     item_type = "other"
+                    it["type"] = item_type
 
-                lot_table = "other_lot" if item_type in ("other", "other_item", "อื่นๆ") else "medicine_lot"
-
-                lot_res = gas_get(lot_table, lot_id)
-                if not lot_res.get("ok") or not lot_res.get("data"):
-                    return "ไม่พบ Lot", 404
-
-                lot = lot_res["data"]
-                current_remain = int(lot.get("qty_remain", 0))
+                # ไม่ระบุ lot -> ให้ FEFO เลือกให้ด้านล่าง
+                if not lot_id or lot_id.lower() == "auto":
+                    continue
 
-                if current_remain < qty:
-                    return f"จำนวนคงเหลือไม่พอ (Lot {lot_id})", 400
+                need[(lot_table_for_type(item_type), lot_id)] += qty
 
-                new_remain = current_remain - qty
-                gas_update_field(lot_table, lot_id, "qty_remain", new_remain)
+            # ✅ รายการที่ไม่ระบุ lot: จัดสรร FEFO แล้วตัดรวมใน batch เดียวกัน
+            items, alloc_err = expand_auto_lots(items, need)
+            if alloc_err:
+                return alloc_err, 400
 
             # ✅ เก็บ medicine json หลัง normalize แล้ว
             medicine_json = json.dumps(items, ensure_ascii=False)
@@ -1441,7 +3179,24 @@ def treatment_form():
                 "doctor_opinion": request.form.get("doctor_opinion", "").strip()
             }
 
-            gas_append("treatment", payload)
+            # เฟส 1: ตรวจทุก lot จาก cache ชุดเดียว + ตัด stock ทั้งหมดใน 1 request (ใต้ lock ของ lot)
+            mv = stock_apply({k: -q for k, q in need.items()}, "dispense")
+            if not mv.get("ok"):
+                if mv.get("error") == "not_found":
+                    return "ไม่พบ Lot", 404
+                if mv.get("error") == "short":
+                    return mv["message"], 400
+                return f"ตัด stock ไม่สำเร็จ: {mv.get('message', '')}", 500
+
+            # เฟส 2: บันทึกการรักษา -> ล้มเมื่อไหร่ คืน stock เป็น batch เดียว
+            try:
+                res = gas_append("treatment", payload)
+            except Exception as e:
+                res = {"ok": False, "message": str(e)}
+            if not (isinstance(res, dict) and res.get("ok")):
+                stock_revert(mv, ref="treatment_form")
+                return f"บันทึกไม่สำเร็จ: {res.get('message', '') if isinstance(res, dict) else res}", 500
+
             return redirect("/treatment/register")
 
         except Exception as e:
@@ -1492,10 +3247,6 @@ def api_treatment_edit(id):
                 return []
         return []
 
-    def lot_table_from_item_type(item_type):
-        t = str(item_type or "").strip().lower()
-        return "other_lot" if t in ("other", "other_item", "อื่นๆ") else "medicine_lot"
-
     def aggregate_meds(meds):
         """
         return: {(table, lot_id): qty_sum}
@@ -1506,7 +3257,7 @@ def api_treatment_edit(id):
             qty = to_int(m.get("qty"), 0)
             if not lot_id or qty <= 0:
                 continue
-            table = lot_table_from_item_type(m.get("type") or m.get("item_type"))
+            table = lot_table_for_type(m.get("type") or m.get("item_type"))
             agg[(table, lot_id)] += qty
         return agg
 
@@ -1531,89 +3282,14 @@ def api_treatment_edit(id):
     # ตัดตัวที่ net = 0 ออก
     delta_map = {k: v for k, v in delta_map.items() if v != 0}
 
-    # 4) เตรียม batch get (ลดจำนวน request)
-    need_ids_med = [lot_id for (table, lot_id), _ in delta_map.items() if table == "medicine_lot"]
-    need_ids_other = [lot_id for (table, lot_id), _ in delta_map.items() if table == "other_lot"]
-
-    med_map = {}
-    other_map = {}
-
-    if need_ids_med:
-        res = gas_batch_get("medicine_lot", need_ids_med)
-        if res.get("ok"):
-            med_map = {str(x.get("id")): x for x in (res.get("data") or [])}
-
-    if need_ids_other:
-        res = gas_batch_get("other_lot", need_ids_other)
-        if res.get("ok"):
-            other_map = {str(x.get("id")): x for x in (res.get("data") or [])}
-
-    # 5) ตรวจคงเหลือ + สร้าง batch update
-    updates_by_table = {"medicine_lot": [], "other_lot": []}
-
-    for (expected_table, lot_id), delta in delta_map.items():
-        lot_id_s = str(lot_id)
-        lot_row = None
-        actual_table = expected_table
-
-        if expected_table == "medicine_lot":
-            lot_row = med_map.get(lot_id_s)
-            if not lot_row:
-                # fallback เผื่อข้อมูล type เก่าคลาดเคลื่อน
-                lot_row = other_map.get(lot_id_s)
-                if lot_row:
-                    actual_table = "other_lot"
-        else:
-            lot_row = other_map.get(lot_id_s)
-            if not lot_row:
-                lot_row = med_map.get(lot_id_s)
-                if lot_row:
-                    actual_table = "medicine_lot"
-
-        # fallback สุดท้ายแบบทีละตัว
-        if not lot_row:
-            r1 = gas_get("medicine_lot", lot_id_s)
-            if r1.get("ok") and r1.get("data"):
-                lot_row = r1["data"]
-                actual_table = "medicine_lot"
-            else:
-                r2 = gas_get("other_lot", lot_id_s)
-                if r2.get("ok") and r2.get("data"):
-                    lot_row = r2["data"]
-                    actual_table = "other_lot"
-
-        if not lot_row:
-            return {"success": False, "message": f"ไม่พบ Lot: {lot_id_s}"}
-
-        current = to_int(lot_row.get("qty_remain", 0), 0)
-        new_remain = current + delta  # delta = +คืน old -ตัด new
-
-        if new_remain < 0:
-            item_name = lot_row.get("item_name") or lot_row.get("lot_name") or lot_id_s
-            return {
-                "success": False,
-                "message": f"จำนวนคงเหลือไม่พอ ({item_name})"
-            }
-
-        updates_by_table[actual_table].append({
-            "id": lot_id_s,
-            "field": "qty_remain",
-            "value": new_remain
-        })
-
-    # 6) เขียน stock แบบ batch (ถ้าไม่ได้ค่อย fallback ทีละรายการ)
-    for table in ("medicine_lot", "other_lot"):
-        updates = updates_by_table[table]
-        if not updates:
-            continue
-
-        br = gas_batch_update_fields(table, updates)
-        if not br.get("ok"):
-            # fallback
-            for u in updates:
-                rr = gas_update_field(table, u["id"], u["field"], u["value"])
-                if not rr.get("ok"):
-                    return {"success": False, "message": rr.get("message") or "อัปเดต stock ไม่สำเร็จ"}
+    # 4-6) ตรวจคงเหลือ + เขียน stock เป็น ledger 1 request (ใต้ lock ของ lot ที่เกี่ยวข้อง)
+    mv = stock_apply(delta_map, "edit", ref=id)
+    if not mv.get("ok"):
+        if mv.get("error") == "short":
+            lot_row = mv.get("lot") or {}
+            item_name = lot_row.get("item_name") or lot_row.get("lot_name") or mv["key"][1]
+            return {"success": False, "message": f"จำนวนคงเหลือไม่พอ ({item_name})"}
+        return {"success": False, "message": mv.get("message") or "อัปเดต stock ไม่สำเร็จ"}
 
     # 7) normalize visit_date
     incoming_visit = (data.get("visit_date") or "").strip() if isinstance(data.get("visit_date"), str) else data.get("visit_date")
@@ -1628,6 +3304,7 @@ def api_treatment_edit(id):
     # 8) update treatment
     ur = gas_update("treatment", id, data)
     if not ur.get("ok"):
+        stock_revert(mv, ref=id)
         return {"success": False, "message": ur.get("message") or "อัปเดตข้อมูลไม่สำเร็จ"}
 
     return {"success": True}
@@ -1638,13 +3315,19 @@ def api_treatment_edit(id):
 @login_required
 def api_treatment_delete(id):
     old_res = gas_get("treatment", id)
+    if not old_res.get("ok") and old_res.get("message") == "Not found":
+        return {"success": True}   # ถูกลบไปแล้ว (กดซ้ำ)
+    if not old_res.get("ok"):
+        # อ่านรายการเดิมไม่ได้ -> ไม่รู้ว่าต้องคืน stock เท่าไร ห้ามลบ
+        return {"success": False, "message": old_res.get("message") or "โหลดข้อมูลเดิมไม่สำเร็จ"}
     old_items = []
-    if old_res.get("ok") and old_res.get("data"):
+    if old_res.get("data"):
         try:
             old_items = json.loads(old_res["data"].get("medicine", "[]"))
         except:
             old_items = []
 
+    back = defaultdict(int)
     for it in old_items:
         lot_id = it.get("lot_id")
         qty = int(it.get("qty") or 0)
@@ -1652,53 +3335,424 @@ def api_treatment_delete(id):
             continue
 
         item_type = str(it.get("type") or it.get("item_type") or "").strip().lower()
-        lot_table = "other_lot" if item_type in ("other", "other_item", "อื่นๆ") else "medicine_lot"
+        back[(lot_table_for_type(item_type), str(lot_id))] += qty
 
-        lot_res = gas_get(lot_table, lot_id)
-        if lot_res.get("ok") and lot_res.get("data"):
-            current = int(lot_res["data"].get("qty_remain", 0))
-            new_remain = current + qty
-            gas_update_field(lot_table, lot_id, "qty_remain", new_remain)
+    # คืน stock ทุก lot ใน 1 request (lot ที่ถูกลบไปแล้วข้าม)
+    mv = stock_apply(back, "return", ref=id, skip_missing=True)
+    if not mv.get("ok"):
+        return {"success": False, "message": mv.get("message") or "คืน stock ไม่สำเร็จ"}
 
-    gas_delete("treatment", id)
+    dr = gas_delete("treatment", id)
+    if not dr.get("ok"):
+        stock_revert(mv, ref=id)
+        return {"success": False, "message": dr.get("message") or "ลบข้อมูลไม่สำเร็จ"}
     return {"success": True}
 
 
 @app.route("/api/treatment_list")
 @login_required
 def treatment_list():
-    res = gas_list("treatment", 1000)
-    rows = res.get("data", []) if res.get("ok") else []
+    """
+    ไม่มี query = รายการทั้งหมด (แบบเดิม)
+    มี limit/cursor/date_from/date_to/department/symptom_group = แบ่งหน้าแบบ keyset
+      -> {"items": [...], "next_cursor": "<epoch>_<id>" | null}
+    """
+    args = request.args
+    paged = any(args.get(k) for k in ("limit", "cursor", "date_from", "date_to", "department", "symptom_group"))
+    if not paged:
+        return _conditional_json(
+            lambda: list_etag([_TREAT_SPEC]),
+            _build_treatment_list,
+            tables=("treatment",),
+        )
 
-    data = []
-    for r in rows:
-        raw_visit = r.get("visit_date")
-        display_visit = format_visit_date_for_display(raw_visit, with_seconds=False)
-
-        data.append({
-            "id": r.get("id"),
-            "visit_date_raw": raw_visit,
-            "visit_date_display": display_visit,
-            "visit_date": display_visit,   # ใช้ key เดิมในหน้า register
-            "patient_name": r.get("patient_name"),
-            "symptom_group": r.get("symptom_group"),
-            "medicine": r.get("medicine")
-        })
+    limit = max(1, min(_to_int(args.get("limit"), 50), 500))
+    return _conditional_json(
+        lambda: list_etag([_TREAT_SPEC]),
+        lambda: treatment_page(
+            cursor=args.get("cursor"),
+            limit=limit,
+            date_from=args.get("date_from"),
+            date_to=args.get("date_to"),
+            department=args.get("department"),
+            symptom_group=args.get("symptom_group"),
+        ),
+        tables=("treatment",),
+    )
 
-    # เรียงใหม่ -> เก่า (ตาม datetime ที่ parse ได้)
-    def _sort_key(x):
-        dt = _parse_any_datetime(x.get("visit_date_raw"))
-        if dt is None:
-            return float("-inf")
-        if dt.tzinfo is None and TH_TZ:
-            dt = dt.replace(tzinfo=TH_TZ)
+
+# ===== index ทะเบียนการรักษา (เรียง ใหม่ -> เก่า) สำหรับแบ่งหน้า =====
+# ใช้ 10000 แถวล่าสุด (order="desc" = ท้ายชีต) / สร้าง index ใหม่เมื่อ cache เปลี่ยน
+# keys[i] = (-epoch, -id) เรียงจากน้อยไปมาก = ใหม่สุดก่อน -> bisect หา cursor / วันที่ได้ทันที
+# ชีตเกิน limit: แถวที่เก่ากว่า (archive) อ่านจากชีตทีละก้อนด้วย list desc + offset (ดูหมวด archive ด้านล่าง)
+_TREAT_LIMIT = 10000
+_TREAT_SPEC = ("treatment", _TREAT_LIMIT, "desc")
+_TREAT_IDX = {"src": None, "keys": [], "rows": []}
+_TREAT_IDX_LOCK = Lock()
+
+
+def _visit_epoch(raw):
+    dt = _parse_any_datetime(raw)
+    if dt is None:
+        return 0
+    if dt.tzinfo is None and TH_TZ:
+        dt = dt.replace(tzinfo=TH_TZ)
+    try:
+        return int(dt.timestamp())
+    except:
+        return 0
+
+
+def _treatment_summary(r):
+    """แถว treatment ดิบ -> (key, แถวสำหรับหน้าทะเบียน)"""
+    raw_visit = r.get("visit_date")
+    display_visit = format_visit_date_for_display(raw_visit, with_seconds=False)
+    epoch = _visit_epoch(raw_visit)
+    return (-epoch, -_to_int(r.get("id"), 0)), {
+        "id": r.get("id"),
+        "visit_date_raw": raw_visit,
+        "visit_date_display": display_visit,
+        "visit_date": display_visit,   # ใช้ key เดิมในหน้า register
+        "visit_epoch": epoch,
+        "patient_name": r.get("patient_name"),
+        "department": r.get("department"),
+        "symptom_group": r.get("symptom_group"),
+        "medicine": r.get("medicine")
+    }
+
+
+def _treatment_index():
+    res = gas_list(*_TREAT_SPEC)
+    if not (isinstance(res, dict) and res.get("ok")):
+        return [], []
+
+    with _TREAT_IDX_LOCK:
+        if _TREAT_IDX["src"] is res:
+            return _TREAT_IDX["keys"], _TREAT_IDX["rows"]
+
+        items = [_treatment_summary(r) for r in _unwrap_rows(res)]
+        items.sort(key=lambda x: x[0])
+        _TREAT_IDX.update(src=res, keys=[k for k, _ in items], rows=[v for _, v in items])
+        return _TREAT_IDX["keys"], _TREAT_IDX["rows"]
+
+
+def _day_epoch(value, end=False):
+    """'YYYY-MM-DD' -> epoch ต้นวัน (end=True = ต้นวันถัดไป) ตามเวลาไทย"""
+    dt = _parse_any_datetime(str(value or "").strip()[:10])
+    if dt is None:
+        return None
+    if dt.tzinfo is None and TH_TZ:
+        dt = dt.replace(tzinfo=TH_TZ)
+    return int(dt.timestamp()) + (86400 if end else 0)
+
+
+def _parse_cursor(cursor):
+    try:
+        epoch, rid = str(cursor).split("_", 1)
+        return (-int(epoch), -int(rid))
+    except Exception:
+        return None
+
+
+# ===== archive: แถวที่เก่ากว่า index (ชีตเกิน _TREAT_LIMIT) =====
+# อ่านทีละ _TREAT_ARCHIVE_CHUNK แถวด้วย list desc + offset (ตำแหน่งนับจากท้ายชีต) เรียงตามลำดับในชีต (ใหม่ -> เก่า)
+# cursor = "a<offset>_<id>" = อ่านต่อที่ offset ข้ามแถวที่ id ไม่น้อยกว่า id (กันซ้ำถ้ามีแถวใหม่ต่อท้ายระหว่างเลื่อนหน้า)
+# GAS ที่ยังไม่รองรับ offset (ส่งแถวท้ายชีตชุดเดิมกลับมา) หรืออ่านไม่ได้ -> ตอบ truncated=True แทนการจบเงียบ ๆ
+_TREAT_ARCHIVE_CHUNK = 2000
+_TREAT_ARCHIVE_MAX_CHUNKS = 5     # ต่อ request (ตัวกรองไม่เจอเลย -> ส่ง cursor ให้อ่านต่อ)
+
+
+def _treatment_window_full():
+    return len(_treatment_index()[0]) >= _TREAT_LIMIT
+
+
+def _treatment_archive_start():
+    """cursor แรกของ archive: ต่อจาก index / id ต้องน้อยกว่าแถวที่อยู่ใน index ทุกแถว"""
+    rows = _treatment_index()[1]
+    min_id = min((_to_int(r.get("id"), 0) for r in rows), default=0)
+    return _TREAT_LIMIT, min_id
+
+
+def _treatment_archive_chunk(offset):
+    """แถวดิบ (ใหม่ -> เก่า) เริ่มที่ offset จากท้ายชีต -> (rows, ok)"""
+    res = gas_list("treatment", _TREAT_ARCHIVE_CHUNK, "desc", offset=offset)
+    if not (isinstance(res, dict) and res.get("ok")):
+        return [], False
+    rows = _unwrap_rows(res)
+    newest = _unwrap_rows(gas_list(*_TREAT_SPEC))[:1]
+    if rows and newest and str(rows[0].get("id")) == str(newest[0].get("id")):
+        print("treatment archive: GAS does not support list offset (deploy gas_code.js ใหม่)")
+        return [], False
+    return rows, True
+
+
+def _treatment_archive_scan(offset, before_id, from_epoch=None):
+    """
+    (pos, แถวดิบ) ใน archive ตั้งแต่ offset ที่ id < before_id (ใหม่ -> เก่าตามชีต)
+    จบเมื่อหมดชีต หรือทั้งก้อนเก่ากว่า from_epoch / อ่านไม่ได้ -> yield (None, None) แล้วจบ
+    """
+    while True:
+        rows, ok = _treatment_archive_chunk(offset)
+        if not ok:
+            yield None, None
+            return
+        if not rows:
+            return
+        newest = 0
+        for i, r in enumerate(rows):
+            epoch = _visit_epoch(r.get("visit_date"))
+            newest = max(newest, epoch)
+            if _to_int(r.get("id"), 0) < before_id:
+                yield offset + i + 1, r
+        offset += len(rows)
+        if len(rows) < _TREAT_ARCHIVE_CHUNK or (from_epoch is not None and newest < from_epoch):
+            return
+
+
+def _treatment_archive_page(offset, before_id, limit, match, from_epoch, to_epoch):
+    """หน้าถัดไปจาก archive -> (items, next_cursor, truncated)"""
+    out, last, truncated = [], None, False
+    budget = _TREAT_ARCHIVE_MAX_CHUNKS * _TREAT_ARCHIVE_CHUNK
+    for pos, r in _treatment_archive_scan(offset, before_id, from_epoch):
+        if pos is None:
+            truncated = True
+            break
+        last = (pos, _to_int(r.get("id"), 0))
+        _, summary = _treatment_summary(r)
+        epoch = summary["visit_epoch"]
+        in_range = (to_epoch is None or epoch < to_epoch) and (from_epoch is None or epoch >= from_epoch)
+        if in_range and match(summary):
+            out.append((last, summary))
+            if len(out) > limit:
+                break
+        if pos - offset >= budget:
+            return [s for _, s in out], f"a{last[0]}_{last[1]}", False
+
+    if len(out) > limit:
+        out = out[:limit]
+        pos, rid = out[-1][0]
+        return [s for _, s in out], f"a{pos}_{rid}", truncated
+    return [s for _, s in out], None, truncated
+
+
+def treatment_page(cursor=None, limit=50, date_from=None, date_to=None, department=None, symptom_group=None):
+    keys, rows = _treatment_index()
+
+    dept = (department or "").strip()
+    group = (symptom_group or "").strip()
+
+    def match(r):
+        if dept and str(r.get("department") or "").strip() != dept:
+            return False
+        if group and str(r.get("symptom_group") or "").strip() != group:
+            return False
+        return True
+
+    to_epoch = _day_epoch(date_to, end=True) if date_to else None
+    from_epoch = _day_epoch(date_from) if date_from else None
+
+    # cursor ของ archive -> อ่านจากชีตต่อเลย
+    if cursor and str(cursor).startswith("a"):
         try:
-            return dt.timestamp()
-        except:
-            return float("-inf")
+            offset, before_id = (int(x) for x in str(cursor)[1:].split("_", 1))
+        except ValueError:
+            return {"items": [], "next_cursor": None}
+        items, nxt, truncated = _treatment_archive_page(offset, before_id, limit, match, from_epoch, to_epoch)
+        return {"items": items, "next_cursor": nxt, "truncated": truncated}
+
+    start = 0
+    ck = _parse_cursor(cursor) if cursor else None
+    if ck:
+        start = bisect_right(keys, ck)
+
+    # date_to: ข้ามไปแถวแรกที่ไม่เกินวันนั้น (keys เรียงตาม -epoch)
+    if to_epoch is not None:
+        start = max(start, bisect_left(keys, (-(to_epoch - 1), float("-inf"))))
+
+    # date_from: แถวหลังจากนี้เก่ากว่าวันเริ่ม -> หยุด
+    stop = len(keys)
+    if from_epoch is not None:
+        stop = bisect_right(keys, (-from_epoch, float("inf")))
+
+    out = []
+    i = start
+    while i < stop and len(out) <= limit:
+        r = rows[i]
+        i += 1
+        if match(r):
+            out.append(r)
+
+    next_cursor = None
+    archive = stop == len(keys) and _treatment_window_full()
+    if len(out) > limit or (archive and len(out) == limit):
+        # เต็มหน้าพอดีตอนหมด index -> หน้าถัดไปเริ่มที่ archive (cursor เลยแถวสุดท้ายของ index)
+        out = out[:limit]
+        last = out[-1]
+        next_cursor = f"{last['visit_epoch']}_{_to_int(last['id'], 0)}"
+    elif archive:
+        # หมด index แล้วแต่ชีตยังมีแถวเก่ากว่า -> เติมหน้าจาก archive
+        offset, before_id = _treatment_archive_start()
+        more, next_cursor, truncated = _treatment_archive_page(
+            offset, before_id, limit - len(out), match, from_epoch, to_epoch)
+        return {"items": out + more, "next_cursor": next_cursor, "truncated": truncated}
+
+    return {"items": out, "next_cursor": next_cursor}
+
+
+def _build_treatment_list():
+    # index เรียงใหม่ -> เก่าไว้แล้ว
+    return list(_treatment_index()[1])
+
+
+# ===== full-text search ทะเบียนการรักษา (inverted index แบบ n-gram) =====
+# ภาษาไทยไม่มีช่องว่างคั่นคำ -> ตัดเป็น bigram ของตัวอักษรในแต่ละช่วงข้อความ ไม่ต้องมีพจนานุกรม
+# index อัปเดตแบบ incremental: เทียบข้อความของแต่ละแถวกับรอบก่อน ทำ token ใหม่เฉพาะแถวที่เพิ่ม/แก้/ลบ
+# (รวมถึงแถวที่ worker อื่นเขียน) ไม่สร้างใหม่ทั้งก้อนทุกครั้งที่ cache treatment เปลี่ยน
+_SEARCH_FIELDS = (("patient_name", 3), ("items", 2), ("department", 1),
+                  ("symptom_detail", 1), ("doctor_opinion", 1), ("visit_date", 1))
+_SEARCH_RAW = ("patient_name", "medicine", "department", "symptom_detail", "doctor_opinion", "visit_date")
+_SEARCH_IDX = {"src": None, "docs": {}, "post": defaultdict(dict)}
+_SEARCH_LOCK = Lock()
+
+
+def _search_segments(text):
+    s = unicodedata.normalize("NFC", str(text or "")).lower()
+    return [seg for seg in re.sub(r"[^0-9a-zก-๙]+", " ", s).split() if seg]
+
+
+def _search_grams(seg):
+    if len(seg) == 1:
+        return [seg]
+    return [seg[i:i + 2] for i in range(len(seg) - 1)]
+
+
+def _search_doc_fields(row):
+    names = " ".join(it["name"] for it in _parse_treatment_items(row.get("medicine")))
+    return {
+        "patient_name": row.get("patient_name"),
+        "items": names,
+        "department": row.get("department"),
+        "symptom_detail": row.get("symptom_detail"),
+        "doctor_opinion": row.get("doctor_opinion"),
+        "visit_date": f"{row.get('visit_date') or ''} {format_visit_date_for_display(row.get('visit_date'))}",
+    }
+
+
+def _search_unindex(rid):
+    doc = _SEARCH_IDX["docs"].pop(rid, None)
+    if not doc:
+        return
+    post = _SEARCH_IDX["post"]
+    for g in doc["grams"]:
+        p = post.get(g)
+        if p is not None:
+            p.pop(rid, None)
+            if not p:
+                post.pop(g, None)
+
+
+def _search_sync():
+    """ทำ index ให้ตรงกับ cache treatment ปัจจุบัน (แถวที่ไม่เปลี่ยนไม่แตะ)"""
+    res = gas_list(*_TREAT_SPEC)
+    if not (isinstance(res, dict) and res.get("ok")):
+        return
+    with _SEARCH_LOCK:
+        if _SEARCH_IDX["src"] is res:
+            return
+        docs, post = _SEARCH_IDX["docs"], _SEARCH_IDX["post"]
+        seen = set()
+        for row in _unwrap_rows(res):
+            rid = str(row.get("id", "")).strip()
+            if not rid:
+                continue
+            seen.add(rid)
+            sig = tuple(str(row.get(f) or "") for f in _SEARCH_RAW)
+            if rid in docs and docs[rid]["sig"] == sig:
+                continue
+
+            _search_unindex(rid)
+            fields = _search_doc_fields(row)
+            grams = defaultdict(int)
+            flat = []
+            for f, weight in _SEARCH_FIELDS:
+                for seg in _search_segments(fields[f]):
+                    flat.append(seg)
+                    for g in _search_grams(seg):
+                        grams[g] += weight
+            for g, w in grams.items():
+                post[g][rid] = w
+            docs[rid] = {"sig": sig, "grams": tuple(grams), "text": " ".join(flat)}
+
+        for rid in [r for r in docs if r not in seen]:
+            _search_unindex(rid)
+        _SEARCH_IDX["src"] = res
+
+
+def treatment_search(q, offset=0, limit=20):
+    """
+    ค้นหาแบบ AND ทุก n-gram ของคำค้น แล้วยืนยันว่าทุกช่วงคำค้นอยู่ในข้อความจริง
+    เรียงตามคะแนน (น้ำหนักฟิลด์ x idf) แล้วใหม่ -> เก่า
+    """
+    segs = _search_segments(q)
+    if not segs:
+        return {"items": [], "total": 0, "next_offset": None}
+
+    _search_sync()
+    keys, rows = _treatment_index()
+    by_id = {str(r.get("id", "")).strip(): r for r in rows}
+
+    with _SEARCH_LOCK:
+        docs, post = _SEARCH_IDX["docs"], _SEARCH_IDX["post"]
+        n_docs = max(1, len(docs))
+        # คำค้น 1 ตัวอักษรไม่มี bigram -> ตรวจแบบ substring อย่างเดียว
+        grams = {g for seg in segs if len(seg) > 1 for g in _search_grams(seg)}
+        lists = sorted((post.get(g, {}) for g in grams), key=len)
+        if lists and not lists[0]:
+            return {"items": [], "total": 0, "next_offset": None}
+
+        cand = set(lists[0]) if lists else set(docs)
+        for p in lists[1:]:
+            cand &= p.keys()
+            if not cand:
+                break
+
+        scored = []
+        for rid in cand:
+            text = docs[rid]["text"]
+            if not all(seg in text for seg in segs):
+                continue
+            score = sum(p[rid] * math.log(1 + n_docs / len(p)) for p in lists) if lists else 1.0
+            scored.append((score, rid))
+
+    def _rank(x):
+        r = by_id.get(x[1]) or {}
+        return (-x[0], -(r.get("visit_epoch") or 0), -_to_int(x[1], 0))
+
+    scored.sort(key=_rank)
+    page = scored[offset:offset + limit]
+    items = []
+    for score, rid in page:
+        r = by_id.get(rid)
+        if r:
+            items.append({**r, "score": round(score, 3)})
+
+    nxt = offset + limit if offset + limit < len(scored) else None
+    # index ค้นหาครอบคลุมเฉพาะ _TREAT_LIMIT แถวล่าสุด -> บอกหน้าเว็บว่าอาจมีผลที่เก่ากว่านี้
+    return {"items": items, "total": len(scored), "next_offset": nxt,
+            "truncated": _treatment_window_full(), "searched_rows": len(_SEARCH_IDX["docs"])}
 
-    data.sort(key=_sort_key, reverse=True)
-    return jsonify(data)
+
+@app.route("/api/treatment/search")
+@login_required
+def api_treatment_search():
+    q = (request.args.get("q") or "").strip()
+    offset = max(0, _to_int(request.args.get("offset"), 0))
+    limit = max(1, min(_to_int(request.args.get("limit"), 20), 200))
+    return _conditional_json(
+        lambda: list_etag([_TREAT_SPEC]),
+        lambda: treatment_search(q, offset=offset, limit=limit),
+        tables=("treatment",),
+    )
 
 
 # ============================================
@@ -1708,15 +3762,18 @@ def treatment_list():
 @app.get("/api/other_items")
 @login_required
 def api_other_items():
-    res = gas_list("other_item", 5000)
-    items = []
-    if res.get("ok"):
-        for r in res.get("data", []):
-            name = norm_text(r.get("name", ""))
-            if name:
-                items.append({"id": r.get("id"), "name": name})
-    items.sort(key=lambda x: x["name"].lower())
-    return jsonify(items)
+    def build():
+        res = gas_list("other_item", 5000)
+        items = []
+        if res.get("ok"):
+            for r in res.get("data", []):
+                name = norm_text(r.get("name", ""))
+                if name:
+                    items.append({"id": r.get("id"), "name": name})
+        items.sort(key=lambda x: x["name"].lower())
+        return items
+
+    return _conditional_json(lambda: list_etag([("other_item", 5000)]), build, tables=("other_item",))
 
 
 @app.get("/api/other_lots")
@@ -1726,37 +3783,48 @@ def api_other_lots():
     if not item_name:
         return jsonify({"lots": []})
 
-    rows = _get_lots_by_field_fast("other_lot", "item_name", item_name, limit=10000)
-
-    lots = []
-    for r in rows:
-        if norm_text(r.get("item_name", "")).lower() != item_name.lower():
-            continue
-        if int(r.get("qty_remain", 0) or 0) > 0:
-            lots.append({
-                "id": r.get("id"),
-                "name": r.get("lot_name"),
-                "remain": r.get("qty_remain"),
-                "price": r.get("price_per_unit")
-            })
+    def build():
+        rows = _get_lots_by_field_fast("other_lot", "item_name", item_name, limit=10000)
+        rows = lots_with_remain("other_lot", rows)
 
-    return jsonify({"lots": lots})
+        lots = []
+        for r in rows:
+            if norm_text(r.get("item_name", "")).lower() != item_name.lower():
+                continue
+            if int(r.get("qty_remain", 0) or 0) > 0:
+                lots.append({
+                    "id": r.get("id"),
+                    "name": r.get("lot_name"),
+                    "remain": r.get("qty_remain"),
+                    "price": r.get("price_per_unit")
+                })
+        return {"lots": lots}
+
+    return _conditional_json(
+        lambda: list_etag([("other_lot", 10000), (STOCK_LEDGER, _LEDGER_LIMIT)]),
+        build,
+        tables=("other_lot", STOCK_LEDGER),
+    )
 
 
 @app.route("/api/medicine_list")
 def api_medicine_list():
     mtype = request.args.get("type", "").strip().lower()
-    res = gas_list("medicine", 2000)
-    rows = []
-    if res.get("ok"):
-        for r in res.get("data", []):
-            cur_type = str(r.get("type", "")).strip().lower()
-            if not mtype:
-                rows.append(r)
-            elif cur_type == mtype:
-                rows.append(r)
 
-    return jsonify([{"id": r.get("id"), "name": r.get("name")} for r in rows])
+    def build():
+        res = gas_list("medicine", 2000)
+        rows = []
+        if res.get("ok"):
+            for r in res.get("data", []):
+                cur_type = str(r.get("type", "")).strip().lower()
+                if not mtype:
+                    rows.append(r)
+                elif cur_type == mtype:
+                    rows.append(r)
+
+        return [{"id": r.get("id"), "name": r.get("name")} for r in rows]
+
+    return _conditional_json(lambda: list_etag([("medicine", 2000)]), build, tables=("medicine",))
 
 
 @app.route("/api/medicine_id")
@@ -1785,6 +3853,14 @@ def api_medicine_items():
     if not group and not code:
         return jsonify({"items": []})
 
+    return _conditional_json(
+        lambda: list_etag([("medicine", 5000)]),
+        lambda: _build_medicine_items(group, code),
+        tables=("medicine",),
+    )
+
+
+def _build_medicine_items(group, code):
     rows = _unwrap_rows(gas_list("medicine", limit=5000))
 
     names = []
@@ -1815,7 +3891,7 @@ def api_medicine_items():
             _push_name(rule.get("canonical", ""))
 
     names.sort(key=lambda s: s.lower())
-    return jsonify({"items": names})
+    return {"items": names}
 
 
 
@@ -1823,7 +3899,15 @@ def api_medicine_items():
 def api_medicine_lots():
     medicine_id = (request.args.get("medicine_id") or "").strip()
     name = (request.args.get("name") or "").strip()
-    
+
+    return _conditional_json(
+        lambda: list_etag([("medicine", 5000), _MED_LOT_SPEC, (STOCK_LEDGER, _LEDGER_LIMIT)]),
+        lambda: _build_medicine_lots(medicine_id, name),
+        tables=("medicine", "medicine_lot", STOCK_LEDGER),
+    )
+
+
+def _build_medicine_lots(medicine_id, name):
     if not name and medicine_id:
         mr = gas_get("medicine", medicine_id)
         if mr.get("ok") and mr.get("data"):
@@ -1831,7 +3915,7 @@ def api_medicine_lots():
 
     # ✅ shared medicine: รวม lot จากทุกระบบที่ใช้ชื่อเดียวกัน
     if name and is_shared_medicine_name(name):
-        rows = _get_shared_medicine_lots_by_name(name)
+        rows = lots_with_remain("medicine_lot", _get_shared_medicine_lots_by_name(name))
         lots = []
         seen = set()
         for r in rows:
@@ -1861,47 +3945,300 @@ def api_medicine_lots():
                     medicine_id = str(m.get("id"))
                     break
 
-    if not medicine_id:
-        return jsonify({"lots": []})
+    if not medicine_id:
+        return jsonify({"lots": []})
+
+    all_lots = gas_list(*_MED_LOT_SPEC)
+    lots = []
+    if all_lots.get("ok"):
+        for r in lots_with_remain("medicine_lot", all_lots.get("data", [])):
+            if str(r.get("medicine_id", "")) == str(medicine_id):
+                if int(r.get("qty_remain", 0) or 0) > 0:
+                    lots.append({
+                        "id": r.get("id"),
+                        "name": r.get("lot_name"),
+                        "remain": r.get("qty_remain"),
+                        "price": r.get("price_per_unit")
+                    })
+
+    lots.sort(key=lambda x: str(x.get("name", "")))
+    return jsonify({"lots": lots})
+
+
+
+@app.route("/api/cut_stock", methods=["POST"])
+def api_cut_stock():
+    data = request.json
+    lot_id = data.get("lot_id")
+    qty = int(data.get("qty", 0) or 0)
+
+    item_type = str(data.get("type") or data.get("item_type") or "").strip().lower()
+    key = (lot_table_for_type(item_type), str(lot_id))
+
+    mv = stock_apply({key: -qty}, "dispense")
+    if not mv.get("ok"):
+        msg = {"not_found": "ไม่พบ Lot", "short": "จำนวนคงเหลือไม่พอ"}.get(mv.get("error"))
+        return {"success": False, "message": msg or mv.get("message") or "ตัด stock ไม่สำเร็จ"}
+    return {"success": True}
+
+
+@app.route("/api/stock/allocate", methods=["POST"])
+@login_required
+def api_stock_allocate():
+    """
+    แนะนำ lot แบบ FEFO (ยังไม่ตัด stock)
+    body: {"name", "qty", "type", "medicine_id"?, "reserved": [{"lot_id", "qty"}, ...]}
+    reserved = รายการที่อยู่ในตารางหน้าฟอร์มแล้ว จะได้ไม่จัดสรรซ้ำ
+    """
+    data = request.json or {}
+    name = (data.get("name") or "").strip()
+    item_type = str(data.get("type") or "").strip().lower()
+    table = lot_table_for_type(item_type)
+
+    reserved = defaultdict(int)
+    for r in data.get("reserved") or []:
+        if isinstance(r, dict) and r.get("lot_id"):
+            reserved[(table, str(r["lot_id"]).strip())] += _to_int(r.get("qty"), 0)
+
+    alloc = allocate_fefo(name, data.get("qty"), item_type, reserved=reserved, medicine_id=data.get("medicine_id") or "")
+    if not alloc.get("ok"):
+        return {"success": False, "message": alloc["message"], "available": alloc.get("available", 0)}
+    return {"success": True, "allocations": alloc["allocations"]}
+
+
+# ============================================
+# BLOB STORE (รูปภาพ เก็บบนดิสก์ตาม sha256)
+# ============================================
+# ชีตเก็บแค่ hash (64 hex) แทน data URL ก้อนใหญ่ -> list waste / _GAS_CACHE เล็กลง
+# ไฟล์เดียวกันได้ hash เดียวกัน = ไม่ซ้ำ / เนื้อหาไม่เปลี่ยน = cache ฝั่ง browser ได้ตลอด
+BLOB_DIR = os.environ.get("BLOB_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "blobs")
+BLOB_DIR_EXPLICIT = bool(os.environ.get("BLOB_DIR"))
+# ไม่ได้ตั้ง BLOB_DIR (เช่น Vercel: โฟลเดอร์แอปหาย/เขียนไม่ได้) -> รูปใหม่เก็บเป็น data URL ในชีตเหมือนเดิม
+if not BLOB_DIR_EXPLICIT:
+    print("photo warning: BLOB_DIR not set - new photos stay as data URL in the sheet (set BLOB_DIR to a persistent disk)")
+
+# ย่อรูป/ทำ thumbnail ใช้ Pillow (อยู่ใน requirements.txt)
+# ไม่มี -> ยังบันทึกได้แต่เก็บไฟล์ต้นฉบับเต็มขนาด และ thumbnail = รูปเต็ม (เตือนครั้งเดียวตอน start)
+try:
+    from PIL import Image, ImageOps
+except Exception:
+    Image = None
+    print("photo warning: Pillow not installed - storing photos full size without resize/thumbnail (pip install Pillow)")
+
+PHOTO_MAX_SIDE = int(os.environ.get("PHOTO_MAX_SIDE", "1600"))
+PHOTO_QUALITY = int(os.environ.get("PHOTO_QUALITY", "80"))
+THUMB_SIDE = int(os.environ.get("THUMB_SIDE", "240"))
+_DATA_URL_RE = re.compile(r"^data:([\w/+.-]+)?(;[\w=.-]+)*;base64,", re.I)
+_BLOB_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_blob_digest(value):
+    return bool(_BLOB_DIGEST_RE.match(str(value or "").strip()))
+
+
+def blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+def thumb_path(digest, side=THUMB_SIDE):
+    return os.path.join(BLOB_DIR, "thumb", digest[:2], f"{digest}-{side}.jpg")
+
+
+def _atomic_write(path, data: bytes):
+    d = os.path.dirname(path)
+    os.makedirs(d, exist_ok=True)
+    # ชื่อ tmp ไม่ซ้ำต่อการเขียน (หลาย thread ใน worker เดียวเขียน path เดียวกันพร้อมกันได้)
+    fd, tmp = tempfile.mkstemp(dir=d, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)   # mkstemp สร้าง 0600
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def blob_put(data: bytes) -> str:
+    """เขียน bytes ลง blob store -> sha256 hex (มีอยู่แล้วไม่เขียนซ้ำ)"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if not os.path.exists(path):
+        _atomic_write(path, data)
+    return digest
+
+
+def _reencode_image(data: bytes, max_side, quality=PHOTO_QUALITY):
+    """ย่อด้านยาวไม่เกิน max_side แล้วเข้ารหัสเป็น JPEG (อ่านไม่ได้/ไม่มี Pillow -> None)"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            im = ImageOps.exif_transpose(im)
+            if im.mode in ("RGBA", "LA", "P"):
+                im = im.convert("RGBA")
+                bg = Image.new("RGB", im.size, (255, 255, 255))
+                bg.paste(im, mask=im.getchannel("A"))
+                im = bg
+            elif im.mode != "RGB":
+                im = im.convert("RGB")
+            im.thumbnail((max_side, max_side), Image.LANCZOS)
+            out = io.BytesIO()
+            im.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+            return out.getvalue()
+    except Exception as e:
+        print(f"reencode image error: {e}")
+        return None
+
+
+def blob_thumb(digest, side=THUMB_SIDE):
+    """path ของ thumbnail (สร้างครั้งแรกแล้ว cache บนดิสก์) / ทำไม่ได้ -> None"""
+    path = thumb_path(digest, side)
+    if os.path.exists(path):
+        return path
+    src_path = blob_path(digest)
+    if Image is None or not os.path.exists(src_path):
+        return None
+    with open(src_path, "rb") as f:
+        data = _reencode_image(f.read(), side, quality=70)
+    if not data:
+        return None
+    _atomic_write(path, data)
+    return path
+
+
+def _sniff_image_mime(head: bytes):
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:4] == b"GIF8":
+        return "image/gif"
+    return "application/octet-stream"
+
+
+def store_photo(value, allow_default_dir=False):
+    """
+    ค่ารูปจากฟอร์ม -> ค่าที่เก็บในชีต
+    data URL = ถอด base64 เก็บลง blob store คืน hash / hash เดิม, URL, ค่าว่าง = คืนตามเดิม
+    ไม่ได้ตั้ง BLOB_DIR หรือเขียนไฟล์ไม่ได้ -> คืน data URL เดิม (ชีตต้องมีรูปเสมอ ไม่ใช่ hash ที่ไม่มีไฟล์)
+    allow_default_dir = ให้ใช้โฟลเดอร์ default ได้ (migration ตรวจเองแล้ว)
+    """
+    s = str(value or "").strip()
+    m = _DATA_URL_RE.match(s)
+    if not m or not (BLOB_DIR_EXPLICIT or allow_default_dir):
+        return s
+    try:
+        data = base64.b64decode(s[m.end():], validate=False)
+    except Exception as e:
+        print(f"store_photo decode error: {e}")
+        return s
+    if not data:
+        return ""
+
+    # รูปจากกล้องมือถือ (PNG เต็มความละเอียด) -> JPEG ขนาดจำกัด ใช้เมื่อเล็กลงจริงเท่านั้น
+    small = _reencode_image(data, PHOTO_MAX_SIDE)
+    if small and len(small) < len(data):
+        data = small
+
+    try:
+        digest = blob_put(data)
+    except OSError as e:
+        print(f"store_photo write error: {e}")
+        return s
+    try:
+        blob_thumb(digest)
+    except OSError as e:
+        # ไม่มี thumbnail -> /blob/<hash>/thumb ส่งรูปเต็มแทน
+        print(f"store_photo thumbnail error: {e}")
+    return digest
+
+
+@app.template_filter("photo_src")
+def photo_src(value):
+    """ใช้ใน template: hash -> URL ของ blob / ข้อมูลเก่า (data URL) คืนตามเดิม"""
+    s = str(value or "").strip()
+    if is_blob_digest(s):
+        return url_for("blob_get", digest=s)
+    return s
+
 
-    all_lots = gas_list("medicine_lot", 5000)
-    lots = []
-    if all_lots.get("ok"):
-        for r in all_lots.get("data", []):
-            if str(r.get("medicine_id", "")) == str(medicine_id):
-                if int(r.get("qty_remain", 0) or 0) > 0:
-                    lots.append({
-                        "id": r.get("id"),
-                        "name": r.get("lot_name"),
-                        "remain": r.get("qty_remain"),
-                        "price": r.get("price_per_unit")
-                    })
+@app.template_filter("photo_thumb")
+def photo_thumb(value):
+    """ใช้ในหน้า list: hash -> URL ของ thumbnail"""
+    s = str(value or "").strip()
+    if is_blob_digest(s):
+        return url_for("blob_thumb_get", digest=s)
+    return s
 
-    lots.sort(key=lambda x: str(x.get("name", "")))
-    return jsonify({"lots": lots})
 
+def _send_blob(path, etag):
+    # เนื้อหาผูกกับ hash -> ไม่มีวันเปลี่ยน (private เพราะต้อง login)
+    if request.headers.get("If-None-Match", "").strip('W/" ') == etag:
+        resp = app.response_class(status=304)
+    else:
+        with open(path, "rb") as f:
+            head = f.read(16)
+        resp = send_file(path, mimetype=_sniff_image_mime(head), conditional=False, etag=False)
+    resp.headers["ETag"] = f'"{etag}"'
+    resp.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return resp
 
 
-@app.route("/api/cut_stock", methods=["POST"])
-def api_cut_stock():
-    data = request.json
-    lot_id = data.get("lot_id")
-    qty = int(data.get("qty", 0) or 0)
+@app.route("/blob/<digest>")
+@login_required
+def blob_get(digest):
+    if not is_blob_digest(digest) or not os.path.exists(blob_path(digest)):
+        return "ไม่พบไฟล์", 404
+    return _send_blob(blob_path(digest), digest)
 
-    item_type = str(data.get("type") or data.get("item_type") or "").strip().lower()
-    lot_table = "other_lot" if item_type in ("other", "other_item", "อื่นๆ") else "medicine_lot"
 
-    lot_res = gas_get(lot_table, lot_id)
-    if not lot_res.get("ok") or not lot_res.get("data"):
-        return {"success": False, "message": "ไม่พบ Lot"}
+@app.route("/blob/<digest>/thumb")
+@login_required
+def blob_thumb_get(digest):
+    if not is_blob_digest(digest) or not os.path.exists(blob_path(digest)):
+        return "ไม่พบไฟล์", 404
+    path = blob_thumb(digest)
+    if not path:
+        return _send_blob(blob_path(digest), digest)
+    return _send_blob(path, f"{digest}-{THUMB_SIDE}")
 
-    current = int(lot_res["data"].get("qty_remain", 0))
-    if current < qty:
-        return {"success": False, "message": "จำนวนคงเหลือไม่พอ"}
 
-    new_remain = current - qty
-    gas_update_field(lot_table, lot_id, "qty_remain", new_remain)
-    return {"success": True}
+def migrate_waste_photos(dry_run=False):
+    """
+    ย้ายรูป data URL ในชีต waste เดิมเข้า blob store (รันซ้ำได้ แถวที่ย้ายแล้วข้าม)
+    ⚠️ ชีตจะเหลือแค่ hash -> ไฟล์ใน BLOB_DIR คือสำเนาเดียวของรูป
+    ต้องตั้ง BLOB_DIR เป็นดิสก์ถาวรเอง (ค่า default อยู่ในโฟลเดอร์แอป ซึ่งบน host แบบ ephemeral หายเมื่อ deploy ใหม่)
+    """
+    if not dry_run and not BLOB_DIR_EXPLICIT:
+        return {"ok": False, "message": "ยังไม่ได้ตั้ง BLOB_DIR: ตั้งเป็นดิสก์ถาวรก่อนย้ายรูป (รูปในชีตจะถูกแทนด้วย hash)"}
+    res = gas_list_raw("waste", 100000)
+    if not res.get("ok"):
+        return {"ok": False, "message": res.get("message") or "อ่านชีต waste ไม่สำเร็จ"}
+
+    moved, skipped, failed, saved = 0, 0, 0, 0
+    for row in _unwrap_rows(res):
+        photo = str(row.get("photo") or "")
+        if not _DATA_URL_RE.match(photo):
+            skipped += 1
+            continue
+        digest = store_photo(photo, allow_default_dir=True)
+        if not is_blob_digest(digest) or not os.path.exists(blob_path(digest)):
+            failed += 1
+            continue
+        if not dry_run:
+            up = gas_update_field("waste", row.get("id"), "photo", digest)
+            if not up.get("ok"):
+                failed += 1
+                continue
+        moved += 1
+        saved += len(photo) - len(digest)
+    return {"ok": True, "moved": moved, "skipped": skipped, "failed": failed, "bytes_saved": saved}
 
 
 # ============================================
@@ -1924,7 +4261,7 @@ def waste_add():
             "date": request.form.get("date", "").strip(),
             "time": request.form.get("time", "").strip(),
             "place": request.form.get("place", "").strip(),
-            "photo": request.form.get("photo", "")
+            "photo": store_photo(request.form.get("photo", ""))
         }
 
         gas_append("waste", payload)
@@ -1968,7 +4305,7 @@ def waste_edit(id):
             "date": request.form.get("date", "").strip(),
             "time": request.form.get("time", "").strip(),
             "place": request.form.get("place", "").strip(),
-            "photo": photo_new if photo_new else old_photo
+            "photo": store_photo(photo_new) if photo_new else old_photo
         }
 
         gas_update("waste", id, payload)
@@ -2074,20 +4411,21 @@ def _dash_norm_name(s):
     return s
 
 
-def _build_drug_master_and_remain():
+def _build_drug_master_and_remain(refresh=False):
     """
     สร้าง master ชื่อยา/เวชภัณฑ์/อื่นๆ + remain รวมจาก lot
     cache ยาวขึ้นเพราะ invalidate อัตโนมัติเมื่อมีการเขียนข้อมูล
     """
     cache_key = ("drug_master_remain_v2",)
-    cached = _dash_get(cache_key, ttl=180)
-    if cached is not None:
-        return cached
+    if not refresh:
+        cached = _dash_get(cache_key, ttl=180)
+        if cached is not None:
+            return cached
 
     meds = _unwrap_rows(gas_list_cached("medicine", limit=5000, ttl=90))
     others = _unwrap_rows(gas_list_cached("other_item", limit=5000, ttl=90))
-    med_lots = _unwrap_rows(gas_list_cached("medicine_lot", limit=10000, ttl=90))
-    other_lots = _unwrap_rows(gas_list_cached("other_lot", limit=10000, ttl=90))
+    med_lots = lots_with_remain("medicine_lot", _unwrap_rows(gas_list_cached("medicine_lot", limit=10000, ttl=90)))
+    other_lots = lots_with_remain("other_lot", _unwrap_rows(gas_list_cached("other_lot", limit=10000, ttl=90)))
 
     key_to_display = {}   # norm_name -> display_name
     remain_by_key = {}    # norm_name -> {"remain": int, "has_lot": bool}
@@ -2145,15 +4483,16 @@ def _build_drug_master_and_remain():
     return payload
 
 
-def _build_drug_used_month_index():
+def _build_drug_used_month_index(refresh=False):
     """
     used_index["YYYY-MM"][norm_name] = used_qty
     นับจาก treatment.medicine โดย parser แบบทนข้อมูลเก่า/เพี้ยน
     """
     cache_key = ("drug_used_month_index_v3",)  # เปลี่ยน version เพื่อกัน cache เก่า
-    cached = _dash_get(cache_key, ttl=120)
-    if cached is not None:
-        return cached
+    if not refresh:
+        cached = _dash_get(cache_key, ttl=120)
+        if cached is not None:
+            return cached
 
     treatments = _unwrap_rows(gas_list_cached("treatment", limit=10000, ttl=60))
     used_index = {}
@@ -2205,18 +4544,13 @@ def dashboard():
     return render_template("dashboard.html")
 
 
-@app.route("/api/dashboard/drug_summary")
-@login_required
-def dashboard_drug_summary():
-    year = request.args.get("year", type=int)
-    month = request.args.get("month", type=int)
-    if not year or not month or month < 1 or month > 12:
-        return jsonify({})
-
+def _build_drug_summary(year, month, refresh=False):
     cache_key = ("drug_summary_v3", year, month)
-    cached = _dash_get(cache_key, ttl=90)
-    if cached is not None:
-        return jsonify(cached)
+    if not refresh:
+        dash_note_period(year, month)
+        cached = _dash_get(cache_key, ttl=90)
+        if cached is not None:
+            return cached
 
     master = _build_drug_master_and_remain()
     used_pack = _build_drug_used_month_index()
@@ -2256,20 +4590,28 @@ def dashboard_drug_summary():
         row["has_used"] = row["used"] > 0
 
     _dash_set(cache_key, result)
-    return jsonify(result)
+    return result
+
 
+@app.route("/api/dashboard/drug_summary")
+@login_required
+def dashboard_drug_summary():
+    year = request.args.get("year", type=int)
+    month = request.args.get("month", type=int)
+    if not year or not month or month < 1 or month > 12:
+        return jsonify({})
+    return jsonify(_build_drug_summary(year, month))
 
 
 
-@app.route("/api/dashboard/monthly_cost")
-@login_required
-def api_dashboard_monthly_cost():
-    year = request.args.get("year", type=int) or th_now().year
 
+def _build_monthly_cost(year, refresh=False):
     cache_key = ("monthly_cost", year)
-    cached = _dash_get(cache_key, ttl=30)
-    if cached is not None:
-        return jsonify(cached)
+    if not refresh:
+        dash_note_period(year)
+        cached = _dash_get(cache_key, ttl=30)
+        if cached is not None:
+            return cached
 
     months = [{"month": i, "drug": 0.0, "supply": 0.0, "other": 0.0, "total": 0.0} for i in range(1, 13)]
 
@@ -2358,7 +4700,14 @@ def api_dashboard_monthly_cost():
 
     payload = {"year": year, "months": months}
     _dash_set(cache_key, payload)
-    return jsonify(payload)
+    return payload
+
+
+@app.route("/api/dashboard/monthly_cost")
+@login_required
+def api_dashboard_monthly_cost():
+    year = request.args.get("year", type=int) or th_now().year
+    return jsonify(_build_monthly_cost(year))
 
 
 
@@ -2554,19 +4903,13 @@ def api_dashboard_symptom_month():
     result = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
     return jsonify([{"name": k, "total": v} for k, v in result])
 
-@app.get("/api/dashboard/month_bundle")
-@login_required
-def api_dashboard_month_bundle():
-    year = request.args.get("year", type=int)
-    month = request.args.get("month", type=int)
-
-    if not year or not month or month < 1 or month > 12:
-        return jsonify({"top5": [], "dept": [], "symptom": []})
-
+def _build_month_bundle(year, month, refresh=False):
     cache_key = ("month_bundle", year, month)
-    cached = _dash_get(cache_key, ttl=45)
-    if cached is not None:
-        return jsonify(cached)
+    if not refresh:
+        dash_note_period(year, month)
+        cached = _dash_get(cache_key, ttl=45)
+        if cached is not None:
+            return cached
 
     treat_res = gas_list("treatment", 10000)
     treatments = _unwrap_rows(treat_res)
@@ -2617,20 +4960,27 @@ def api_dashboard_month_bundle():
     }
 
     _dash_set(cache_key, payload)
-    return jsonify(payload)
+    return payload
 
 
-@app.get("/api/dashboard/year_bundle")
+@app.get("/api/dashboard/month_bundle")
 @login_required
-def api_dashboard_year_bundle():
+def api_dashboard_month_bundle():
     year = request.args.get("year", type=int)
-    if not year:
+    month = request.args.get("month", type=int)
+
+    if not year or not month or month < 1 or month > 12:
         return jsonify({"top5": [], "dept": [], "symptom": []})
+    return jsonify(_build_month_bundle(year, month))
 
+
+def _build_year_bundle(year, refresh=False):
     cache_key = ("year_bundle", year)
-    cached = _dash_get(cache_key, ttl=45)
-    if cached is not None:
-        return jsonify(cached)
+    if not refresh:
+        dash_note_period(year)
+        cached = _dash_get(cache_key, ttl=45)
+        if cached is not None:
+            return cached
 
     treat_res = gas_list("treatment", 10000)
     treatments = _unwrap_rows(treat_res)
@@ -2673,7 +5023,613 @@ def api_dashboard_year_bundle():
     }
 
     _dash_set(cache_key, payload)
-    return jsonify(payload)
+    return payload
+
+
+@app.get("/api/dashboard/year_bundle")
+@login_required
+def api_dashboard_year_bundle():
+    year = request.args.get("year", type=int)
+    if not year:
+        return jsonify({"top5": [], "dept": [], "symptom": []})
+    return jsonify(_build_year_bundle(year))
+
+
+# table ที่ข้อมูล dashboard ทั้งหมดอิงอยู่ (ใช้คิด ETag ของ snapshot)
+_DASH_TABLES = ("treatment", "medicine", "medicine_lot", "other_item", "other_lot", STOCK_LEDGER)
+_DASH_TABLE_SPECS = [("treatment", 10000), ("medicine", 5000), ("medicine_lot", 10000),
+                     ("other_item", 5000), ("other_lot", 10000), (STOCK_LEDGER, _LEDGER_LIMIT)]
+
+
+@app.get("/api/dashboard/snapshot")
+@login_required
+def api_dashboard_snapshot():
+    """
+    รวมทุก section ของ dashboard ใน 1 request (ปี/เดือน)
+    - ETag มาจาก version ของ table ที่เกี่ยวข้อง
+    - If-None-Match ตรง -> 304 ไม่ต้องคำนวณ/serialize ใหม่
+    """
+    now = th_now()
+    year = request.args.get("year", type=int) or now.year
+    month = request.args.get("month", type=int) or now.month
+    if month < 1 or month > 12:
+        return jsonify({"success": False, "message": "month ไม่ถูกต้อง"}), 400
+
+    def etag():
+        return list_etag(_DASH_TABLE_SPECS, year, month, f"g{_DASH_SCHED['gen']}")
+
+    def build():
+        # cache body ที่ serialize แล้วตาม etag -> tab ถัดไป/ผู้ใช้คนอื่นไม่ต้อง dumps ซ้ำ
+        body = _dash_get(("snapshot_body", etag()), ttl=180)
+        if body is None:
+            master = _build_drug_master_and_remain()
+            snap = {
+                "year": year,
+                "month": month,
+                "items": master.get("items", []),
+                "drug_summary": _build_drug_summary(year, month),
+                "month_bundle": _build_month_bundle(year, month),
+                "year_bundle": _build_year_bundle(year),
+                "monthly_cost": _build_monthly_cost(year),
+            }
+            snap["version"] = etag()
+            body = json.dumps(snap, ensure_ascii=False)
+            _dash_set(("snapshot_body", snap["version"]), body)
+        return app.response_class(body, mimetype="application/json")
+
+    return _conditional_json(etag, build, tables=_DASH_TABLES)
+
+
+# ============================================
+# WARM-UP (ดึงตารางหลัก + สร้าง dashboard ล่วงหน้าตอน boot)
+# ============================================
+
+# table -> limit ที่ route ต่าง ๆ เรียกใช้จริง (key ของ _GAS_CACHE คือ (table, limit))
+# ดึงครั้งเดียวด้วย limit ที่ใหญ่สุด แล้ว seed limit ที่เล็กกว่าจากข้อมูลเดียวกัน
+_WARM_TABLES = {
+    "medicine": (5000, 2000, 1000),
+    "medicine_lot": (10000, 5000),
+    "other_item": (5000,),
+    "other_lot": (10000, 5000),
+    "treatment": (10000,),
+    STOCK_LEDGER: (_LEDGER_LIMIT,),
+    "users": (_USER_LIMIT,),
+}
+
+# table -> limit ของ order="desc" (seed จากชุดใหญ่ได้เมื่อดึงมาครบทั้งชีต ไม่ครบค่อยดึงท้ายชีตแยก)
+_WARM_TAILS = {
+    "treatment": (_TREAT_LIMIT, 300),
+}
+
+_WARM_STATE = {"status": "idle", "started_at": None, "finished_at": None, "errors": []}
+
+
+def _warm_table(table, limits):
+    limits = sorted(limits, reverse=True)
+    res = gas_list_raw(table, limits[0])
+    if not (isinstance(res, dict) and res.get("ok")):
+        raise RuntimeError(f"{table}: {res.get('message') if isinstance(res, dict) else res}")
+
+    now = time.time()
+    rows = _unwrap_rows(res)
+    _GAS_CACHE[(table, limits[0])] = (now, res)
+    for lim in limits[1:]:
+        _GAS_CACHE[(table, lim)] = (now, {"ok": True, "data": rows[:lim]})
+    tails = sorted(_WARM_TAILS.get(table, ()), reverse=True)
+    if tails and len(rows) >= limits[0]:
+        # ชีตใหญ่กว่า limit -> ชุด asc เป็นแถวเก่าสุด ใช้แทนท้ายชีตไม่ได้
+        res = gas_list_raw(table, tails[0], "desc")
+        if not (isinstance(res, dict) and res.get("ok")):
+            raise RuntimeError(f"{table} (desc): {res.get('message') if isinstance(res, dict) else res}")
+        rows = _unwrap_rows(res)
+    else:
+        rows = rows[::-1]
+    for lim in tails:
+        _GAS_CACHE[_gas_cache_key(table, lim, "desc")] = (now, {"ok": True, "data": rows[:lim]})
+    return table
+
+
+def warm_up(max_workers=6):
+    """
+    รันครั้งเดียวตอน start (sync):
+    1) ดึง hot tables แบบขนาน
+    2) สร้าง index/aggregate ของ dashboard เดือน/ปีปัจจุบันแบบขนาน
+    ใช้ได้ทั้งใน gunicorn master (--preload -> worker ที่ fork ออกมาได้ cache ไปด้วย) และใน worker
+    """
+    _WARM_STATE.update(status="warming", started_at=time.time(), finished_at=None, errors=[])
+    now = th_now()
+    year, month = now.year, now.month
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = [ex.submit(_warm_table, t, lims) for t, lims in _WARM_TABLES.items()]
+        for f in futures:
+            try:
+                f.result()
+            except Exception as e:
+                _WARM_STATE["errors"].append(str(e))
+
+        # master/used index ถูกใช้ร่วมโดยหลาย aggregate -> สร้างก่อน
+        index_jobs = [ex.submit(_build_drug_master_and_remain), ex.submit(_build_drug_used_month_index),
+                      ex.submit(_search_sync), ex.submit(user_directory)]
+        for f in index_jobs:
+            try:
+                f.result()
+            except Exception as e:
+                _WARM_STATE["errors"].append(str(e))
+
+        agg_jobs = [
+            ex.submit(_build_drug_summary, year, month),
+            ex.submit(_build_month_bundle, year, month),
+            ex.submit(_build_year_bundle, year),
+            ex.submit(_build_monthly_cost, year),
+        ]
+        for f in agg_jobs:
+            try:
+                f.result()
+            except Exception as e:
+                _WARM_STATE["errors"].append(str(e))
+
+    _WARM_STATE.update(status="failed" if _WARM_STATE["errors"] else "ready", finished_at=time.time())
+    took = _WARM_STATE["finished_at"] - _WARM_STATE["started_at"]
+    print(f"warm_up {_WARM_STATE['status']} in {took:.2f}s (pid {os.getpid()})")
+    for err in _WARM_STATE["errors"]:
+        print(f"warm_up error: {err}")
+    return _WARM_STATE
+
+
+def start_warm_up_background():
+    """สำหรับ worker ที่ไม่ได้ preload: warm ใน thread แยก ระหว่างนี้ /healthz/ready ตอบ 503"""
+    if _WARM_STATE["status"] in ("warming", "ready"):
+        return
+    _WARM_STATE["status"] = "warming"
+    Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+def is_ready():
+    # failed = warm ไม่ครบ แต่ยังให้บริการได้ (ดึงชีตสดตามปกติ)
+    return _WARM_STATE["status"] != "warming"
+
+
+@app.get("/healthz/ready")
+def healthz_ready():
+    """readiness probe: 200 เมื่อ worker warm เสร็จแล้ว, 503 ระหว่าง warm"""
+    body = {
+        "ready": is_ready(),
+        "status": _WARM_STATE["status"],
+        "errors": _WARM_STATE["errors"],
+        "pid": os.getpid(),
+    }
+    return jsonify(body), (200 if body["ready"] else 503)
+
+
+# ============================================
+# DASHBOARD SCHEDULER (สร้าง aggregate ล่วงหน้า นอก request)
+# ============================================
+# daemon thread + job registry ทั้งระบบรันจริงแค่ worker เดียว (ตัวที่ถือ flock "dash_scheduler")
+# worker อื่นรอลองถือ lock เป็นระยะ (ถ้าตัวที่รันอยู่ตาย flock หลุดเอง ตัวอื่นรับช่วงต่อ)
+# - รัน job ตามรอบ (interval) เฉพาะเมื่อมีคนเปิด dashboard ตั้งแต่รอบก่อน (ไม่มีคนดู = ไม่ดึง GAS)
+# - หลังมีการเขียนข้อมูล (ใน worker นี้ หรือ worker อื่นแจ้งผ่านไฟล์ dirty.<table> ใน LOCK_DIR)
+#   รอให้ write burst สงบ (debounce) แล้วค่อย build ใหม่ครั้งเดียว
+# request handler ของ worker ที่รัน scheduler อ่านผลที่ build ไว้แล้ว (ไม่หมดอายุตาม TTL ปกติ)
+# worker อื่นใช้ TTL + ล้างเมื่อเขียนเหมือนไม่มี scheduler
+
+_SCHED_JOBS = {}                # name -> {"fn", "interval", "on_write", "when_read", "last_run", "last_error"}
+_SCHED_WAKE = Event()
+_SCHED_DIRTY = {"first": None, "last": None}
+_SCHED_DEBOUNCE = float(os.environ.get("DASH_REFRESH_DEBOUNCE", "3"))
+_SCHED_MAX_DELAY = float(os.environ.get("DASH_REFRESH_MAX_DELAY", "15"))
+_SCHED_LEADER_RETRY = 10.0
+
+# แจ้งข้ามโปรเซสเฉพาะเมื่อเปิด scheduler (มีคนรอรับ)
+_DASH_SIGNAL = os.environ.get("DASH_SCHEDULER", "1") == "1"
+_DASH_SIGNAL_SEEN = {}          # table -> mtime ของไฟล์ dirty ที่จัดการไปแล้ว
+
+# (year, month) / year ที่มีคนเปิดดูล่าสุด -> เวลาที่เปิด
+_DASH_HOT = {}
+_DASH_HOT_TTL = 30 * 60
+
+
+def register_job(name, fn, interval, on_write=False, when_read=False):
+    _SCHED_JOBS[name] = {"fn": fn, "interval": interval, "on_write": on_write, "when_read": when_read,
+                         "last_run": 0.0, "last_error": None}
+
+
+def dash_note_period(year, month=None):
+    """
+    จำว่าช่วงเวลาไหนถูกเปิดดู scheduler จะ refresh ช่วงนั้นต่อไปด้วย
+    เฉพาะปีนี้กับปีก่อน (ปีเก่ากว่านั้นใช้ TTL ปกติ)
+    """
+    cur = th_now().year
+    if year not in (cur, cur - 1):
+        return
+    _DASH_HOT[(year, month)] = time.time()
+
+
+def dash_mark_dirty():
+    now = time.time()
+    if _SCHED_DIRTY["first"] is None:
+        _SCHED_DIRTY["first"] = now
+    _SCHED_DIRTY["last"] = now
+    _SCHED_WAKE.set()
+
+
+def _dash_signal_path(table):
+    return os.path.join(LOCK_DIR, f"dirty.{table}")
+
+
+def _dash_signal(tables):
+    """แจ้ง worker ที่รัน scheduler ว่า tables เปลี่ยน (touch ไฟล์ dirty.<table>)"""
+    if not _DASH_SIGNAL:
+        return
+    for t in tables:
+        path = _dash_signal_path(t)
+        try:
+            os.makedirs(LOCK_DIR, exist_ok=True)
+            with open(path, "a"):
+                pass
+            os.utime(path)
+        except OSError as e:
+            print(f"dash signal {t} error: {e}")
+
+
+def _dash_poll_signals():
+    """ตารางที่ worker อื่นเขียน -> ทิ้ง cache ของตารางนั้นในโปรเซสนี้ (dashboard จะ build ใหม่หลัง debounce)"""
+    for t in _DASH_TABLES:
+        try:
+            mtime = os.path.getmtime(_dash_signal_path(t))
+        except OSError:
+            continue
+        if mtime > _DASH_SIGNAL_SEEN.get(t, 0.0):
+            _DASH_SIGNAL_SEEN[t] = mtime
+            gas_cache_invalidate(t, signal=False)
+
+
+def _hot_periods():
+    now = time.time()
+    cur = th_now()
+    periods = {(cur.year, cur.month), (cur.year, None)}
+    for k, ts in list(_DASH_HOT.items()):
+        if now - ts > _DASH_HOT_TTL:
+            _DASH_HOT.pop(k, None)
+        else:
+            periods.add(k)
+    return periods
+
+
+def _refresh_key(done, key, fn, *args):
+    """build ใหม่แล้ววางทับ ถ้าผลเปลี่ยนจากเดิมให้ขยับ gen (ETag ของ snapshot จะเปลี่ยนตาม)"""
+    old = _dash_peek(key)
+    new = fn(*args, refresh=True)
+    done.add(key)
+    return new != old
+
+
+def _job_dashboard():
+    changed = False
+    done = set()
+    changed |= _refresh_key(done, ("drug_master_remain_v2",), _build_drug_master_and_remain)
+    changed |= _refresh_key(done, ("drug_used_month_index_v3",), _build_drug_used_month_index)
+    periods = _hot_periods()
+    for year, month in sorted(p for p in periods if p[1] is not None):
+        changed |= _refresh_key(done, ("drug_summary_v3", year, month), _build_drug_summary, year, month)
+        changed |= _refresh_key(done, ("month_bundle", year, month), _build_month_bundle, year, month)
+    # ปีของทุกเดือนที่เปิดดูด้วย (snapshot ใช้ year_bundle/monthly_cost)
+    for year in sorted({p[0] for p in periods}):
+        changed |= _refresh_key(done, ("year_bundle", year), _build_year_bundle, year)
+        changed |= _refresh_key(done, ("monthly_cost", year), _build_monthly_cost, year)
+    # ช่วงที่หลุดจาก hot แล้วไม่ได้ refresh อีก -> กลับไปใช้ TTL ปกติ
+    _DASH_SCHED["keys"] = done
+    if changed:
+        _DASH_SCHED["gen"] += 1
+
+
+register_job("dashboard", _job_dashboard, interval=int(os.environ.get("DASH_REFRESH_INTERVAL", "60")),
+             on_write=True, when_read=True)
+
+
+_STOCK_COMPACT_INTERVAL = int(os.environ.get("STOCK_COMPACT_INTERVAL", "300"))
+
+
+def _job_stock_compact():
+    # flock + เวลาที่ทำล่าสุด (mtime ของไฟล์ lock) -> ทั้งระบบทำรอบละครั้ง โปรเซสเดียว
+    # (รวมกรณีสั่งจาก /admin/stock/compact หรือช่วงที่ scheduler ย้าย worker)
+    res = gas_compact_ledger(min_interval=_STOCK_COMPACT_INTERVAL)
+    if not res.get("ok"):
+        raise RuntimeError(res.get("message") or "compact_ledger failed")
+
+
+register_job("stock_compact", _job_stock_compact, interval=_STOCK_COMPACT_INTERVAL)
+
+
+@app.post("/admin/stock/compact")
+@admin_required
+def admin_stock_compact():
+    """สั่ง compaction ledger ทันที"""
+    return jsonify(gas_compact_ledger())
+
+
+def _run_job(name, job):
+    try:
+        job["fn"]()
+        job["last_error"] = None
+    except Exception as e:
+        job["last_error"] = str(e)
+        print(f"scheduler job {name} error: {e}")
+    job["last_run"] = time.time()
+
+
+def _scheduler_loop():
+    # worker อื่นรันอยู่ -> รอ ถือ lock ไว้ตลอดอายุโปรเซส (ไม่ปล่อย)
+    lock = proc_lock("dash_scheduler")
+    while not lock.acquire():
+        time.sleep(_SCHED_LEADER_RETRY)
+    # job นับรอบจากตอนนี้ (warm-up เพิ่ง build ไปแล้ว)
+    for job in _SCHED_JOBS.values():
+        job["last_run"] = time.time()
+    _DASH_SCHED["alive"] = True
+    print(f"dashboard scheduler running in pid {os.getpid()}")
+
+    while True:
+        _SCHED_WAKE.wait(timeout=1.0)
+        _SCHED_WAKE.clear()
+        try:
+            _dash_poll_signals()
+        except Exception as e:
+            print(f"scheduler signal error: {e}")
+        now = time.time()
+
+        # write burst: รอจนเงียบ DEBOUNCE วินาที แต่ไม่เกิน MAX_DELAY นับจากครั้งแรก
+        write_due = False
+        first, last = _SCHED_DIRTY["first"], _SCHED_DIRTY["last"]
+        if first is not None and (now - last >= _SCHED_DEBOUNCE or now - first >= _SCHED_MAX_DELAY):
+            _SCHED_DIRTY["first"] = _SCHED_DIRTY["last"] = None
+            write_due = True
+
+        for name, job in list(_SCHED_JOBS.items()):
+            due = (write_due and job["on_write"]) or now - job["last_run"] >= job["interval"]
+            if not due:
+                continue
+            if job["when_read"] and _DASH_SCHED["read_at"] < job["last_run"]:
+                # ไม่มีใครเปิดดูตั้งแต่รอบก่อน -> ไม่ build แต่ของที่ค้างหลังเขียนต้องทิ้ง (คนถัดไป build ใหม่เอง)
+                if write_due:
+                    _DASH_SCHED["keys"] = set()
+                    _dash_clear()
+                continue
+            _run_job(name, job)
+
+
+_SCHED_STARTED = []
+
+
+def start_dashboard_scheduler():
+    """
+    เริ่ม thread scheduler (ครั้งเดียวต่อโปรเซส) ต้องเรียกใน worker หลัง fork เพราะ thread ไม่ตามไปหลัง fork
+    เรียกได้ทุก worker: ตัวที่ได้ flock ก่อนเป็นผู้รัน ตัวอื่นรอรับช่วงต่อ
+    """
+    if _SCHED_STARTED:
+        return
+    _SCHED_STARTED.append(os.getpid())
+    Thread(target=_scheduler_loop, name="dash-scheduler", daemon=True).start()
+
+# ============================================
+# EXPORT (CSV แบบ stream / XLSX)
+# ============================================
+# สร้างแถวด้วย generator จากข้อมูลที่ cache/index ไว้แล้ว ส่งเป็น chunk ทีละช่วง
+# CSV: เริ่มดาวน์โหลดทันที หน่วยความจำคงที่ / XLSX: ต้องมี openpyxl ไม่ stream แต่หน่วยความจำคงที่ (write-only + spool ลงดิสก์)
+try:
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+except Exception:
+    Workbook = None
+
+_EXPORT_CHUNK_ROWS = 500
+# ข้อความ (ชื่อผู้ป่วย/อาการที่ผู้ใช้พิมพ์) ที่ขึ้นต้นด้วยอักขระเหล่านี้ Excel ตีความเป็นสูตร -> ใส่ ' นำหน้า
+_FORMULA_PREFIX = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _csv_cell(v):
+    if isinstance(v, str) and v.startswith(_FORMULA_PREFIX):
+        return "'" + v
+    return v
+
+
+def _csv_stream(header, rows):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    buf.write("\ufeff")   # BOM ให้ Excel อ่านภาษาไทยถูก
+    w.writerow(header)
+    n = 0
+    for row in rows:
+        w.writerow([_csv_cell(v) for v in row])
+        n += 1
+        if n % _EXPORT_CHUNK_ROWS == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+
+def _xlsx_cell(ws, v):
+    # openpyxl เขียนข้อความที่ขึ้นต้นด้วย = เป็นสูตร -> บังคับเป็นข้อความ (ค่าในเซลล์ไม่เปลี่ยน)
+    if isinstance(v, str) and v.startswith("="):
+        cell = WriteOnlyCell(ws, value=v)
+        cell.data_type = "s"
+        return cell
+    return v
+
+
+def _xlsx_stream(header, rows, title):
+    """
+    XLSX เป็น zip -> ส่งได้หลังเขียนครบทุกแถวเท่านั้น (ไม่ stream ระหว่างอ่านข้อมูลเหมือน CSV)
+    write_only เขียนแถวลงไฟล์ชั่วคราวของ openpyxl และไฟล์ผลลัพธ์ spool ลงดิสก์เมื่อเกิน 8MB
+    หน่วยความจำจึงไม่โตตามจำนวนแถว แต่ byte แรกออกไปหลังประมวลผลครบ
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=title[:31])
+    ws.append(header)
+    for row in rows:
+        ws.append([_xlsx_cell(ws, v) for v in row])
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as f:
+        wb.save(f)
+        f.seek(0)
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _export_response(name, fmt, header, rows):
+    if fmt == "xlsx":
+        if Workbook is None:
+            return "ส่งออก XLSX ต้องติดตั้ง openpyxl (ใช้ .csv แทนได้)", 501
+        body = _xlsx_stream(header, rows, name)
+        mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        body = _csv_stream(header, rows)
+        mimetype = "text/csv; charset=utf-8"
+
+    resp = Response(stream_with_context(body), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f"attachment; filename={name}.{'xlsx' if fmt == 'xlsx' else 'csv'}"
+    resp.headers["Cache-Control"] = "no-store"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+def _export_fmt(fmt):
+    fmt = (fmt or "csv").lower()
+    return fmt if fmt in ("csv", "xlsx") else None
+
+
+def _iter_treatments_in_range(date_from=None, date_to=None):
+    """
+    treatment ดิบในช่วงวันที่ เรียงเก่า -> ใหม่ (ใช้ index ของทะเบียน ไม่ sort ใหม่)
+    ช่วงที่เลยแถวเก่าสุดของ index -> อ่าน archive จากชีต (เก็บเฉพาะแถวที่อยู่ในช่วง แล้ว sort) แล้ว merge กัน
+    """
+    keys, rows = _treatment_index()
+    raw = {str(r.get("id", "")).strip(): r for r in _unwrap_rows(gas_list(*_TREAT_SPEC))}
+
+    lo, hi = 0, len(keys)
+    to_epoch = _day_epoch(date_to, end=True) if date_to else None
+    if to_epoch is not None:
+        lo = bisect_left(keys, (-(to_epoch - 1), float("-inf")))
+    from_epoch = _day_epoch(date_from) if date_from else None
+    if from_epoch is not None:
+        hi = bisect_right(keys, (-from_epoch, float("inf")))
+
+    def window():
+        for i in range(hi - 1, lo - 1, -1):
+            summary = rows[i]
+            r = raw.get(str(summary.get("id", "")).strip())
+            if r is not None:
+                yield keys[i], summary, r
+
+    older = []
+    if hi == len(keys) and _treatment_window_full():
+        offset, before_id = _treatment_archive_start()
+        for pos, r in _treatment_archive_scan(offset, before_id, from_epoch):
+            if pos is None:
+                print(f"export treatments: อ่านแถวที่เก่ากว่า {_TREAT_LIMIT} แถวล่าสุดไม่ได้ ไฟล์จะขาดช่วงเก่า")
+                break
+            key, summary = _treatment_summary(r)
+            epoch = summary["visit_epoch"]
+            if (to_epoch is None or epoch < to_epoch) and (from_epoch is None or epoch >= from_epoch):
+                older.append((key, summary, r))
+        older.sort(key=lambda x: x[0], reverse=True)
+
+    # key = (-epoch, -id) -> เก่าก่อน = key มากก่อน
+    for _, summary, r in heap_merge(older, window(), key=lambda x: x[0], reverse=True):
+        yield summary, r
+
+
+_EXPORT_TREATMENT_HEADER = ["treatment_id", "visit_date", "patient_name", "department", "symptom_group",
+                            "symptom_detail", "item_name", "item_type", "lot_id", "lot_name",
+                            "qty", "price_per_unit", "amount"]
+
+
+def _export_treatment_rows(date_from, date_to):
+    """1 แถวต่อ 1 รายการยา (treatment ที่ไม่ได้จ่ายยาได้ 1 แถว คอลัมน์ยาว่าง)"""
+    lot_price = {}
+    for t in _LOT_TABLES:
+        for lid, lot in lot_rows_by_id(t).items():
+            lot_price[(t, lid)] = (lot.get("lot_name", ""), _to_float(lot.get("price_per_unit"), 0.0))
+
+    for summary, r in _iter_treatments_in_range(date_from, date_to):
+        base = [r.get("id"), summary.get("visit_date_display"), r.get("patient_name", ""),
+                r.get("department", ""), r.get("symptom_group", ""), r.get("symptom_detail", "")]
+        items = _parse_treatment_items(r.get("medicine"))
+        if not items:
+            yield base + ["", "", "", "", "", "", ""]
+            continue
+        for it in items:
+            item_type = str(it.get("type") or it.get("item_type") or "").strip().lower()
+            lot_id = str(it.get("lot_id") or "").strip()
+            lot_name, lot_ppu = lot_price.get((lot_table_for_type(item_type), lot_id), (it.get("lot", ""), 0.0))
+            # ราคาที่บันทึกไว้ตอนจ่ายยา -> ไฟล์ย้อนหลังไม่เปลี่ยนตามราคา lot ปัจจุบัน (ข้อมูลเก่าที่ไม่มีราคาใช้ราคา lot)
+            recorded = it.get("price_per_unit", it.get("price"))
+            price = _to_float(recorded, 0.0) if recorded not in (None, "") else lot_ppu
+            qty = it["qty"]
+            yield base + [it["name"], item_type, lot_id, lot_name or it.get("lot", ""),
+                          qty, price, round(price * qty, 2)]
+
+
+@app.route("/export/treatments.<fmt>")
+@login_required
+def export_treatments(fmt):
+    fmt = _export_fmt(fmt)
+    if not fmt:
+        return "รูปแบบไม่รองรับ", 404
+    date_from = request.args.get("date_from")
+    date_to = request.args.get("date_to")
+    return _export_response("treatments", fmt, _EXPORT_TREATMENT_HEADER,
+                            _export_treatment_rows(date_from, date_to))
+
+
+_EXPORT_LOT_HEADER = ["lot_table", "lot_id", "item_name", "lot_name", "expire_date",
+                      "qty_total", "qty_remain", "price_per_unit", "remain_value"]
+
+
+def _export_lot_rows(include_empty=False):
+    for t in _LOT_TABLES:
+        for lid, lot in lot_rows_by_id(t).items():
+            remain = _to_int(lot.get("qty_remain"), 0)
+            if remain <= 0 and not include_empty:
+                continue
+            price = _to_float(lot.get("price_per_unit"), 0.0)
+            yield [t, lid, lot.get("item_name", ""), lot.get("lot_name", ""), lot.get("expire_date", ""),
+                   _to_int(lot.get("qty_total"), 0), remain, price, round(price * remain, 2)]
+
+
+@app.route("/export/lot_stock.<fmt>")
+@login_required
+def export_lot_stock(fmt):
+    fmt = _export_fmt(fmt)
+    if not fmt:
+        return "รูปแบบไม่รองรับ", 404
+    include_empty = request.args.get("all") == "1"
+    return _export_response("lot_stock", fmt, _EXPORT_LOT_HEADER, _export_lot_rows(include_empty))
+
+
+def _export_cost_rows(date_from, date_to):
+    now = th_now()
+    start = _parse_any_datetime(str(date_from or "")[:10]) or datetime(now.year, 1, 1)
+    end = _parse_any_datetime(str(date_to or "")[:10]) or datetime(now.year, 12, 1)
+    for year in range(start.year, end.year + 1):
+        for m in _build_monthly_cost(year)["months"]:
+            if (year, m["month"]) < (start.year, start.month) or (year, m["month"]) > (end.year, end.month):
+                continue
+            yield [year, m["month"], m["drug"], m["supply"], m["other"], m["total"]]
+
+
+@app.route("/export/monthly_cost.<fmt>")
+@login_required
+def export_monthly_cost(fmt):
+    fmt = _export_fmt(fmt)
+    if not fmt:
+        return "รูปแบบไม่รองรับ", 404
+    return _export_response("monthly_cost", fmt, ["year", "month", "drug", "supply", "other", "total"],
+                            _export_cost_rows(request.args.get("date_from"), request.args.get("date_to")))
+
 
 # ============================================
 # MEDICAL CERTIFICATE
@@ -2740,12 +5696,81 @@ def medical_certificate_form():
     return render_template("certificate_form.html")
 
 
+# ===== ทะเบียนใบรับรองแพทย์: projection เฉพาะคอลัมน์สรุป + แบ่งหน้า =====
+# ไม่ดึงลายเซ็น/ที่อยู่/ประวัติ มาแสดงในตาราง -> รายละเอียดเต็มโหลดตอนเปิดดูผ่าน api_medical_certificate_get
+_CERT_LIMIT = 10000
+_CERT_SUMMARY_FIELDS = ("id", "title", "fullname", "requester_date", "exam_date",
+                        "certificate_no", "created_at")
+_CERT_SORTS = ("created_at", "certificate_no")
+_CERT_IDX = {"src": None, "sorted": {}}
+_CERT_IDX_LOCK = Lock()
+
+
+def _natural_key(value):
+    """'MC-10' > 'MC-9' (เลขในข้อความเทียบแบบตัวเลข)"""
+    return [(0, int(p), "") if p.isdigit() else (1, 0, p.lower())
+            for p in re.split(r"(\d+)", str(value or "").strip()) if p]
+
+
+def _cert_summaries():
+    res = gas_list("medical_certificate", _CERT_LIMIT, fields=_CERT_SUMMARY_FIELDS)
+    if not (isinstance(res, dict) and res.get("ok")):
+        return {}
+    with _CERT_IDX_LOCK:
+        if _CERT_IDX["src"] is res:
+            return _CERT_IDX["sorted"]
+        rows = [r for r in _unwrap_rows(res) if str(r.get("id", "")).strip()]
+        by_created = sorted(rows, key=lambda r: (_visit_epoch(r.get("created_at")), _to_int(r.get("id"), 0)))
+        by_no = sorted(rows, key=lambda r: (_natural_key(r.get("certificate_no")), _to_int(r.get("id"), 0)))
+        _CERT_IDX.update(src=res, sorted={"created_at": by_created, "certificate_no": by_no})
+        return _CERT_IDX["sorted"]
+
+
+def certificate_page(page=1, limit=50, sort="created_at", order="desc", q=""):
+    rows = _cert_summaries().get(sort if sort in _CERT_SORTS else "created_at", [])
+    if order != "asc":
+        rows = rows[::-1]
+
+    q = (q or "").strip().lower()
+    if q:
+        rows = [r for r in rows if any(q in str(r.get(k) or "").lower()
+                                       for k in ("fullname", "certificate_no", "requester_date", "created_at"))]
+
+    total = len(rows)
+    pages = max(1, (total + limit - 1) // limit)
+    page = min(max(1, page), pages)
+    start = (page - 1) * limit
+    return {"items": rows[start:start + limit], "page": page, "pages": pages, "total": total,
+            "limit": limit, "sort": sort, "order": order}
+
+
+def _cert_page_args(args):
+    return {
+        "page": _to_int(args.get("page"), 1),
+        "limit": max(1, min(_to_int(args.get("limit"), 50), 500)),
+        "sort": (args.get("sort") or "created_at").strip(),
+        "order": "asc" if (args.get("order") or "").strip().lower() == "asc" else "desc",
+        "q": args.get("q") or "",
+    }
+
+
 @app.route("/medical_certificate/register")
 @login_required
 def medical_certificate_register():
-    res = gas_list("medical_certificate", 1000)
-    records = res.get("data", []) if res.get("ok") else []
-    return render_template("certificate_register.html", records=records)
+    first = certificate_page(**_cert_page_args(request.args))
+    return render_template("certificate_register.html", records=first["items"], page_info=first)
+
+
+@app.route("/api/medical_certificate/list")
+@login_required
+def api_medical_certificate_list():
+    opts = _cert_page_args(request.args)
+
+    def etag():
+        gas_list("medical_certificate", _CERT_LIMIT, fields=_CERT_SUMMARY_FIELDS)
+        return tables_etag(["medical_certificate"])
+
+    return _conditional_json(etag, lambda: certificate_page(**opts), tables=("medical_certificate",))
 
 
 @app.route("/medical_certificate/edit/<int:id>")
@@ -2827,4 +5852,8 @@ def welcome():
 
 if __name__ == "__main__":
     debug_mode = os.environ.get('FLASK_DEBUG', 'False') == 'True'
+    if os.environ.get('WARMUP_ON_BOOT', '1') == '1':
+        start_warm_up_background()
+    if os.environ.get('DASH_SCHEDULER', '1') == '1':
+        start_dashboard_scheduler()
     app.run(debug=debug_mode, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,69 @@
+"""
+ตรวจทะเบียนการรักษาเมื่อชีต treatment ใหญ่กว่า limit ของ index (10,000 แถว)
+สร้างข้อมูลด้วย generate_data.py ลงไฟล์ของ gas_emulator.py แล้วให้ app อ่านผ่าน emulator
+ต้องได้แถวล่าสุด (ไม่ใช่ 10,000 แถวแรกของชีต) และกด "โหลดเพิ่ม" ไปจนสุดต้องได้ครบทุกแถวในชีต
+
+    python check_registry.py            # 15k visits
+    python check_registry.py 30k
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PORT = 8799
+
+
+def main(visits="15k"):
+    db = os.path.join(tempfile.mkdtemp(prefix="cpf_check_"), "emulator.db")
+    subprocess.run([sys.executable, os.path.join(HERE, "generate_data.py"), "--visits", visits,
+                    "--out", f"emulator:{db}", "--random-seed", "37"], check=True, stdout=subprocess.DEVNULL)
+
+    os.environ["GAS_URL"] = f"http://127.0.0.1:{PORT}/exec"
+    os.environ["WARMUP_ON_BOOT"] = "0"
+    os.environ["DASH_SCHEDULER"] = "0"
+    emu = subprocess.Popen([sys.executable, os.path.join(HERE, "gas_emulator.py"), "--port", str(PORT), "--db", db],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        import requests
+        for _ in range(50):
+            try:
+                requests.get(os.environ["GAS_URL"], params={"action": "list", "table": "users", "limit": 1}, timeout=2)
+                break
+            except requests.RequestException:
+                time.sleep(0.2)
+
+        sys.path.insert(0, HERE)
+        import app as A
+
+        rows = A._unwrap_rows(A.gas_list_raw("treatment", 10 ** 7))
+        newest = max(rows, key=lambda r: (A._visit_epoch(r.get("visit_date")), A._to_int(r.get("id"), 0)))
+        keys, index = A._treatment_index()
+        first = A.treatment_page(limit=1)["items"][0]
+
+        print(f"sheet {len(rows)} rows / index {len(index)} rows")
+        print(f"newest in sheet: id {newest.get('id')} {newest.get('visit_date')}")
+        print(f"first in register: id {first.get('id')} {first.get('visit_date_raw')}")
+
+        seen, cursor, pages = set(), None, 0
+        while True:
+            page = A.treatment_page(cursor=cursor, limit=500)
+            seen.update(str(r.get("id")) for r in page["items"])
+            pages += 1
+            cursor = page["next_cursor"]
+            if not cursor or page.get("truncated"):
+                break
+        print(f"paged {len(seen)} rows in {pages} pages (truncated={bool(page.get('truncated'))})")
+
+        ok = len(rows) > A._TREAT_LIMIT and str(first.get("id")) == str(newest.get("id")) \
+            and seen == {str(r.get("id")) for r in rows}
+        print("OK" if ok else "FAIL")
+        return 0 if ok else 1
+    finally:
+        emu.terminate()
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:2]))
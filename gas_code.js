@@ -12,9 +12,14 @@ const TABLE_HEADERS = {
   medicine_lot: ['id', 'medicine_id', 'lot_name', 'expire_date', 'qty_total', 'qty_remain', 'price_per_lot', 'price_per_unit', 'created_at'],
   treatment: ['id', 'visit_date', 'patient_name', 'department', 'symptom_group', 'symptom_detail', 'medicine', 'allergy', 'allergy_detail', 'occupational_disease', 'doctor_opinion', 'created_at'],
   waste: ['id', 'company', 'amount', 'date', 'time', 'place', 'photo', 'created_at'],
-  medical_certificate: ['id', 'title', 'fullname', 'address', 'disease', 'disease_detail', 'accident', 'accident_detail', 'hospital', 'hospital_detail', 'other_history', 'requester_sign', 'requester_date', 'hospital_name', 'weight', 'height', 'bp', 'pulse', 'body_status', 'body_detail', 'work_result', 'doctor_name', 'created_at']
+  medical_certificate: ['id', 'title', 'fullname', 'address', 'disease', 'disease_detail', 'accident', 'accident_detail', 'hospital', 'hospital_detail', 'other_history', 'requester_sign', 'requester_date', 'hospital_name', 'weight', 'height', 'bp', 'pulse', 'body_status', 'body_detail', 'work_result', 'doctor_name', 'created_at'],
+  // ledger การเคลื่อนไหว stock (ตัดจ่าย/คืน/รับเข้า) 1 แถวต่อ 1 movement
+  stock_ledger: ['id', 'lot_table', 'lot_id', 'delta', 'reason', 'ref', 'created_at']
 };
 
+// table ของ lot ที่ ledger อ้างถึงได้
+const LOT_TABLES = ['medicine_lot', 'other_lot'];
+
 // ============================================
 // HELPER FUNCTIONS
 // ============================================
@@ -27,6 +32,44 @@ function getSheet_(name) {
   return getSpreadsheet_().getSheetByName(name);
 }
 
+// ID ต่อเนื่องไม่ซ้ำแม้แถวท้ายถูกลบ (เก็บเลขล่าสุดไว้ใน Script Properties)
+function nextId_(table, maxIdInSheet) {
+  var props = PropertiesService.getScriptProperties();
+  var key = 'seq_' + table;
+  var last = parseInt(props.getProperty(key)) || 0;
+  var next = Math.max(last, maxIdInSheet) + 1;
+  props.setProperty(key, String(next));
+  return next;
+}
+
+function maxIdOf_(data, idCol) {
+  var maxId = 0;
+  for (var i = 1; i < data.length; i++) {
+    var id = parseInt(data[i][idCol]) || 0;
+    if (id > maxId) maxId = id;
+  }
+  return maxId;
+}
+
+// เพิ่มคอลัมน์ท้ายตารางถ้ายังไม่มี คืน index (0-based)
+function ensureColumn_(sheet, headers, name) {
+  var col = headers.indexOf(name);
+  if (col >= 0) return col;
+  sheet.getRange(1, headers.length + 1).setValue(name);
+  headers.push(name);
+  return headers.length - 1;
+}
+
+function withLock_(fn) {
+  var lock = LockService.getScriptLock();
+  lock.waitLock(30000);
+  try {
+    return fn();
+  } finally {
+    lock.releaseLock();
+  }
+}
+
 function jsonResponse_(data) {
   return ContentService
     .createTextOutput(JSON.stringify(data))
@@ -79,7 +122,11 @@ function doGet(e) {
 
     switch (action) {
       case 'list':
-        return jsonResponse_(listRows_(table, parseInt(e.parameter.limit) || 1000));
+        var tail = e.parameter.tail === '1' || e.parameter.tail === 'true';
+        var order = e.parameter.order || (tail ? 'desc' : 'asc');
+        var fields = e.parameter.fields ? String(e.parameter.fields).split(',') : null;
+        return jsonResponse_(listRows_(table, parseInt(e.parameter.limit) || 1000, order, fields,
+                                       parseInt(e.parameter.offset) || 0));
       case 'get':
         return jsonResponse_(getRowById_(table, e.parameter.id));
       case 'search':
@@ -113,8 +160,22 @@ function doPost(e) {
         return jsonResponse_(updateRow_(table, id, payload));
       case 'delete':
         return jsonResponse_(deleteRow_(table, id));
+      case 'batch_delete':
+        return jsonResponse_(deleteRows_(table, { ids: (payload || {}).ids || [] }));
+      case 'delete_where':
+        return jsonResponse_(deleteRows_(table, payload || {}));
       case 'update_field':
         return jsonResponse_(updateField_(table, id, field, value));
+      case 'update_field_if':
+        return jsonResponse_(updateFieldIf_(table, id, field, body.expected, value));
+      case 'batch_append':
+        return jsonResponse_(appendRows_(table, (payload || {}).rows || []));
+      case 'stock_moves':
+        return jsonResponse_(stockMoves_(table, (payload || {}).rows || []));
+      case 'batch_update_fields':
+        return jsonResponse_(updateFields_(table, (payload || {}).updates || []));
+      case 'compact_ledger':
+        return jsonResponse_(compactLedger_(table));
       default:
         return jsonResponse_({ ok: false, message: 'Unknown action' });
     }
@@ -126,20 +187,57 @@ function doPost(e) {
 // ============================================
 // CRUD FUNCTIONS
 // ============================================
-function listRows_(table, limit) {
+// fields = ส่งกลับเฉพาะคอลัมน์ที่ขอ (projection) ไม่ระบุ = ทุกคอลัมน์
+function pickCols_(headers, fields) {
+  var cols = [];
+  for (var j = 0; j < headers.length; j++) {
+    if (!fields || fields.indexOf(headers[j]) >= 0) cols.push(j);
+  }
+  return cols;
+}
+
+function listRows_(table, limit, order, fields, offset) {
   var sheet = getSheet_(table);
   if (!sheet) return { ok: false, message: 'Sheet not found: ' + table };
+  if (order === 'desc') return listTailRows_(sheet, limit, fields, offset);
 
   var data = sheet.getDataRange().getValues();
   if (data.length <= 1) return { ok: true, data: [] };
 
   var headers = data[0];
+  var cols = pickCols_(headers, fields);
   var rows = [];
 
   for (var i = 1; i < data.length && rows.length < limit; i++) {
     var row = {};
-    for (var j = 0; j < headers.length; j++) {
-      row[headers[j]] = data[i][j];
+    for (var c = 0; c < cols.length; c++) {
+      row[headers[cols[c]]] = data[i][cols[c]];
+    }
+    rows.push(row);
+  }
+
+  return { ok: true, data: rows };
+}
+
+// ใหม่ -> เก่า: อ่านเฉพาะ N แถวท้ายชีต (ไม่อ่านทั้งชีต) ขนาดชีตโตแค่ไหนก็ O(N)
+// offset = ข้าม offset แถวสุดท้ายก่อน (อ่านหน้าถัดไปที่เก่ากว่า)
+function listTailRows_(sheet, limit, fields, offset) {
+  var lastRow = sheet.getLastRow();
+  var lastCol = sheet.getLastColumn();
+  offset = Math.max(0, offset || 0);
+  if (lastRow - 1 - offset <= 0 || lastCol < 1) return { ok: true, data: [] };
+
+  var headers = sheet.getRange(1, 1, 1, lastCol).getValues()[0];
+  var cols = pickCols_(headers, fields);
+  var end = lastRow - offset;
+  var n = Math.min(limit, end - 1);
+  var values = sheet.getRange(end - n + 1, 1, n, lastCol).getValues();
+
+  var rows = [];
+  for (var i = values.length - 1; i >= 0; i--) {
+    var row = {};
+    for (var c = 0; c < cols.length; c++) {
+      row[headers[cols[c]]] = values[i][cols[c]];
     }
     rows.push(row);
   }
@@ -195,23 +293,7 @@ function searchRows_(table, field, value) {
   return { ok: true, data: rows };
 }
 
-function appendRow_(table, payload) {
-  var sheet = getSheet_(table);
-  if (!sheet) return { ok: false, message: 'Sheet not found' };
-
-  var data = sheet.getDataRange().getValues();
-  var headers = data[0] || TABLE_HEADERS[table];
-
-  // หา max ID
-  var maxId = 0;
-  var idCol = headers.indexOf('id');
-  for (var i = 1; i < data.length; i++) {
-    var id = parseInt(data[i][idCol]) || 0;
-    if (id > maxId) maxId = id;
-  }
-  var newId = maxId + 1;
-
-  // สร้างแถวใหม่
+function buildRow_(headers, payload, newId) {
   var newRow = [];
   for (var j = 0; j < headers.length; j++) {
     var col = headers[j];
@@ -223,71 +305,377 @@ function appendRow_(table, payload) {
       newRow.push(payload[col] !== undefined ? payload[col] : '');
     }
   }
-
-  sheet.appendRow(newRow);
-  return { ok: true, id: newId };
+  return newRow;
 }
 
-function updateRow_(table, id, payload) {
+function appendRow_(table, payload) {
   var sheet = getSheet_(table);
   if (!sheet) return { ok: false, message: 'Sheet not found' };
 
-  var data = sheet.getDataRange().getValues();
+  // lock กัน 2 request ได้ ID เดียวกัน
+  return withLock_(function () {
+    var data = sheet.getDataRange().getValues();
+    var headers = data[0] || TABLE_HEADERS[table];
+    var newId = nextId_(table, maxIdOf_(data, headers.indexOf('id')));
+
+    sheet.appendRow(buildRow_(headers, payload, newId));
+    return { ok: true, id: newId };
+  });
+}
+
+// เพิ่มหลายแถวใน 1 request / เขียน 1 range
+function appendRows_(table, payloads) {
+  // ตารางใหม่ (เช่น stock_ledger) สร้างให้อัตโนมัติถ้ายังไม่ได้รัน initSheets
+  var sheet = getSheet_(table) || (TABLE_HEADERS[table] ? getSpreadsheet_().insertSheet(table) : null);
+  if (!sheet) return { ok: false, message: 'Sheet not found' };
+  if (!payloads.length) return { ok: true, ids: [] };
+
+  return withLock_(function () {
+    return writeRows_(sheet, table, sheet.getDataRange().getValues(), payloads);
+  });
+}
+
+// เขียนหลายแถวต่อท้าย (ผู้เรียกถือ lock อยู่แล้ว) data = ค่าทั้งชีตที่อ่านมาแล้ว
+function writeRows_(sheet, table, data, payloads) {
+  if (data.length === 0 || data[0][0] === '') {
+    data = [TABLE_HEADERS[table]];
+    sheet.getRange(1, 1, 1, data[0].length).setValues(data);
+  }
   var headers = data[0];
-  var idCol = headers.indexOf('id');
+  var firstId = nextId_(table, maxIdOf_(data, headers.indexOf('id')));
+  var ids = [];
+  var rows = [];
+  for (var i = 0; i < payloads.length; i++) {
+    ids.push(firstId + i);
+    rows.push(buildRow_(headers, payloads[i] || {}, firstId + i));
+  }
+  // จอง ID ที่เหลือ
+  if (payloads.length > 1) nextId_(table, firstId + payloads.length - 1);
 
-  for (var i = 1; i < data.length; i++) {
-    if (String(data[i][idCol]) === String(id)) {
-      var range = sheet.getRange(i + 1, 1, 1, headers.length);
-      var rowData = range.getValues()[0];
+  sheet.getRange(data.length + 1, 1, rows.length, headers.length).setValues(rows);
+  return { ok: true, ids: ids };
+}
 
-      for (var j = 0; j < headers.length; j++) {
-        if (headers[j] !== 'id' && payload[headers[j]] !== undefined) {
-          rowData[j] = payload[headers[j]];
+// แก้/ลบทีละแถวก็ทำใต้ script lock: compaction เขียน qty_remain ของ lot ตามตำแหน่งแถวใต้ lock เดียวกัน
+function updateRow_(table, id, payload) {
+  var sheet = getSheet_(table);
+  if (!sheet) return { ok: false, message: 'Sheet not found' };
+
+  return withLock_(function () {
+    var data = sheet.getDataRange().getValues();
+    var headers = data[0];
+    var idCol = headers.indexOf('id');
+
+    for (var i = 1; i < data.length; i++) {
+      if (String(data[i][idCol]) === String(id)) {
+        var range = sheet.getRange(i + 1, 1, 1, headers.length);
+        var rowData = range.getValues()[0];
+
+        for (var j = 0; j < headers.length; j++) {
+          if (headers[j] !== 'id' && payload[headers[j]] !== undefined) {
+            rowData[j] = payload[headers[j]];
+          }
         }
-      }
 
-      range.setValues([rowData]);
-      return { ok: true };
+        range.setValues([rowData]);
+        return { ok: true };
+      }
     }
-  }
 
-  return { ok: false, message: 'Not found' };
+    return { ok: false, message: 'Not found' };
+  });
 }
 
 function updateField_(table, id, field, value) {
   var sheet = getSheet_(table);
   if (!sheet) return { ok: false, message: 'Sheet not found' };
 
-  var data = sheet.getDataRange().getValues();
-  var headers = data[0];
-  var idCol = headers.indexOf('id');
-  var fieldCol = headers.indexOf(field);
+  return withLock_(function () {
+    var data = sheet.getDataRange().getValues();
+    var headers = data[0];
+    var idCol = headers.indexOf('id');
+    var fieldCol = headers.indexOf(field);
+
+    for (var i = 1; i < data.length; i++) {
+      if (String(data[i][idCol]) === String(id)) {
+        sheet.getRange(i + 1, fieldCol + 1).setValue(value);
+        return { ok: true };
+      }
+    }
 
-  for (var i = 1; i < data.length; i++) {
-    if (String(data[i][idCol]) === String(id)) {
-      sheet.getRange(i + 1, fieldCol + 1).setValue(value);
-      return { ok: true };
+    return { ok: false, message: 'Not found' };
+  });
+}
+
+// แก้หลาย field หลายแถวใน 1 request: updates = [{id, field, value}, ...]
+// อ่านชีตรอบเดียว เขียนกลับเฉพาะช่วงแถวที่แก้ 1 range ต่อคอลัมน์
+function updateFields_(table, updates) {
+  var sheet = getSheet_(table);
+  if (!sheet) return { ok: false, message: 'Sheet not found' };
+  if (!updates.length) return { ok: true, updated: 0 };
+
+  return withLock_(function () {
+    var data = sheet.getDataRange().getValues();
+    var headers = data[0];
+    var idCol = headers.indexOf('id');
+    var rowOf = {};
+    for (var i = 1; i < data.length; i++) rowOf[String(data[i][idCol]).trim()] = i;
+
+    // ตรวจทั้งชุดก่อน เขียนเมื่อถูกหมด (ไม่เขียนครึ่ง ๆ)
+    var touched = {};
+    for (var k = 0; k < updates.length; k++) {
+      var u = updates[k];
+      var r = rowOf[String(u.id).trim()];
+      var c = headers.indexOf(u.field);
+      if (r === undefined) return { ok: false, message: 'Not found: ' + u.id };
+      if (c < 0 || u.field === 'id') return { ok: false, message: 'Field not found: ' + u.field };
+      data[r][c] = u.value;
+      var span = (touched[c] = touched[c] || { lo: r, hi: r });
+      span.lo = Math.min(span.lo, r);
+      span.hi = Math.max(span.hi, r);
     }
-  }
 
-  return { ok: false, message: 'Not found' };
+    for (var col in touched) {
+      var s = touched[col], vals = [];
+      for (var r2 = s.lo; r2 <= s.hi; r2++) vals.push([data[r2][col]]);
+      sheet.getRange(s.lo + 1, Number(col) + 1, vals.length, 1).setValues(vals);
+    }
+    return { ok: true, updated: updates.length };
+  });
+}
+
+// compare-and-set: เขียนเฉพาะเมื่อค่าปัจจุบันยังเท่ากับ expected
+// ไม่ตรง -> conflict พร้อมค่าปัจจุบัน ให้ฝั่ง Python คำนวณใหม่แล้วลองอีกครั้ง
+function updateFieldIf_(table, id, field, expected, value) {
+  var sheet = getSheet_(table);
+  if (!sheet) return { ok: false, message: 'Sheet not found' };
+
+  return withLock_(function () {
+    var data = sheet.getDataRange().getValues();
+    var headers = data[0];
+    var idCol = headers.indexOf('id');
+    var fieldCol = headers.indexOf(field);
+    if (fieldCol < 0) return { ok: false, message: 'Field not found' };
+
+    for (var i = 1; i < data.length; i++) {
+      if (String(data[i][idCol]) === String(id)) {
+        var current = data[i][fieldCol];
+        if (String(current).trim() !== String(expected).trim()) {
+          return { ok: false, conflict: true, current: current };
+        }
+        sheet.getRange(i + 1, fieldCol + 1).setValue(value);
+        return { ok: true };
+      }
+    }
+
+    return { ok: false, message: 'Not found' };
+  });
 }
 
 function deleteRow_(table, id) {
   var sheet = getSheet_(table);
   if (!sheet) return { ok: false, message: 'Sheet not found' };
 
-  var data = sheet.getDataRange().getValues();
-  var headers = data[0];
-  var idCol = headers.indexOf('id');
+  return withLock_(function () {
+    var data = sheet.getDataRange().getValues();
+    var headers = data[0];
+    var idCol = headers.indexOf('id');
 
-  for (var i = 1; i < data.length; i++) {
-    if (String(data[i][idCol]) === String(id)) {
-      sheet.deleteRow(i + 1);
-      return { ok: true };
+    for (var i = 1; i < data.length; i++) {
+      if (String(data[i][idCol]) === String(id)) {
+        sheet.deleteRow(i + 1);
+        return { ok: true };
+      }
     }
-  }
 
-  return { ok: false, message: 'Not found' };
+    return { ok: false, message: 'Not found' };
+  });
+}
+
+// ลบหลายแถวใน 1 รอบการอ่านชีต (ล่างขึ้นบน ลบช่วงที่ติดกันทีเดียว)
+// opts.ids = [id, ...] หรือ opts.where = { field: value, ... } (ci = ไม่สนตัวพิมพ์)
+function deleteRows_(table, opts) {
+  var sheet = getSheet_(table);
+  if (!sheet) return { ok: false, message: 'Sheet not found' };
+
+  return withLock_(function () {
+    var data = sheet.getDataRange().getValues();
+    if (data.length <= 1) return { ok: true, deleted: 0, ids: [] };
+
+    var headers = data[0];
+    var idCol = headers.indexOf('id');
+    var norm = function (v) {
+      var s = String(v === null || v === undefined ? '' : v).trim();
+      return opts.ci ? s.toLowerCase() : s;
+    };
+
+    var idSet = null;
+    if (opts.ids) {
+      idSet = {};
+      opts.ids.forEach(function (x) { idSet[String(x).trim()] = true; });
+    }
+
+    var conds = [];
+    var where = opts.where || {};
+    for (var f in where) {
+      var col = headers.indexOf(f);
+      if (col < 0) return { ok: false, message: 'Unknown field: ' + f };
+      conds.push({ col: col, value: norm(where[f]) });
+    }
+    if (!idSet && !conds.length) return { ok: false, message: 'Missing ids or where' };
+
+    var hit = [], ids = [];
+    for (var i = 1; i < data.length; i++) {
+      if (idSet && !idSet[String(data[i][idCol]).trim()]) continue;
+      var ok = true;
+      for (var c = 0; c < conds.length && ok; c++) {
+        ok = norm(data[i][conds[c].col]) === conds[c].value;
+      }
+      if (!ok) continue;
+      hit.push(i + 1);
+      ids.push(data[i][idCol]);
+    }
+    if (!hit.length) return { ok: true, deleted: 0, ids: [] };
+
+    // ลบทุกแถวที่ไม่ freeze ไม่ได้ -> เติมแถวว่างท้ายชีตก่อน
+    if (hit.length === data.length - 1) sheet.insertRowAfter(sheet.getMaxRows());
+
+    var end = hit.length - 1;
+    while (end >= 0) {
+      var start = end;
+      while (start > 0 && hit[start - 1] === hit[start] - 1) start--;
+      sheet.deleteRows(hit[start], end - start + 1);
+      end = start - 1;
+    }
+    return { ok: true, deleted: hit.length, ids: ids };
+  });
+}
+
+// ============================================
+// STOCK LEDGER
+// ============================================
+// ตรวจคงเหลือ + append movement ใน lock เดียวกัน (ทุก worker/ทุกเครื่องเห็นค่าเดียวกัน)
+// คงเหลือจริง = qty_remain ของ lot + delta ใน ledger ที่ id > ledger_seq ของ lot
+// lot ใดติดลบหลังรวม batch -> ไม่เขียนเลยทั้งชุด คืน short พร้อมคงเหลือปัจจุบัน
+function stockMoves_(table, rows) {
+  table = table || 'stock_ledger';
+  var ledger = getSheet_(table) || getSpreadsheet_().insertSheet(table);
+  if (!rows.length) return { ok: true, ids: [] };
+
+  return withLock_(function () {
+    var need = {};
+    for (var i = 0; i < rows.length; i++) {
+      var k = String(rows[i].lot_table) + '|' + String(rows[i].lot_id).trim();
+      need[k] = (need[k] || 0) + (Number(rows[i].delta) || 0);
+    }
+
+    // base + seq ของ lot ที่ถูกอ้างถึง (อ่านชีต lot ละ 1 ครั้ง)
+    var lots = {};
+    for (var key in need) {
+      var t = key.split('|')[0];
+      if (LOT_TABLES.indexOf(t) < 0) return { ok: false, not_found: true, lot_table: t, message: 'Unknown lot table: ' + t };
+      if (lots[t]) continue;
+      lots[t] = {};
+      var sheet = getSheet_(t);
+      if (!sheet) continue;
+      var rowsT = sheet.getDataRange().getValues();
+      var h = rowsT[0] || [];
+      var cId = h.indexOf('id'), cRemain = h.indexOf('qty_remain'), cSeq = h.indexOf('ledger_seq');
+      for (var r = 1; r < rowsT.length; r++) {
+        lots[t][String(rowsT[r][cId]).trim()] = {
+          remain: Number(rowsT[r][cRemain]) || 0,
+          seq: cSeq >= 0 ? (parseInt(rowsT[r][cSeq]) || 0) : 0
+        };
+      }
+    }
+    for (var key2 in need) {
+      var parts = key2.split('|');
+      if (!lots[parts[0]][parts[1]]) {
+        return { ok: false, not_found: true, lot_table: parts[0], lot_id: parts[1], message: 'Not found: ' + parts[1] };
+      }
+    }
+
+    // movement ที่ยังไม่ถูก compact
+    var data = ledger.getDataRange().getValues();
+    if (data.length > 1) {
+      var lh = data[0];
+      var lId = lh.indexOf('id'), lTable = lh.indexOf('lot_table'), lLot = lh.indexOf('lot_id'), lDelta = lh.indexOf('delta');
+      for (var j = 1; j < data.length; j++) {
+        var lot = (lots[String(data[j][lTable])] || {})[String(data[j][lLot]).trim()];
+        if (lot && (parseInt(data[j][lId]) || 0) > lot.seq) lot.remain += Number(data[j][lDelta]) || 0;
+      }
+    }
+
+    for (var key3 in need) {
+      var p = key3.split('|');
+      var cur = lots[p[0]][p[1]].remain;
+      if (need[key3] < 0 && cur + need[key3] < 0) {
+        return { ok: false, short: true, lot_table: p[0], lot_id: p[1], remain: cur,
+                 message: 'Insufficient stock: ' + p[1] };
+      }
+    }
+    return writeRows_(ledger, table, data, rows);
+  });
+}
+
+// รวม movement ใน ledger เข้า qty_remain ของ lot แล้วลบแถว ledger ที่รวมแล้ว
+// ทำใต้ script lock (append/แก้/ลบแถวก็ใช้ lock เดียวกัน) จึงไม่มี movement หลุด และไม่เขียนทับการแก้ lot
+// lot เก็บ ledger_seq = id สูงสุดของ ledger ที่รวมแล้ว: รวมเฉพาะแถวที่ id > ledger_seq
+// (รอบก่อนเขียน lot แล้วแต่ล้าง ledger ไม่ทัน -> รันซ้ำไม่บวกซ้ำ) ฝั่ง Python ใช้กันนับซ้ำเช่นกัน
+function compactLedger_(table) {
+  var ledger = getSheet_(table || 'stock_ledger');
+  if (!ledger) return { ok: true, lots: 0, rows: 0 };
+
+  return withLock_(function () {
+    var data = ledger.getDataRange().getValues();
+    if (data.length <= 1) return { ok: true, lots: 0, rows: 0 };
+
+    var h = data[0];
+    var cId = h.indexOf('id'), cTable = h.indexOf('lot_table'), cLot = h.indexOf('lot_id'), cDelta = h.indexOf('delta');
+
+    // lot_table -> lot_id -> [[id, delta], ...]
+    var moves = {};
+    for (var i = 1; i < data.length; i++) {
+      var t = String(data[i][cTable]);
+      if (LOT_TABLES.indexOf(t) < 0) continue;
+      var box = (moves[t] = moves[t] || {});
+      var lotId = String(data[i][cLot]);
+      (box[lotId] = box[lotId] || []).push([parseInt(data[i][cId]) || 0, Number(data[i][cDelta]) || 0]);
+    }
+
+    var lots = 0;
+    for (var t in moves) {
+      var sheet = getSheet_(t);
+      if (!sheet) continue;
+      var rows = sheet.getDataRange().getValues();
+      if (rows.length <= 1) continue;
+      var headers = rows[0];
+      var idCol = headers.indexOf('id');
+      var remainCol = headers.indexOf('qty_remain');
+      var seqCol = ensureColumn_(sheet, headers, 'ledger_seq');
+
+      for (var r = 1; r < rows.length; r++) {
+        var mv = moves[t][String(rows[r][idCol])];
+        if (!mv) continue;
+        var seq = parseInt(rows[r][seqCol]) || 0;
+        var delta = 0, top = seq;
+        for (var k = 0; k < mv.length; k++) {
+          if (mv[k][0] > seq) {
+            delta += mv[k][1];
+            top = Math.max(top, mv[k][0]);
+          }
+        }
+        if (top === seq) continue;
+        // เขียนเฉพาะช่องของ lot ที่เปลี่ยน
+        sheet.getRange(r + 1, remainCol + 1).setValue((Number(rows[r][remainCol]) || 0) + delta);
+        sheet.getRange(r + 1, seqCol + 1).setValue(top);
+        lots++;
+      }
+    }
+
+    // clearContent แทน deleteRows (ลบทุกแถวที่ไม่ freeze ไม่ได้) แถวว่างจะถูก append ทับ
+    var n = data.length - 1;
+    ledger.getRange(2, 1, n, h.length).clearContent();
+    return { ok: true, lots: lots, rows: n };
+  });
 }
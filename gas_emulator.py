@@ -0,0 +1,842 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+import threading
+
+from flask import Flask, request, jsonify, Response
+
+# เซิร์ฟเวอร์จำลอง Google Apps Script (gas_code.js) สำหรับพัฒนา/ทดสอบ/benchmark แบบไม่ต่อเน็ต
+# - protocol เดียวกับ doGet/doPost: list/get/search + append/update/update_field/delete + batch ต่าง ๆ + stock_moves
+# - ตารางเก็บใน memory (ค่าเริ่มต้น) หรือ SQLite (--db) เพื่อให้ข้อมูลอยู่ข้ามการรีสตาร์ต
+# - ปรับ latency / jitter / ค่าใช้จ่ายต่อแถว / error ที่สุ่มใส่ได้ ทั้งตอนสตาร์ตและตอนรัน (POST /_emulator)
+# ใช้: python gas_emulator.py --port 8765 --latency-ms 300 --jitter-ms 200 --error-rate 0.02
+#      แล้วตั้ง GAS_URL=http://127.0.0.1:8765/exec ให้ app.py / migrate_data.py / verify_data.py
+
+# Headers ตาม TABLE_HEADERS ของ gas_code.js + คอลัมน์ที่ชีตจริงเพิ่มเองภายหลัง (item_name, ledger_seq, other_*)
+TABLE_HEADERS = {
+    'users': ['id', 'username', 'password', 'name', 'dept', 'role', 'created_at'],
+    'medicine': ['id', 'type', 'group_name', 'name', 'benefit', 'min_qty', 'qty', 'expire_date', 'used', 'created_at'],
+    'medicine_lot': ['id', 'medicine_id', 'lot_name', 'expire_date', 'qty_total', 'qty_remain', 'price_per_lot',
+                     'price_per_unit', 'created_at', 'item_name', 'ledger_seq'],
+    'treatment': ['id', 'visit_date', 'patient_name', 'department', 'symptom_group', 'symptom_detail', 'medicine',
+                  'allergy', 'allergy_detail', 'occupational_disease', 'doctor_opinion', 'created_at'],
+    'waste': ['id', 'company', 'amount', 'date', 'time', 'place', 'photo', 'created_at'],
+    'medical_certificate': ['id', 'title', 'fullname', 'address', 'disease', 'disease_detail', 'accident',
+                            'accident_detail', 'hospital', 'hospital_detail', 'other_history', 'requester_sign',
+                            'requester_date', 'hospital_name', 'weight', 'height', 'bp', 'pulse', 'body_status',
+                            'body_detail', 'work_result', 'doctor_name', 'created_at'],
+    'stock_ledger': ['id', 'lot_table', 'lot_id', 'delta', 'reason', 'ref', 'created_at'],
+    'other_item': ['id', 'type', 'group_name', 'name', 'benefit', 'min_qty', 'qty', 'expire_date', 'used', 'created_at'],
+    'other_lot': ['id', 'item_name', 'lot_name', 'expire_date', 'qty_total', 'qty_remain', 'price_per_lot',
+                  'price_per_unit', 'created_at', 'ledger_seq'],
+}
+LOT_TABLES = ['medicine_lot', 'other_lot']
+# action ที่ gas_code.js ทำใต้ script lock
+LOCKED_ACTIONS = {'append', 'batch_append', 'update', 'update_field', 'batch_update_fields', 'update_field_if',
+                  'delete', 'batch_delete', 'delete_where', 'compact_ledger', 'stock_moves'}
+# action ที่ app.py เรียกแต่ gas_code.js ที่ deploy อยู่ยังไม่มี (--strict = ตอบ Unknown action เหมือนของจริง)
+EXTRA_ACTIONS = {'batch_get'}
+
+# error ที่สุ่มใส่ได้ (--errors): 500/429 = HTTP error / sheets, lock = 200 + ok:false แบบ Apps Script
+# timeout = ค้างนานเกิน timeout ของ client / lost = ทำจริงแล้วแต่ตอบ 500 (ทดสอบ retry ซ้ำ)
+ERROR_KINDS = ('500', '429', 'sheets', 'lock', 'timeout', 'lost')
+ERROR_MESSAGES = {
+    'sheets': 'Exception: Service Spreadsheets failed while accessing document with id emulator.',
+    'lock': 'Exception: Lock timeout: another process was holding the lock for too long.',
+}
+
+CONFIG = {
+    'latency_ms': float(os.getenv('GAS_EMU_LATENCY_MS', '0')),
+    'jitter_ms': float(os.getenv('GAS_EMU_JITTER_MS', '0')),
+    'row_cost_us': float(os.getenv('GAS_EMU_ROW_COST_US', '0')),
+    'lock_ms': float(os.getenv('GAS_EMU_LOCK_MS', '0')),
+    'error_rate': float(os.getenv('GAS_EMU_ERROR_RATE', '0')),
+    'errors': [e for e in os.getenv('GAS_EMU_ERRORS', '500,sheets').split(',') if e],
+    'error_actions': [a for a in os.getenv('GAS_EMU_ERROR_ACTIONS', '').split(',') if a],
+    'timeout_s': float(os.getenv('GAS_EMU_TIMEOUT_S', '35')),
+    'strict': os.getenv('GAS_EMU_STRICT', '0') == '1',
+}
+
+_NUMBER = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?")
+_LOCK = threading.RLock()
+_RNG = random.Random()
+STATS = {'calls': {}, 'errors': {}, 'started': time.time()}
+
+
+# ============================================
+# STORE (ชีต = headers + แถวเป็น list เรียงตามคอลัมน์)
+# ============================================
+def _cell(v):
+    """ค่าที่เขียนลงช่อง: ชีตแปลงข้อความที่เป็นตัวเลขเป็น number / null -> ช่องว่าง / object -> ข้อความ"""
+    if v is None:
+        return ''
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, float):
+        return int(v) if v.is_integer() else v
+    if isinstance(v, (dict, list)):
+        return json.dumps(v, ensure_ascii=False)
+    if isinstance(v, str) and _NUMBER.fullmatch(v.strip()):
+        f = float(v)
+        return int(f) if f.is_integer() else f
+    return v
+
+
+def _js_str(v):
+    """String(x) ของ JavaScript (5.0 -> "5", true -> "true", null -> "null")"""
+    if v is None:
+        return 'null'
+    if isinstance(v, bool):
+        return 'true' if v else 'false'
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+
+def _parse_int(v):
+    """parseInt(x) || 0"""
+    m = re.match(r"\s*([-+]?\d+)", _js_str(v))
+    return int(m.group(1)) if m else 0
+
+
+def _to_number(v):
+    """Number(x) || 0"""
+    if isinstance(v, bool):
+        return int(v)
+    try:
+        f = float(str(v).strip() or 0)
+    except ValueError:
+        return 0
+    return int(f) if f.is_integer() else f
+
+
+def _iso_now():
+    # new Date().toISOString()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (now.microsecond // 1000)
+
+
+class Row(list):
+    """แถวของชีต + key ที่ใช้บันทึกลง SQLite (เพิ่มขึ้นตามลำดับที่เพิ่มแถว ไม่เลื่อนเมื่อแถวอื่นถูกลบ)"""
+    __slots__ = ('key',)
+
+    def __init__(self, values=(), key=-1):
+        super().__init__(values)
+        self.key = key
+
+
+class Sheet:
+    def __init__(self, name, headers, rows=None, seq=0):
+        self.name = name
+        self.headers = list(headers)
+        self.rows = rows or []
+        # seq >= id ทุกแถวเสมอ (ตั้งตอนสร้าง + set_cell คอลัมน์ id) -> next_id ไม่ต้องอ่านทั้งคอลัมน์
+        c = self.col('id')
+        self.seq = max([seq] + ([_parse_int(self.cell(r, c)) for r in self.rows] if c >= 0 else []))
+
+    def record(self, row):
+        return {h: (row[j] if j < len(row) else '') for j, h in enumerate(self.headers)}
+
+    def col(self, name):
+        return self.headers.index(name) if name in self.headers else -1
+
+    def ensure_column(self, name):
+        if name not in self.headers:
+            self.headers.append(name)
+        return self.headers.index(name)
+
+    def cell(self, row, col):
+        return row[col] if col < len(row) else ''
+
+    def set_cell(self, row, col, value):
+        while len(row) <= col:
+            row.append('')
+        row[col] = _cell(value)
+        if col == self.col('id'):
+            self.seq = max(self.seq, _parse_int(row[col]))
+
+    def find(self, row_id):
+        c = self.col('id')
+        for i, row in enumerate(self.rows):
+            if _js_str(self.cell(row, c)) == _js_str(row_id):
+                return i
+        return -1
+
+    def next_id(self):
+        # = max(id) + 1 แบบ getMaxId_ (seq ไม่ลดเมื่อลบแถว)
+        self.seq += 1
+        return self.seq
+
+
+class Store:
+    """
+    ชีตทั้งหมด + บันทึกลง SQLite (ถ้าระบุ path) เรียกใต้ _LOCK เท่านั้น
+    งานปกติบันทึกเฉพาะแถวที่เปลี่ยน (insert/update/delete ตาม Row.key = pos) ไม่เขียนทั้งชีตใหม่
+    """
+
+    def __init__(self, path=None):
+        self.sheets = {}
+        self.last_key = {}      # ชีต -> Row.key ล่าสุดที่ใช้ไป
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS emu_sheet (name TEXT PRIMARY KEY, headers TEXT, seq INTEGER)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS emu_row (sheet TEXT, pos INTEGER, data TEXT, PRIMARY KEY (sheet, pos))")
+            for name, headers, seq in self.conn.execute("SELECT name, headers, seq FROM emu_sheet"):
+                rows = [Row(json.loads(d), pos) for pos, d in self.conn.execute(
+                    "SELECT pos, data FROM emu_row WHERE sheet = ? ORDER BY pos", (name,))]
+                self.sheets[name] = Sheet(name, json.loads(headers), rows, seq or 0)
+                self.last_key[name] = rows[-1].key if rows else -1
+        for name, headers in TABLE_HEADERS.items():
+            if name not in self.sheets:
+                self.sheets[name] = Sheet(name, headers)
+                self.save(self.sheets[name])
+
+    def get(self, name):
+        return self.sheets.get(name)
+
+    def _save_meta(self, sheet):
+        # headers (คอลัมน์ที่เพิ่มเอง) กับ seq เปลี่ยนได้ทุกครั้งที่เขียน
+        self.conn.execute("INSERT OR REPLACE INTO emu_sheet (name, headers, seq) VALUES (?, ?, ?)",
+                          (sheet.name, json.dumps(sheet.headers), sheet.seq))
+
+    def save(self, sheet):
+        """เขียนทั้งชีตใหม่ (สร้างชีต/reset) งานปกติใช้ insert/update/delete"""
+        for i, r in enumerate(sheet.rows):
+            r.key = i
+        self.last_key[sheet.name] = len(sheet.rows) - 1
+        if not self.conn:
+            return
+        with self.conn:
+            self._save_meta(sheet)
+            self.conn.execute("DELETE FROM emu_row WHERE sheet = ?", (sheet.name,))
+            self.conn.executemany("INSERT INTO emu_row (sheet, pos, data) VALUES (?, ?, ?)",
+                                  [(sheet.name, r.key, json.dumps(r, ensure_ascii=False)) for r in sheet.rows])
+
+    def insert(self, sheet, rows):
+        """แถวที่เพิ่งต่อท้าย sheet.rows"""
+        key = self.last_key.get(sheet.name, -1)
+        for r in rows:
+            key += 1
+            r.key = key
+        self.last_key[sheet.name] = key
+        if not self.conn:
+            return
+        with self.conn:
+            self._save_meta(sheet)
+            self.conn.executemany("INSERT INTO emu_row (sheet, pos, data) VALUES (?, ?, ?)",
+                                  [(sheet.name, r.key, json.dumps(r, ensure_ascii=False)) for r in rows])
+
+    def update(self, sheet, rows):
+        """แถวที่แก้ค่าแล้ว (อยู่ใน sheet.rows)"""
+        if not self.conn:
+            return
+        with self.conn:
+            self._save_meta(sheet)
+            self.conn.executemany("UPDATE emu_row SET data = ? WHERE sheet = ? AND pos = ?",
+                                  [(json.dumps(r, ensure_ascii=False), sheet.name, r.key) for r in rows])
+
+    def delete(self, sheet, rows=None):
+        """แถวที่เอาออกจาก sheet.rows แล้ว / rows=None = ทั้งชีต"""
+        if not self.conn:
+            return
+        with self.conn:
+            self._save_meta(sheet)
+            if rows is None:
+                self.conn.execute("DELETE FROM emu_row WHERE sheet = ?", (sheet.name,))
+            else:
+                self.conn.executemany("DELETE FROM emu_row WHERE sheet = ? AND pos = ?",
+                                      [(sheet.name, r.key) for r in rows])
+
+    def reset(self):
+        for name in list(self.sheets):
+            s = self.sheets[name]
+            s.rows, s.seq = [], 0
+            s.headers = list(TABLE_HEADERS.get(name, s.headers))
+            self.save(s)
+
+    def load(self, table, rows):
+        """ใส่แถวพร้อม id เดิม (seed จาก offline.db / dump / ชีตจริง)"""
+        s = self.sheets.get(table) or self.sheets.setdefault(table, Sheet(table, ['id']))
+        added = []
+        for r in rows:
+            for k in r:
+                s.ensure_column(k)
+            row = Row([''] * len(s.headers))
+            for k, v in r.items():
+                row[s.col(k)] = _cell(v)
+            added.append(row)
+        s.rows.extend(added)
+        c = s.col('id')
+        s.seq = max([s.seq] + [_parse_int(s.cell(r, c)) for r in s.rows])
+        self.insert(s, added)
+        return len(rows)
+
+
+STORE = Store()
+
+
+# ============================================
+# ACTIONS (ตรรกะเดียวกับ gas_code.js แต่ละฟังก์ชัน)
+# ============================================
+# แต่ละฟังก์ชันคืน (ผลลัพธ์, จำนวนแถวที่ต้องอ่าน) -> ใช้คิด latency ตามขนาดชีต
+def list_rows(table, limit, order, fields, offset=0):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found: ' + table}, 0
+    cols = [h for h in s.headers if not fields or h in fields]
+    if order == 'desc':
+        end = len(s.rows) - max(0, offset)
+        picked = s.rows[max(0, end - limit):max(0, end)][::-1]
+    else:
+        picked = s.rows[:limit]
+    data = [{h: v for h, v in s.record(r).items() if h in cols} for r in picked]
+    return {'ok': True, 'data': data}, (len(picked) if order == 'desc' else len(s.rows))
+
+
+def get_row_by_id(table, row_id):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    i = s.find(row_id)
+    if i < 0:
+        return {'ok': False, 'message': 'Not found'}, len(s.rows)
+    return {'ok': True, 'data': s.record(s.rows[i])}, len(s.rows)
+
+
+def search_rows(table, field, value):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    if not s.rows:
+        return {'ok': True, 'data': []}, 0
+    c = s.col(field)
+    if c < 0:
+        return {'ok': False, 'message': 'Field not found'}, 0
+    want = _js_str(value).strip()
+    return {'ok': True, 'data': [s.record(r) for r in s.rows if _js_str(s.cell(r, c)).strip() == want]}, len(s.rows)
+
+
+def _build_row(s, payload, new_id):
+    if not CONFIG['strict']:
+        # ชีตจริงบางตารางมีคอลัมน์ที่เพิ่มเองภายหลัง -> เพิ่มให้แทนการทิ้งค่าเงียบ ๆ (--strict = ทิ้งเหมือน buildRow_)
+        for k in payload:
+            s.ensure_column(k)
+    row = Row()
+    for h in s.headers:
+        if h == 'id':
+            row.append(new_id)
+        elif h == 'created_at' and not payload.get(h):
+            row.append(_iso_now())
+        else:
+            row.append(_cell(payload.get(h, '')))
+    return row
+
+
+def append_row(table, payload):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    new_id = s.next_id()
+    row = _build_row(s, payload or {}, new_id)
+    s.rows.append(row)
+    STORE.insert(s, [row])
+    return {'ok': True, 'id': new_id}, len(s.rows)
+
+
+def append_rows(table, payloads):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    if not payloads:
+        return {'ok': True, 'ids': []}, 0
+    # อ่าน id สูงสุดรอบเดียวแล้วจอง id ต่อเนื่องทั้งชุด เหมือน appendRows_
+    first = s.next_id()
+    ids = list(range(first, first + len(payloads)))
+    s.seq = ids[-1]
+    added = [_build_row(s, p or {}, new_id) for new_id, p in zip(ids, payloads)]
+    s.rows.extend(added)
+    STORE.insert(s, added)
+    return {'ok': True, 'ids': ids}, len(s.rows)
+
+
+def batch_get(table, ids):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    want = {_js_str(x).strip() for x in ids}
+    c = s.col('id')
+    return {'ok': True, 'data': [s.record(r) for r in s.rows if _js_str(s.cell(r, c)).strip() in want]}, len(s.rows)
+
+
+def update_row(table, row_id, payload):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    payload = payload or {}
+    i = s.find(row_id)
+    if i < 0:
+        return {'ok': False, 'message': 'Not found'}, len(s.rows)
+    if not CONFIG['strict']:
+        for k in payload:
+            s.ensure_column(k)
+    for h in s.headers:
+        if h != 'id' and h in payload:
+            s.set_cell(s.rows[i], s.col(h), payload[h])
+    STORE.update(s, [s.rows[i]])
+    return {'ok': True}, len(s.rows)
+
+
+def update_field(table, row_id, field, value):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    i = s.find(row_id)
+    if i < 0:
+        return {'ok': False, 'message': 'Not found'}, len(s.rows)
+    c = s.col(field)
+    if c < 0:
+        # getRange(row, 0) ของ Apps Script
+        return {'ok': False, 'message': 'Exception: The starting column of the range is too small.'}, len(s.rows)
+    s.set_cell(s.rows[i], c, value)
+    STORE.update(s, [s.rows[i]])
+    return {'ok': True}, len(s.rows)
+
+
+def update_fields(table, updates):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    if not updates:
+        return {'ok': True, 'updated': 0}, 0
+    c_id = s.col('id')
+    row_of = {_js_str(s.cell(r, c_id)).strip(): r for r in s.rows}
+    # ตรวจทั้งชุดก่อน เขียนเมื่อถูกหมด
+    plan = []
+    for u in updates:
+        r = row_of.get(_js_str(u.get('id')).strip())
+        c = s.col(u.get('field'))
+        if r is None:
+            return {'ok': False, 'message': 'Not found: ' + _js_str(u.get('id'))}, len(s.rows)
+        if c < 0 or u.get('field') == 'id':
+            return {'ok': False, 'message': 'Field not found: ' + _js_str(u.get('field'))}, len(s.rows)
+        plan.append((r, c, u.get('value')))
+    for r, c, v in plan:
+        s.set_cell(r, c, v)
+    STORE.update(s, list({id(r): r for r, _, _ in plan}.values()))
+    return {'ok': True, 'updated': len(updates)}, len(s.rows)
+
+
+def update_field_if(table, row_id, field, expected, value):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    c = s.col(field)
+    if c < 0:
+        return {'ok': False, 'message': 'Field not found'}, len(s.rows)
+    i = s.find(row_id)
+    if i < 0:
+        return {'ok': False, 'message': 'Not found'}, len(s.rows)
+    current = s.cell(s.rows[i], c)
+    if _js_str(current).strip() != _js_str(expected).strip():
+        return {'ok': False, 'conflict': True, 'current': current}, len(s.rows)
+    s.set_cell(s.rows[i], c, value)
+    STORE.update(s, [s.rows[i]])
+    return {'ok': True}, len(s.rows)
+
+
+def delete_row(table, row_id):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    i = s.find(row_id)
+    if i < 0:
+        return {'ok': False, 'message': 'Not found'}, len(s.rows)
+    STORE.delete(s, [s.rows.pop(i)])
+    return {'ok': True}, len(s.rows)
+
+
+def delete_rows(table, opts):
+    s = STORE.get(table)
+    if not s:
+        return {'ok': False, 'message': 'Sheet not found'}, 0
+    if not s.rows:
+        return {'ok': True, 'deleted': 0, 'ids': []}, 0
+
+    def norm(v):
+        t = ('' if v is None else _js_str(v)).strip()
+        return t.lower() if opts.get('ci') else t
+
+    id_set = None
+    if opts.get('ids') is not None:
+        id_set = {_js_str(x).strip() for x in opts['ids']}
+    conds = []
+    for f, v in (opts.get('where') or {}).items():
+        c = s.col(f)
+        if c < 0:
+            return {'ok': False, 'message': 'Unknown field: ' + f}, len(s.rows)
+        conds.append((c, norm(v)))
+    if id_set is None and not conds:
+        return {'ok': False, 'message': 'Missing ids or where'}, len(s.rows)
+
+    c_id = s.col('id')
+    keep, gone, ids = [], [], []
+    for r in s.rows:
+        hit = (id_set is None or _js_str(s.cell(r, c_id)).strip() in id_set) and \
+              all(norm(s.cell(r, c)) == v for c, v in conds)
+        if hit:
+            ids.append(s.cell(r, c_id))
+            gone.append(r)
+        else:
+            keep.append(r)
+    n = len(s.rows)
+    if ids:
+        s.rows = keep
+        STORE.delete(s, gone)
+    return {'ok': True, 'deleted': len(ids), 'ids': ids}, n
+
+
+def compact_ledger(table):
+    ledger = STORE.get(table or 'stock_ledger')
+    if not ledger or not ledger.rows:
+        return {'ok': True, 'lots': 0, 'rows': 0}, 0
+
+    c_id, c_table, c_lot, c_delta = (ledger.col(h) for h in ('id', 'lot_table', 'lot_id', 'delta'))
+    agg = {}
+    for r in ledger.rows:
+        t = _js_str(ledger.cell(r, c_table))
+        if t not in LOT_TABLES:
+            continue
+        agg.setdefault(t, {}).setdefault(_js_str(ledger.cell(r, c_lot)), []).append(
+            (_parse_int(ledger.cell(r, c_id)), _to_number(ledger.cell(r, c_delta))))
+
+    lots = 0
+    scanned = len(ledger.rows)
+    for t, moves in agg.items():
+        s = STORE.get(t)
+        if not s or not s.rows:
+            continue
+        scanned += len(s.rows)
+        c_lid, c_remain, c_seq = s.col('id'), s.col('qty_remain'), s.ensure_column('ledger_seq')
+        changed = []
+        for r in s.rows:
+            mv = moves.get(_js_str(s.cell(r, c_lid)))
+            if not mv:
+                continue
+            # รวมเฉพาะ movement ที่ id > ledger_seq ของ lot (รอบก่อนค้างกลางทาง -> ไม่บวกซ้ำ)
+            seq = _parse_int(s.cell(r, c_seq))
+            new = [(i, d) for i, d in mv if i > seq]
+            if not new:
+                continue
+            s.set_cell(r, c_remain, _to_number(s.cell(r, c_remain)) + sum(d for _, d in new))
+            s.set_cell(r, c_seq, max(i for i, _ in new))
+            changed.append(r)
+        lots += len(changed)
+        STORE.update(s, changed)
+
+    n = len(ledger.rows)
+    ledger.rows = []
+    STORE.delete(ledger)
+    return {'ok': True, 'lots': lots, 'rows': n}, scanned
+
+
+def stock_moves(table, rows):
+    """stockMoves_: ตรวจคงเหลือ (base + ledger ที่ยังไม่ compact + batch) แล้ว append ใน lock เดียวกัน"""
+    table = table or 'stock_ledger'
+    ledger = STORE.get(table) or STORE.sheets.setdefault(table, Sheet(table, TABLE_HEADERS['stock_ledger']))
+    if not rows:
+        return {'ok': True, 'ids': []}, 0
+
+    need = {}
+    for r in rows:
+        k = (_js_str(r.get('lot_table')), _js_str(r.get('lot_id')).strip())
+        need[k] = need.get(k, 0) + _to_number(r.get('delta'))
+
+    lots, scanned = {}, 0
+    for t, _ in need:
+        if t not in LOT_TABLES:
+            return {'ok': False, 'not_found': True, 'lot_table': t, 'message': 'Unknown lot table: ' + t}, scanned
+        if t in lots:
+            continue
+        lots[t] = {}
+        s = STORE.get(t)
+        if not s:
+            continue
+        scanned += len(s.rows)
+        c_id, c_remain, c_seq = s.col('id'), s.col('qty_remain'), s.col('ledger_seq')
+        for r in s.rows:
+            lots[t][_js_str(s.cell(r, c_id)).strip()] = {
+                'remain': _to_number(s.cell(r, c_remain)),
+                'seq': _parse_int(s.cell(r, c_seq)) if c_seq >= 0 else 0}
+    for t, lid in need:
+        if lid not in lots[t]:
+            return {'ok': False, 'not_found': True, 'lot_table': t, 'lot_id': lid,
+                    'message': 'Not found: ' + lid}, scanned
+
+    c_id, c_table, c_lot, c_delta = (ledger.col(h) for h in ('id', 'lot_table', 'lot_id', 'delta'))
+    scanned += len(ledger.rows)
+    for r in ledger.rows:
+        lot = lots.get(_js_str(ledger.cell(r, c_table)), {}).get(_js_str(ledger.cell(r, c_lot)).strip())
+        if lot and _parse_int(ledger.cell(r, c_id)) > lot['seq']:
+            lot['remain'] += _to_number(ledger.cell(r, c_delta))
+
+    for (t, lid), delta in need.items():
+        cur = lots[t][lid]['remain']
+        if delta < 0 and cur + delta < 0:
+            return {'ok': False, 'short': True, 'lot_table': t, 'lot_id': lid, 'remain': cur,
+                    'message': 'Insufficient stock: ' + lid}, scanned
+    res, n = append_rows(table, rows)
+    return res, scanned + n
+
+
+def _limit(v):
+    # parseInt(limit) || 1000
+    n = _parse_int(v) if v not in (None, '') else 0
+    return n or 1000
+
+
+def dispatch_get(args):
+    action, table = args.get('action'), args.get('table')
+    if not action or not table:
+        return {'ok': False, 'message': 'Missing action or table'}, 0
+    if action == 'list':
+        tail = args.get('tail') in ('1', 'true')
+        order = args.get('order') or ('desc' if tail else 'asc')
+        fields = args.get('fields').split(',') if args.get('fields') else None
+        return list_rows(table, _limit(args.get('limit')), order, fields, _parse_int(args.get('offset', '')))
+    if action == 'get':
+        return get_row_by_id(table, args.get('id', 'undefined'))
+    if action == 'search':
+        return search_rows(table, args.get('field'), args.get('value', 'undefined'))
+    return {'ok': False, 'message': 'Unknown action'}, 0
+
+
+def dispatch_post(body):
+    action, table = body.get('action'), body.get('table')
+    if not action or not table:
+        return {'ok': False, 'message': 'Missing action or table'}, 0
+    if CONFIG['strict'] and action in EXTRA_ACTIONS:
+        return {'ok': False, 'message': 'Unknown action'}, 0
+    payload = body.get('payload')
+    p = payload if isinstance(payload, dict) else {}
+    if action == 'append':
+        return append_row(table, payload)
+    if action == 'update':
+        return update_row(table, body.get('id'), payload)
+    if action == 'delete':
+        return delete_row(table, body.get('id'))
+    if action == 'batch_delete':
+        return delete_rows(table, {'ids': p.get('ids') or []})
+    if action == 'delete_where':
+        return delete_rows(table, p)
+    if action == 'update_field':
+        return update_field(table, body.get('id'), body.get('field'), body.get('value'))
+    if action == 'update_field_if':
+        return update_field_if(table, body.get('id'), body.get('field'), body.get('expected'), body.get('value'))
+    if action == 'batch_append':
+        return append_rows(table, p.get('rows') or [])
+    if action == 'stock_moves':
+        return stock_moves(table, p.get('rows') or [])
+    if action == 'batch_update_fields':
+        return update_fields(table, p.get('updates') or [])
+    if action == 'compact_ledger':
+        return compact_ledger(table)
+    if action == 'batch_get':
+        return batch_get(table, p.get('ids') or [])
+    return {'ok': False, 'message': 'Unknown action'}, 0
+
+
+# ============================================
+# HTTP (latency / error injection รอบ dispatch)
+# ============================================
+emu = Flask(__name__)
+
+
+def _count(box, key):
+    box[key] = box.get(key, 0) + 1
+
+
+def _pick_error(action):
+    rate = CONFIG['error_rate']
+    kinds = [k for k in CONFIG['errors'] if k in ERROR_KINDS]
+    if rate <= 0 or not kinds:
+        return None
+    if CONFIG['error_actions'] and action not in CONFIG['error_actions']:
+        return None
+    with _LOCK:
+        if _RNG.random() >= rate:
+            return None
+        return _RNG.choice(kinds)
+
+
+def _sleep_latency(scanned):
+    with _LOCK:
+        jitter = _RNG.uniform(0, CONFIG['jitter_ms']) if CONFIG['jitter_ms'] > 0 else 0
+    delay = (CONFIG['latency_ms'] + jitter) / 1000.0 + scanned * CONFIG['row_cost_us'] / 1e6
+    if delay > 0:
+        time.sleep(delay)
+
+
+def _http_error(status):
+    return Response(f"<html><body>Emulated Apps Script error {status}</body></html>", status=status,
+                    mimetype='text/html')
+
+
+def _handle(method):
+    if method == 'GET':
+        args = request.args.to_dict()
+    else:
+        try:
+            # GAS อ่าน e.postData.contents เสมอไม่สน content-type
+            args = json.loads(request.get_data(as_text=True) or 'null')
+            if not isinstance(args, dict):
+                raise ValueError('body is not an object')
+        except Exception as e:
+            return jsonify({'ok': False, 'message': f'SyntaxError: {e}'})
+    action = str(args.get('action') or '')
+
+    with _LOCK:
+        _count(STATS['calls'], action or '(none)')
+    kind = _pick_error(action)
+    if kind:
+        with _LOCK:
+            _count(STATS['errors'], kind)
+        if kind == 'timeout':
+            time.sleep(CONFIG['timeout_s'])
+            return _http_error(500)
+        if kind != 'lost':
+            _sleep_latency(0)
+            if kind in ERROR_MESSAGES:
+                return jsonify({'ok': False, 'message': ERROR_MESSAGES[kind]})
+            return _http_error(int(kind))
+
+    with _LOCK:
+        try:
+            if method == 'GET':
+                res, scanned = dispatch_get(args)
+            else:
+                res, scanned = dispatch_post(args)
+        except Exception as e:
+            res, scanned = {'ok': False, 'message': f'Exception: {e}'}, 0
+        if action in LOCKED_ACTIONS and CONFIG['lock_ms'] > 0:
+            # งานเขียนใต้ script lock ของจริงต่อคิวกัน
+            time.sleep(CONFIG['lock_ms'] / 1000.0)
+
+    _sleep_latency(scanned)
+    if kind == 'lost':
+        return _http_error(500)
+    return jsonify(res)
+
+
+@emu.route('/', methods=['GET', 'POST'])
+@emu.route('/exec', methods=['GET', 'POST'])
+@emu.route('/macros/s/<deploy_id>/exec', methods=['GET', 'POST'])
+def gas_exec(deploy_id=None):
+    return _handle(request.method)
+
+
+@emu.route('/_emulator', methods=['GET', 'POST'])
+def emulator_config():
+    """GET = config + สถิติ + จำนวนแถวต่อตาราง / POST {key: value} = ปรับ config ตอนรัน"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        unknown = [k for k in data if k not in CONFIG]
+        if unknown:
+            return jsonify({'ok': False, 'message': f'unknown config: {", ".join(unknown)}'}), 400
+        with _LOCK:
+            for k, v in data.items():
+                if isinstance(CONFIG[k], list):
+                    CONFIG[k] = v.split(',') if isinstance(v, str) else list(v or [])
+                elif isinstance(CONFIG[k], bool):
+                    CONFIG[k] = bool(v)
+                else:
+                    CONFIG[k] = float(v)
+    with _LOCK:
+        return jsonify({'ok': True, 'config': CONFIG, 'stats': STATS,
+                        'tables': {n: len(s.rows) for n, s in STORE.sheets.items()}})
+
+
+@emu.route('/_emulator/reset', methods=['POST'])
+def emulator_reset():
+    """ล้างทุกตาราง (เหลือ header) + สถิติ"""
+    with _LOCK:
+        STORE.reset()
+        STATS['calls'].clear()
+        STATS['errors'].clear()
+    return jsonify({'ok': True})
+
+
+# ============================================
+# CLI
+# ============================================
+def seed_from(source, tables):
+    """ใส่ข้อมูลเริ่มต้นจาก source แบบเดียวกับ verify_data.py (sqlite:<path> | json:<path> | sheet)"""
+    from verify_data import load_rows
+    total = 0
+    for t in tables:
+        rows = load_rows(source, t)
+        if rows:
+            with _LOCK:
+                total += STORE.load(t, rows)
+            print(f"[emulator] seed {t}: {len(rows)} แถว")
+    return total
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description="Google Apps Script (gas_code.js) จำลองสำหรับพัฒนา/ทดสอบ/benchmark")
+    p.add_argument("--host", default=os.getenv("GAS_EMU_HOST", "127.0.0.1"))
+    p.add_argument("--port", type=int, default=int(os.getenv("GAS_EMU_PORT", "8765")))
+    p.add_argument("--db", default=os.getenv("GAS_EMU_DB", ""), help="ไฟล์ SQLite เก็บตาราง (ไม่ระบุ = memory)")
+    p.add_argument("--reset", action="store_true", help="ล้างข้อมูลเดิมใน --db ก่อนเริ่ม")
+    p.add_argument("--seed", default="", help="ข้อมูลเริ่มต้นเมื่อตารางว่าง: sqlite:offline.db | json:dump/{table}.json | sheet")
+    p.add_argument("--latency-ms", type=float, default=CONFIG['latency_ms'], help="เวลาตอบขั้นต่ำต่อ request")
+    p.add_argument("--jitter-ms", type=float, default=CONFIG['jitter_ms'], help="สุ่มเพิ่ม 0..N ms")
+    p.add_argument("--row-cost-us", type=float, default=CONFIG['row_cost_us'],
+                   help="เวลาต่อแถวที่ต้องอ่าน (ชีตใหญ่ = ช้าลง เหมือน getDataRange)")
+    p.add_argument("--lock-ms", type=float, default=CONFIG['lock_ms'], help="เวลาที่งานเขียนถือ script lock")
+    p.add_argument("--error-rate", type=float, default=CONFIG['error_rate'], help="โอกาสเกิด error ต่อ request (0-1)")
+    p.add_argument("--errors", default=",".join(CONFIG['errors']), help=f"ชนิด error ที่สุ่ม: {','.join(ERROR_KINDS)}")
+    p.add_argument("--error-actions", default=",".join(CONFIG['error_actions']), help="สุ่ม error เฉพาะ action เหล่านี้")
+    p.add_argument("--timeout-s", type=float, default=CONFIG['timeout_s'], help="เวลาค้างของ error ชนิด timeout")
+    p.add_argument("--random-seed", type=int, default=None, help="ให้ jitter/error ซ้ำได้ทุกครั้ง")
+    p.add_argument("--strict", action="store_true", default=CONFIG['strict'],
+                   help="ทำเหมือน gas_code.js ที่ deploy ทุกอย่าง (ทิ้งคอลัมน์ที่ไม่มีใน header, ไม่มี batch_get)")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    global STORE
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    bad = [k for k in args.errors.split(',') if k and k not in ERROR_KINDS]
+    if bad:
+        print(f"error ไม่รู้จัก: {', '.join(bad)} (ได้: {', '.join(ERROR_KINDS)})")
+        return 2
+    CONFIG.update(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, row_cost_us=args.row_cost_us,
+                  lock_ms=args.lock_ms, error_rate=args.error_rate, timeout_s=args.timeout_s, strict=args.strict,
+                  errors=[e for e in args.errors.split(',') if e],
+                  error_actions=[a for a in args.error_actions.split(',') if a])
+    if args.random_seed is not None:
+        _RNG.seed(args.random_seed)
+
+    STORE = Store(args.db or None)
+    if args.reset:
+        STORE.reset()
+    if args.seed and not any(s.rows for s in STORE.sheets.values()):
+        seed_from(args.seed, list(TABLE_HEADERS))
+
+    print(f"[emulator] GAS_URL=http://{args.host}:{args.port}/exec "
+          f"({'SQLite ' + args.db if args.db else 'memory'}, latency {args.latency_ms:g}+{args.jitter_ms:g}ms, "
+          f"error {args.error_rate:g})")
+    emu.run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,561 @@
+import os
+import re
+import ast
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+from urllib.parse import urlparse
+
+from gas_emulator import TABLE_HEADERS, _cell
+
+# สร้างข้อมูลห้องพยาบาลจำลองปริมาณมาก (10k / 100k / 1M visits) ไว้วัด performance ที่ขนาดอนาคต
+# - กลุ่มอาการจาก SYMPTOM_GROUPS และชื่อยาร่วม/alias จาก _SHARED_MED_RULES ของ app.py (อ่านด้วย ast ไม่ import app)
+# - มีข้อมูลรูปแบบเก่าปนตามสัดส่วน --legacy (มากในช่วงต้นของช่วงเวลา): วันที่ ISO UTC / เฉพาะวันที่ / datetime-local,
+#   medicine แบบ single quote, ชื่อยาแบบ alias, key เก่า (quantity/medicine_name)
+# - stock สอดคล้องกัน: qty_total - qty_remain ของทุก lot = ผลรวมที่ treatment ตัดไปจริง (ไม่ผ่าน ledger)
+# ใช้: python generate_data.py --visits 100k --out sqlite:synthetic.db
+#      python generate_data.py --visits 1m --out emulator:emu.db   (แล้ว python gas_emulator.py --db emu.db)
+#      python generate_data.py --visits 10k --out gas              (POST batch_append ไป GAS_URL ที่ว่างอยู่)
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+GAS_URL = os.getenv("GAS_URL", "http://127.0.0.1:8765/exec")
+
+TABLES_ORDER = ['users', 'medicine', 'other_item', 'treatment', 'medicine_lot', 'other_lot',
+                'waste', 'medical_certificate']
+CHUNK = 5000
+
+# รหัสกลุ่มอาการตามลำดับ SYMPTOM_GROUPS (ตรงกับ <select name="symptom_group"> ใน treatment_form.html)
+SYMPTOM_CODES = ['respiratory', 'digestive', 'muscle', 'brain', 'skin', 'medicine', 'urinary', 'reproductive',
+                 'eye', 'throat', 'nose', 'wound', 'work_accident', 'nonwork_accident', 'other']
+SYMPTOM_WEIGHTS = {'respiratory': 20, 'digestive': 12, 'muscle': 20, 'brain': 10, 'skin': 8, 'medicine': 6,
+                   'urinary': 2, 'reproductive': 3, 'eye': 4, 'throat': 4, 'nose': 3, 'wound': 5,
+                   'work_accident': 1, 'nonwork_accident': 1, 'other': 1}
+# ยาต่อกลุ่มตาม medicineData ของ treatment_form.html (+ กลุ่มที่ฟอร์มไม่มีรายการ)
+MEDICINES_BY_CODE = {
+    'respiratory': ['Amoxy', 'Bisolvon', 'Mybacin', 'Loratadine', 'Zyetec', 'M.tusis', 'Paracetamol(500)'],
+    'digestive': ['Air-x', 'Buscopan', 'Diasgest', 'M.car', 'ORS', 'Paracetamol(500)', 'Motilium', 'K-milk',
+                  'ยาหอม', 'CA-R-Bon'],
+    'muscle': ['Balm', 'Mydoclam', 'Norgesic', 'Paracetamol(500)'],
+    'brain': ['B1,6,12', 'Dimen', 'ORS', 'Paracetamol(500)'],
+    'skin': ['Acyclovir', 'CPM', 'Loratadine', 'Zyetec', '0.1%TA Cream', 'Mycozol', 'Silver cream',
+             'Calamine lotion', 'Paracetamol(500)'],
+    'medicine': ['CPM', 'ORS', 'Brufen(400)'],
+    'urinary': ['Paracetamol(500)', 'Norflox'],
+    'reproductive': ['Ponstan(500)', 'Paracetamol(500)'],
+    'eye': ['Hista oph', 'Op Sar', 'Ointment', 'Brufen(400)', 'Kenalog', 'Paracetamol(500)'],
+    'throat': ['Mybacin', 'Paracetamol(500)'],
+    'nose': ['Loratadine', 'Paracetamol(500)'],
+}
+SUPPLIES = ['ไม้พันสำลี', 'EB:3', 'EB:2', 'Mask', 'Grove Dispose', 'Eyepad', 'Transpore', 'Sofatulle', 'ไม้กดลิ้น',
+            'Gouze', 'Betadine', '70%Alcohol', '0.9%NSS', 'Amonia', 'Plaster', 'เซ็ตทำแผล D/S', 'ผ้าสามเหลี่ยม']
+# กลุ่มที่จ่ายเวชภัณฑ์เป็นหลัก
+SUPPLY_CODES = {'wound', 'work_accident', 'nonwork_accident'}
+OTHER_ITEMS = ['Mask N95', 'ถุงมือยาง', 'เจลล้างมือ', 'ที่อุดหู', 'แว่นตานิรภัย', 'ยาดม']
+
+DEPARTMENTS = ['อสร.', 'คลังวัตถุดิบ', 'ห้องปฏิบัติการ', 'วิศวกรรม', 'บริหาร', 'ดิจิตอล', 'ผู้รับเหมา', 'ธุรการ',
+               'ผลิตอาหารสัตว์', 'อื่นๆ']
+DEPT_WEIGHTS = [30, 12, 6, 10, 5, 3, 15, 4, 12, 3]
+FIRST_NAMES = ['สมชาย', 'สมศรี', 'วิชัย', 'สุดา', 'ประยุทธ', 'มาลี', 'อนุชา', 'กาญจนา', 'ธนา', 'ปิยะ', 'วรรณา',
+               'สุรชัย', 'นภา', 'ชัยวัฒน์', 'อรุณี', 'เกรียงไกร', 'พรทิพย์', 'สมบัติ', 'จันทร์เพ็ญ', 'ธีระ',
+               'รัตนา', 'บุญมี', 'ศิริพร', 'ณัฐพล', 'อัมพร', 'วีระ', 'สายสุนีย์', 'ประเสริฐ', 'ลำดวน', 'เอกชัย']
+LAST_NAMES = ['ใจดี', 'สุขสม', 'ทองดี', 'มั่นคง', 'ศรีสุข', 'แก้วมณี', 'บุญเรือง', 'พงษ์ไทย', 'รุ่งเรือง',
+              'สายทอง', 'ชัยมงคล', 'วงศ์ใหญ่', 'อินทร์แก้ว', 'ปัญญาดี', 'เพชรรัตน์', 'นาคสุข', 'คำแก้ว']
+NICKNAMES = ['ก', 'ป', 'เอิน', 'บี', 'นุ่น', 'ต้น', 'แบงค์', 'ฝน', 'เอ', 'โอ๋', 'จ๋า', 'เก่ง', 'หนิง', 'ตูน']
+SYMPTOM_DETAILS = {
+    'respiratory': ['ไอ มีเสมหะ', 'เป็นหวัด น้ำมูกไหล', 'เจ็บคอ ไอแห้ง'],
+    'digestive': ['ปวดท้อง', 'ท้องเสีย', 'จุกเสียด แน่นท้อง'],
+    'muscle': ['ปวดหลัง', 'ปวดไหล่จากยกของ', 'ปวดเมื่อยกล้ามเนื้อ'],
+    'brain': ['ปวดศีรษะ', 'เวียนศีรษะ', 'นอนไม่หลับ'],
+    'skin': ['ผื่นคัน', 'ลมพิษ', 'แผลพุพอง'],
+    'wound': ['แผลถลอก', 'แผลมีดบาด', 'ล้างแผลต่อเนื่อง'],
+    'work_accident': ['ของหล่นทับเท้า', 'ลื่นล้มในไลน์ผลิต', 'เศษวัตถุเข้าตา'],
+    'nonwork_accident': ['รถล้มระหว่างเดินทาง', 'ล้มที่บ้าน'],
+}
+WASTE_COMPANIES = ['บริษัท กำจัดขยะติดเชื้อ จำกัด', 'เทศบาลตำบล', 'บริษัท เอ็นไวโร แคร์ จำกัด']
+WASTE_PLACES = ['ห้องพยาบาล', 'ป้อมรปภ', 'โรงอาหาร', 'จุดพักขยะ']
+HOSPITALS = ['โรงพยาบาลประจำจังหวัด', 'โรงพยาบาลเอกชน', 'คลินิกเวชกรรม']
+DOCTORS = ['นพ.สมศักดิ์ รักษาดี', 'พญ.วิภา ใจเย็น', 'นพ.ธนพล ศรีเมือง']
+# รูปของข้อมูลเก่าเป็น data URL ในชีต (1x1 PNG) ข้อมูลใหม่ไม่มีรูป (blob store อยู่นอกชีต)
+LEGACY_PHOTO = ("data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8/5+hHgAHggJ/"
+                "PchI7wAAAABJRU5ErkJggg==")
+
+_TH_OFFSET = datetime.timedelta(hours=7)
+
+
+def app_constants(names=('SYMPTOM_GROUPS', '_SHARED_MED_RULES')):
+    """อ่านค่าคงที่จาก app.py ด้วย ast (import app จะติด Flask/warm-up/scheduler)"""
+    with open(APP_FILE, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    out = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) \
+                and node.targets[0].id in names:
+            out[node.targets[0].id] = ast.literal_eval(node.value)
+    missing = [n for n in names if n not in out]
+    if missing:
+        raise RuntimeError(f"ไม่พบ {', '.join(missing)} ใน app.py")
+    return out
+
+
+def _norm_med_key(s):
+    # เหมือน _norm_med_key ของ app.py
+    s = str(s or '').strip().lower().replace('（', '(').replace('）', ')')
+    s = re.sub(r"\s+", '', s)
+    return re.sub(r"[^a-z0-9ก-๙]+", '', s)
+
+
+def parse_count(v):
+    """10k / 100k / 1m / 2500"""
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kKmM]?)\s*", str(v))
+    if not m:
+        raise argparse.ArgumentTypeError(f"จำนวนไม่ถูกต้อง: {v}")
+    return int(float(m.group(1)) * {'': 1, 'k': 1000, 'm': 1000000}[m.group(2).lower()])
+
+
+# ============================================
+# GENERATOR
+# ============================================
+class Generator:
+    def __init__(self, visits, start, end, legacy=0.15, seed=None):
+        self.rng = random.Random(seed)
+        self.visits = visits
+        self.start = start
+        self.end = end
+        self.legacy = legacy
+        consts = app_constants()
+        groups = consts['SYMPTOM_GROUPS']
+        self.group_name = dict(zip(SYMPTOM_CODES, groups))
+        self.shared = consts['_SHARED_MED_RULES']
+        self.stats = {'legacy_dates': 0, 'legacy_json': 0, 'aliases': 0, 'lots': 0}
+
+        self.medicine, self.other_item = [], []
+        self.lots = {'medicine_lot': [], 'other_lot': []}
+        self.current = {}          # (lot_table, key) -> lot ที่กำลังจ่าย
+        self.price = {}            # ชื่อ -> ราคาต่อหน่วย
+        self.lot_count = {}        # (lot_table, key) -> จำนวน lot ที่รับเข้าแล้ว
+        self._rules = {}           # ชื่อ -> rule ของยาร่วม (หรือ None)
+        self.items_by_code = {}    # code -> [(ชื่อ, lot_table, key, type)]
+        self._build_catalog()
+        self._build_patients()
+
+    # ---------- catalog ----------
+    def _shared_rule(self, name):
+        if name not in self._rules:
+            k = _norm_med_key(name)
+            self._rules[name] = None
+            for rule in self.shared.values():
+                keys = {_norm_med_key(rule.get('canonical', ''))} | {_norm_med_key(a) for a in rule.get('aliases', ())}
+                if k in keys:
+                    self._rules[name] = rule
+                    break
+        return self._rules[name]
+
+    def _build_catalog(self):
+        created = self._fmt(self.start - datetime.timedelta(days=30))
+        canonical_id = {}
+        for code in SYMPTOM_CODES:
+            for name in MEDICINES_BY_CODE.get(code, []):
+                mid = len(self.medicine) + 1
+                self.medicine.append({'id': mid, 'type': 'medicine', 'group_name': self.group_name.get(code, 'อื่นๆ'),
+                                      'name': name, 'benefit': '', 'min_qty': self.rng.choice([5, 10, 20]), 'qty': 0,
+                                      'expire_date': '', 'used': 0, 'created_at': created})
+                # ยาร่วม (เช่น Paracetamol(500)) มีแถวในหลายกลุ่มแต่ใช้ lot ชุดเดียวของ id ต่ำสุด
+                rule = self._shared_rule(name)
+                key = canonical_id.setdefault(rule['canonical'], mid) if rule else mid
+                self.items_by_code.setdefault(code, []).append((name, 'medicine_lot', key, 'medicine'))
+                self.price.setdefault(name, round(self.rng.uniform(0.5, 15), 2))
+        supplies = []
+        for name in SUPPLIES:
+            mid = len(self.medicine) + 1
+            self.medicine.append({'id': mid, 'type': 'supply', 'group_name': 'เวชภัณฑ์', 'name': name,
+                                  'benefit': 'เวชภัณฑ์ใช้ในห้องพยาบาล', 'min_qty': 5, 'qty': 0, 'expire_date': '',
+                                  'used': 0, 'created_at': created})
+            supplies.append((name, 'medicine_lot', mid, 'supply'))
+            self.price.setdefault(name, round(self.rng.uniform(1, 40), 2))
+        for code in SUPPLY_CODES:
+            self.items_by_code[code] = supplies
+        for name in OTHER_ITEMS:
+            oid = len(self.other_item) + 1
+            self.other_item.append({'id': oid, 'type': 'other', 'group_name': 'อื่นๆ', 'name': name, 'benefit': '',
+                                    'min_qty': 0, 'qty': 0, 'expire_date': '', 'used': 0, 'created_at': created})
+            self.items_by_code.setdefault('other', []).append((name, 'other_lot', name, 'other'))
+            self.price.setdefault(name, round(self.rng.uniform(2, 60), 2))
+        self.med_name = {m['id']: m['name'] for m in self.medicine}
+
+    def _build_patients(self):
+        n = max(100, self.visits // 10)
+        self.patients = []
+        for _ in range(n):
+            if self.rng.random() < 0.2:
+                name = self.rng.choice(NICKNAMES)
+            else:
+                name = f"{self.rng.choice(FIRST_NAMES)} {self.rng.choice(LAST_NAMES)}"
+            self.patients.append((name, self.rng.choices(DEPARTMENTS, DEPT_WEIGHTS)[0]))
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _fmt(dt):
+        return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    def _is_legacy(self, when):
+        # ข้อมูลรูปแบบเก่าหนาแน่นช่วงต้น แล้วค่อย ๆ หมดไป (เฉลี่ยทั้งช่วง = --legacy)
+        span = (self.end - self.start).total_seconds() or 1
+        frac = (when - self.start).total_seconds() / span
+        return self.rng.random() < min(1.0, self.legacy * 2 * (1 - frac))
+
+    def _legacy_date(self, when):
+        kind = self.rng.randrange(3)
+        if kind == 0:
+            return when.strftime('%Y-%m-%d')
+        if kind == 1:
+            # ค่าที่ชีตแปลงเป็น Date แล้วส่งกลับเป็น ISO UTC
+            return (when - _TH_OFFSET).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        return when.strftime('%Y-%m-%dT%H:%M')
+
+    def _dispense(self, lot_table, key, name, qty, when):
+        """ตัดจาก lot ปัจจุบัน ไม่พอ -> รับ lot ใหม่ (lot เก่าที่เหลือค้างไว้เหมือนของจริง)"""
+        lot = self.current.get((lot_table, key))
+        if lot is None or lot['qty_remain'] < qty or lot['expire_date'] < when.strftime('%Y-%m-%d'):
+            lots = self.lots[lot_table]
+            n_for_key = self.lot_count.get((lot_table, key), 0)
+            self.lot_count[(lot_table, key)] = n_for_key + 1
+            received = when - datetime.timedelta(days=self.rng.randint(0, 7), hours=self.rng.randint(0, 8))
+            total = max(qty, self.rng.choice([50, 100, 200, 500]))
+            ppu = self.price[name]
+            lot = {'id': len(lots) + 1, '_key': key, 'lot_name': f'LOT {n_for_key + 1}',
+                   'expire_date': (received + datetime.timedelta(days=self.rng.randint(180, 900))).strftime('%Y-%m-%d'),
+                   'qty_total': total, 'qty_remain': total, 'price_per_lot': round(total * ppu, 2),
+                   'price_per_unit': ppu, 'created_at': self._fmt(received)}
+            if lot_table == 'medicine_lot':
+                rule = self._shared_rule(name)
+                lot.update(medicine_id=key, item_name=rule['canonical'] if rule else self.med_name[key])
+            else:
+                lot.update(item_name=key)
+            lots.append(lot)
+            self.current[(lot_table, key)] = lot
+            self.stats['lots'] += 1
+        lot['qty_remain'] -= qty
+        return lot
+
+    def _qty(self, item_type, name):
+        if item_type != 'medicine' or name in ('Balm', 'Calamine lotion', 'Silver cream', '0.1%TA Cream'):
+            return self.rng.choices([1, 2, 3], [70, 20, 10])[0]
+        return self.rng.choices([1, 2, 4, 6, 10, 20], [25, 25, 20, 12, 12, 6])[0]
+
+    def _items(self, code, when, legacy):
+        pool = self.items_by_code.get(code) or self.items_by_code['muscle']
+        n = self.rng.choices([0, 1, 2, 3], [20, 45, 25, 10])[0]
+        out = []
+        for name, lot_table, key, item_type in self.rng.sample(pool, min(n, len(pool))):
+            qty = self._qty(item_type, name)
+            lot = self._dispense(lot_table, key, name, qty, when)
+            rule = self._shared_rule(name)
+            shown = rule['canonical'] if rule else name
+            if legacy:
+                if rule and self.rng.random() < 0.5:
+                    shown = self.rng.choice(sorted(rule['aliases']))
+                    self.stats['aliases'] += 1
+                it = {'medicine_name' if self.rng.random() < 0.2 else 'name': shown, 'lot_id': str(lot['id'])}
+                it['quantity' if self.rng.random() < 0.2 else 'qty'] = qty if self.rng.random() < 0.5 else str(qty)
+            else:
+                it = {'name': shown, 'item_name': shown,
+                      'lot': f"{lot['lot_name']} (คงเหลือ {lot['qty_remain']})",
+                      'lot_id': str(lot['id']), 'qty': str(qty)}
+            if item_type != 'medicine':
+                it['type'] = item_type
+            out.append(it)
+        if not out:
+            return '' if legacy and self.rng.random() < 0.5 else '[]'
+        if legacy:
+            self.stats['legacy_json'] += 1
+            # str(list) ของ Python = single quote แบบข้อมูลเก่า (app อ่านด้วย ast.literal_eval)
+            return str(out)
+        return json.dumps(out, ensure_ascii=False)
+
+    # ---------- tables ----------
+    def _day_weights(self):
+        days, weights = [], []
+        d = self.start.date()
+        while d <= self.end.date():
+            w = {5: 0.35, 6: 0.1}.get(d.weekday(), 1.0)
+            w *= 1.15 if d.month in (6, 7, 8, 9, 10, 12, 1) else 1.0
+            days.append(d)
+            weights.append(w)
+            d += datetime.timedelta(days=1)
+        return days, weights
+
+    def treatments(self):
+        """yield ทีละก้อน (<= CHUNK แถว) เรียงตามเวลา"""
+        days, weights = self._day_weights()
+        total_w = sum(weights)
+        counts = [int(self.visits * w / total_w) for w in weights]
+        for i in self.rng.sample(range(len(days)), min(len(days), self.visits - sum(counts))):
+            counts[i] += 1
+
+        codes = list(SYMPTOM_WEIGHTS)
+        base_w = [SYMPTOM_WEIGHTS[c] for c in codes]
+        wet_w = [w * (1.6 if c == 'respiratory' else 1) for c, w in zip(codes, base_w)]
+        hours = list(range(7, 20))
+        hour_w = [3, 8, 10, 9, 6, 4, 8, 9, 7, 5, 3, 2, 1]
+
+        rid, chunk = 0, []
+        for day, n in zip(days, counts):
+            stamps = sorted(datetime.datetime.combine(day, datetime.time(self.rng.choices(hours, hour_w)[0],
+                                                                         self.rng.randrange(60), self.rng.randrange(60)))
+                            for _ in range(n))
+            gw = wet_w if day.month in (6, 7, 8, 9, 10) else base_w
+            for when in stamps:
+                rid += 1
+                legacy = self._is_legacy(when)
+                code = self.rng.choices(codes, gw)[0]
+                name, dept = self.patients[int(len(self.patients) * self.rng.random() ** 2.5)]
+                allergy = self.rng.random() < 0.03
+                if legacy:
+                    self.stats['legacy_dates'] += 1
+                    visit_date = self._legacy_date(when)
+                    # บันทึกย้อนหลัง / created_at จาก buildRow_ ของ GAS (ISO UTC) หรือว่าง
+                    created = self.rng.choice(['', (when + datetime.timedelta(days=self.rng.randint(0, 5))
+                                                    - _TH_OFFSET).strftime('%Y-%m-%dT%H:%M:%S.000Z')])
+                else:
+                    visit_date = self._fmt(when)
+                    created = self._fmt(when + datetime.timedelta(minutes=self.rng.randint(0, 20)))
+                chunk.append({
+                    'id': rid, 'visit_date': visit_date, 'patient_name': name,
+                    'department': dept.rstrip('.') if legacy and self.rng.random() < 0.3 else dept,
+                    'symptom_group': code,
+                    'symptom_detail': self.rng.choice(SYMPTOM_DETAILS.get(code, [''])) if self.rng.random() < 0.6 else '',
+                    'medicine': self._items(code, when, legacy),
+                    'allergy': 1 if allergy else 0,
+                    'allergy_detail': 'แพ้ยา Penicillin' if allergy else '',
+                    'occupational_disease': 1 if self.rng.random() < 0.02 else 0,
+                    'doctor_opinion': 'ส่งต่อโรงพยาบาล' if self.rng.random() < 0.01 else '',
+                    'created_at': created,
+                })
+                if len(chunk) >= CHUNK:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def lot_rows(self, lot_table):
+        return [{k: v for k, v in lot.items() if k != '_key'} for lot in self.lots[lot_table]]
+
+    def _random_time(self):
+        span = int((self.end - self.start).total_seconds())
+        return self.start + datetime.timedelta(seconds=self.rng.randrange(max(1, span)))
+
+    def waste(self, n):
+        rows = []
+        for when in sorted(self._random_time() for _ in range(n)):
+            legacy = self._is_legacy(when)
+            rows.append({'id': len(rows) + 1, 'company': self.rng.choice(WASTE_COMPANIES),
+                         'amount': str(round(self.rng.uniform(0.5, 15), 1)), 'date': when.strftime('%Y-%m-%d'),
+                         'time': when.strftime('%H:%M'), 'place': self.rng.choice(WASTE_PLACES),
+                         'photo': LEGACY_PHOTO if legacy else '', 'created_at': self._fmt(when)})
+        return rows
+
+    def certificates(self, n):
+        rows = []
+        for when in sorted(self._random_time() for _ in range(n)):
+            title = self.rng.choice(['นาย', 'นาง', 'นางสาว'])
+            name, _ = self.rng.choice(self.patients)
+            disease, accident, hospital = (self.rng.random() < p for p in (0.1, 0.05, 0.08))
+            w, h = self.rng.randint(45, 95), self.rng.randint(150, 185)
+            bp, pulse = f"{self.rng.randint(100, 140)}/{self.rng.randint(60, 90)}", self.rng.randint(60, 100)
+            rows.append({
+                'id': len(rows) + 1, 'title': title, 'fullname': name,
+                'address': f"{self.rng.randint(1, 300)} หมู่ {self.rng.randint(1, 12)}",
+                'disease': 'มี' if disease else 'ไม่มี', 'disease_detail': 'ความดันโลหิตสูง' if disease else '',
+                'accident': 'มี' if accident else 'ไม่มี', 'accident_detail': 'กระดูกหัก' if accident else '',
+                'hospital': 'มี' if hospital else 'ไม่มี', 'hospital_detail': 'ผ่าตัดไส้ติ่ง' if hospital else '',
+                'other_history': '', 'requester_sign': f"{title}{name}", 'requester_date': when.strftime('%Y-%m-%d'),
+                'hospital_name': self.rng.choice(HOSPITALS), 'weight': str(w), 'height': str(h), 'bp': bp,
+                'pulse': str(pulse), 'body_status': 'ปกติ', 'body_detail': '',
+                'work_result': 'ได้' if self.rng.random() < 0.97 else 'ไม่ได้',
+                'doctor_name': self.rng.choice(DOCTORS), 'created_at': self._fmt(when)})
+        return rows
+
+
+# ============================================
+# SINKS
+# ============================================
+class SqliteSink:
+    """ไฟล์ SQLite รูปแบบ offline.db (1 ตาราง = 1 ชีต) -> ใช้กับ verify_data.py / gas_emulator.py --seed"""
+
+    def __init__(self, path, force=False):
+        if os.path.abspath(path) == os.path.abspath('offline.db'):
+            raise SystemExit("ไม่เขียนทับ offline.db (ข้อมูลจริง) เลือกไฟล์อื่น")
+        self.conn = sqlite3.connect(path)
+        self.force = force
+
+    def begin(self, table):
+        exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
+        if exists and self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+            if not self.force:
+                raise SystemExit(f"ตาราง {table} มีข้อมูลแล้ว (ใช้ --force เพื่อลบแล้วสร้างใหม่)")
+        self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+        cols = ", ".join(f'"{c}"' for c in TABLE_HEADERS[table] if c != 'id')
+        self.conn.execute(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, {cols})")
+
+    def write(self, table, rows):
+        cols = TABLE_HEADERS[table]
+        ph = ", ".join("?" for _ in cols)
+        with self.conn:
+            self.conn.executemany(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({ph})",
+                                  [[r.get(c, '') for c in cols] for r in rows])
+
+    def close(self):
+        self.conn.close()
+
+
+class EmulatorSink:
+    """เขียนตรงลงไฟล์ --db ของ gas_emulator.py (เร็วกว่ายิง HTTP มากสำหรับ 1M แถว)"""
+
+    def __init__(self, path, force=False):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS emu_sheet (name TEXT PRIMARY KEY, headers TEXT, seq INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS emu_row (sheet TEXT, pos INTEGER, data TEXT, PRIMARY KEY (sheet, pos))")
+        self.force = force
+        self.pos = {}
+
+    def begin(self, table):
+        if self.conn.execute("SELECT 1 FROM emu_row WHERE sheet = ? LIMIT 1", (table,)).fetchone() and not self.force:
+            raise SystemExit(f"ชีต {table} ใน emulator มีข้อมูลแล้ว (ใช้ --force เพื่อล้าง)")
+        with self.conn:
+            self.conn.execute("DELETE FROM emu_row WHERE sheet = ?", (table,))
+            self.conn.execute("INSERT OR REPLACE INTO emu_sheet (name, headers, seq) VALUES (?, ?, 0)",
+                              (table, json.dumps(TABLE_HEADERS[table])))
+        self.pos[table] = 0
+
+    def write(self, table, rows):
+        cols = TABLE_HEADERS[table]
+        start = self.pos[table]
+        self.pos[table] += len(rows)
+        with self.conn:
+            self.conn.executemany("INSERT INTO emu_row (sheet, pos, data) VALUES (?, ?, ?)",
+                                  [(table, start + i, json.dumps([_cell(r.get(c, '')) for c in cols], ensure_ascii=False))
+                                   for i, r in enumerate(rows)])
+            self.conn.execute("UPDATE emu_sheet SET seq = MAX(seq, ?) WHERE name = ?",
+                              (max(int(r['id']) for r in rows), table))
+
+    def close(self):
+        self.conn.close()
+
+
+class GasSink:
+    """batch_append ไป GAS_URL (ปกติ = gas_emulator ที่รันอยู่) ตารางปลายทางต้องว่างเพื่อให้ id ตรงกับที่อ้างถึงกัน"""
+
+    def __init__(self, url, allow_remote=False, batch_size=500):
+        import migrate_data
+        host = urlparse(url).hostname or ''
+        if host not in ('127.0.0.1', 'localhost', '::1') and not allow_remote:
+            raise SystemExit(f"GAS_URL ไม่ใช่เครื่องนี้ ({host}) ไม่ส่งข้อมูลจำลองเข้าชีตจริง (ใช้ --allow-remote ถ้าตั้งใจ)")
+        migrate_data.GAS_URL = url
+        self.md = migrate_data
+        self.url = url
+        self.limiter = migrate_data.AdaptiveLimiter()
+        self.batch_size = batch_size
+
+    def begin(self, table):
+        import requests
+        res = requests.get(self.url, params={"action": "list", "table": table, "limit": 1}, timeout=60).json()
+        if res.get("ok") and res.get("data"):
+            raise SystemExit(f"ชีต {table} ปลายทางมีข้อมูลแล้ว (ล้างก่อน เช่น POST /_emulator/reset)")
+
+    def write(self, table, rows):
+        pairs = [(r['id'], {k: v for k, v in r.items() if k != 'id'}) for r in rows]
+        for batch in self.md.make_batches(pairs, self.batch_size, self.md.MAX_BATCH_BYTES):
+            ok, ids = self.md.gas_batch_append(table, [p for _, p in batch], self.limiter)
+            if not ok:
+                raise SystemExit(f"{table}: ส่งไม่สำเร็จ ({ids})")
+            want = [int(i) for i, _ in batch]
+            if [int(i) for i in ids] != want:
+                raise SystemExit(f"{table}: id ปลายทาง {ids[0]}.. ไม่ตรงกับ {want[0]}.. (ชีตต้องว่างและ seq เริ่มที่ 0)")
+
+    def close(self):
+        pass
+
+
+def make_sink(out, force=False, allow_remote=False):
+    kind, _, path = out.partition(':')
+    if kind == 'sqlite':
+        return SqliteSink(path or 'synthetic.db', force)
+    if kind == 'emulator':
+        return EmulatorSink(path or 'emulator.db', force)
+    if kind == 'gas':
+        return GasSink(path or GAS_URL, allow_remote)
+    raise SystemExit(f"--out ไม่รู้จัก: {out} (sqlite:<path> | emulator:<path> | gas[:<url>])")
+
+
+# ============================================
+# CLI
+# ============================================
+def parse_args(argv):
+    p = argparse.ArgumentParser(description="สร้างข้อมูลห้องพยาบาลจำลองสำหรับทดสอบที่ขนาดใหญ่")
+    p.add_argument("--visits", type=parse_count, default=parse_count('10k'), help="จำนวน treatment เช่น 10k, 100k, 1m")
+    p.add_argument("--years", type=float, default=3, help="ช่วงเวลาย้อนหลังจาก --end")
+    p.add_argument("--end", default="", help="วันสุดท้าย YYYY-MM-DD (ไม่ระบุ = วันนี้)")
+    p.add_argument("--legacy", type=float, default=0.15, help="สัดส่วนแถวรูปแบบเก่า (0-1)")
+    p.add_argument("--waste", type=parse_count, default=None, help="จำนวนแถว waste (ไม่ระบุ = visits/40)")
+    p.add_argument("--certificates", type=parse_count, default=None, help="จำนวนใบรับรองแพทย์ (ไม่ระบุ = visits/150)")
+    p.add_argument("--out", default="sqlite:synthetic.db", help="sqlite:<path> | emulator:<path> | gas[:<url>]")
+    p.add_argument("--force", action="store_true", help="ล้างตารางปลายทางที่มีข้อมูลอยู่แล้ว")
+    p.add_argument("--allow-remote", action="store_true", help="ยอมส่งไป GAS_URL ที่ไม่ใช่เครื่องนี้")
+    p.add_argument("--random-seed", type=int, default=1, help="seed เดียวกัน = ข้อมูลชุดเดิมทุกครั้ง")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    end = datetime.datetime.strptime(args.end, '%Y-%m-%d') if args.end else datetime.datetime.now()
+    end = end.replace(hour=23, minute=59, second=59, microsecond=0)
+    start = (end - datetime.timedelta(days=int(args.years * 365))).replace(hour=0, minute=0, second=0)
+
+    t0 = time.time()
+    gen = Generator(args.visits, start, end, legacy=max(0.0, min(1.0, args.legacy)), seed=args.random_seed)
+    sink = make_sink(args.out, force=args.force, allow_remote=args.allow_remote)
+    counts = {}
+
+    def emit(table, rows):
+        sink.write(table, rows)
+        counts[table] = counts.get(table, 0) + len(rows)
+
+    try:
+        for table in TABLES_ORDER:
+            sink.begin(table)
+            if table == 'users':
+                # แถวเดียวกับที่ initSheets() ของ gas_code.js ใส่ให้ (login เข้า app ได้ทันที)
+                emit(table, [{'id': 1, 'username': 'admin', 'password': '111', 'name': 'ผู้ดูแลระบบ', 'dept': 'Safety',
+                              'role': 'admin', 'created_at': gen._fmt(start)}])
+            elif table in ('medicine', 'other_item'):
+                emit(table, getattr(gen, table))
+            elif table == 'treatment':
+                for chunk in gen.treatments():
+                    emit(table, chunk)
+                    print(f"[gen] treatment {counts[table]}/{args.visits} ({time.time() - t0:.1f}s)")
+            elif table in ('medicine_lot', 'other_lot'):
+                rows = gen.lot_rows(table)
+                for i in range(0, len(rows), CHUNK):
+                    emit(table, rows[i:i + CHUNK])
+            elif table == 'waste':
+                emit(table, gen.waste(args.waste if args.waste is not None else max(10, args.visits // 40)))
+            elif table == 'medical_certificate':
+                n = args.certificates if args.certificates is not None else max(5, args.visits // 150)
+                emit(table, gen.certificates(n))
+    finally:
+        sink.close()
+
+    print(f"[gen] เสร็จใน {time.time() - t0:.1f}s -> {args.out} ({start:%Y-%m-%d} ถึง {end:%Y-%m-%d})")
+    for table in TABLES_ORDER:
+        print(f"  {table}: {counts.get(table, 0)}")
+    s = gen.stats
+    print(f"  legacy: วันที่ {s['legacy_dates']}, medicine single quote {s['legacy_json']}, alias ยาร่วม {s['aliases']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
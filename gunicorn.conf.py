@@ -0,0 +1,49 @@
+# gunicorn จะอ่านไฟล์นี้อัตโนมัติเมื่อรันจากโฟลเดอร์โปรเจกต์ (Procfile: gunicorn app:app)
+import os
+import glob
+import tempfile
+
+# --preload: import app ใน master ครั้งเดียว แล้ว warm cache ก่อน fork
+# worker ทุกตัวได้ cache/aggregate ชุดเดียวกันไปเลย (copy-on-write)
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+
+WARMUP_ON_BOOT = os.environ.get("WARMUP_ON_BOOT", "1") == "1"
+DASH_SCHEDULER = os.environ.get("DASH_SCHEDULER", "1") == "1"
+
+
+def on_starting(server):
+    # ไฟล์ metrics ของรอบก่อน (pid เก่า) ไม่นับรวม (ไม่ import app ที่นี่ กรณีไม่ preload)
+    metrics_dir = os.environ.get("METRICS_DIR") or os.path.join(tempfile.gettempdir(), "cpf_metrics")
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # preload แล้ว app ถูก import ใน master ก่อน hook นี้ -> warm แบบ sync ให้เสร็จก่อน fork
+    if WARMUP_ON_BOOT and preload_app:
+        from app import warm_up, metrics_flush
+        warm_up()
+        # ค่าจาก warm-up ของ master เก็บเป็นไฟล์ของ master เอง (worker ล้างสำเนาที่ fork ไปทิ้ง)
+        metrics_flush(force=True)
+
+
+def post_worker_init(worker):
+    # metrics ที่ติดมาจาก master ตอน fork ไม่ใช่ของ worker นี้ (กันนับซ้ำ)
+    from app import metrics_reset
+    metrics_reset()
+
+    # ไม่ได้ preload -> แต่ละ worker warm เองใน background (/healthz/ready ตอบ 503 จนกว่าจะเสร็จ)
+    if WARMUP_ON_BOOT and not preload_app:
+        from app import start_warm_up_background
+        start_warm_up_background()
+
+    # thread ไม่ตามไปหลัง fork -> เริ่มในแต่ละ worker แต่รันจริงตัวเดียว (flock ใน LOCK_DIR) ตัวอื่นรอรับช่วงต่อ
+    if DASH_SCHEDULER:
+        from app import start_dashboard_scheduler
+        start_dashboard_scheduler()
+
@@ -1,135 +1,427 @@
 import sqlite3
 import json
-import time
+import os
+import random
 import sys
+import time
 import datetime
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from verify_data import IGNORE_COLS, row_digest
 
 # การตั้งค่า (Configuration)
 DB_PATH = 'offline.db'
-GAS_URL = "https://script.google.com/macros/s/AKfycbyFLXNjy21R8gVHfWecWCwKKLAAnnfOsbi5ex4hJDaMR_kkoZKNIC53DVbBOUrszdUH/exec"
+GAS_URL = os.getenv("GAS_URL", "https://script.google.com/macros/s/AKfycbyFLXNjy21R8gVHfWecWCwKKLAAnnfOsbi5ex4hJDaMR_kkoZKNIC53DVbBOUrszdUH/exec")
 LOG_FILE = 'migration_log.txt'
+# checkpoint: id เก่าที่ย้ายแล้วต่อตาราง + medicine_id_map (รันซ้ำ = ทำต่อจากที่ค้าง)
+STATE_FILE = 'migration_state.json'
 
 # เราจะย้าย users และ medicine ก่อน เพื่อให้ได้ ID ใหม่มา map
 TABLES_ORDER = [
     'users',
     'medicine',
-    'medical_certificate', 
+    'medical_certificate',
     'waste',
     'treatment',
     'medicine_lot'
 ]
 
-# เก็บ ID เก่า -> ID ใหม่ สำหรับตาราง medicine
+BATCH_SIZE = 200                 # แถวต่อ request (batch_append)
+MAX_BATCH_BYTES = 2 * 1024 * 1024  # กัน payload ใหญ่เกิน (waste มีรูป data URL)
+WORKERS = 2                      # request พร้อมกันต่อตาราง
+MAX_RETRIES = 5
+TIMEOUT = 120
+
+# เก็บ ID เก่า -> ID ใหม่ สำหรับตาราง medicine (โหลด/บันทึกกับ checkpoint)
 medicine_id_map = {}
 
+_LOG_LOCK = threading.Lock()
+
+
 def log(msg):
     """บันทึกข้อความลงไฟล์และแสดงผลหน้าจอ"""
-    print(msg)
-    try:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(msg + "\n")
-    except Exception:
-        pass
+    with _LOG_LOCK:
+        print(msg)
+        try:
+            with open(LOG_FILE, "a", encoding="utf-8") as f:
+                f.write(msg + "\n")
+        except Exception:
+            pass
+
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+def get_db_connection(path=DB_PATH):
+    conn = sqlite3.connect(path)
     conn.row_factory = sqlite3.Row
     return conn
 
-def gas_append(table, payload_data):
+
+# ============================================
+# CHECKPOINT
+# ============================================
+class Checkpoint:
     """
-    ส่งข้อมูลไปยัง Google Sheet ผ่าน GAS API
-    แก้ไข: ส่งใน key 'payload' แทน 'data' ตามที่ GAS ต้องการ
+    ไฟล์ JSON: {"tables": {table: {"done": [id เก่า, ...], "id_map": {id เก่า: id ใหม่}, "failed": {id: msg}}},
+               "medicine_id_map": {...}}
+    id_map ต่อตารางใช้จับคู่แถวตอนตรวจสอบ (verify_data.py)
+    เขียนแบบ atomic (ไฟล์ชั่วคราว + replace) หลังทุก batch ที่สำเร็จ -> crash แล้วรันต่อได้
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {"tables": {}, "medicine_id_map": {}}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.data = json.load(f)
+        self.data.setdefault("tables", {})
+        self.data.setdefault("medicine_id_map", {})
+        self._done = {t: set(v.get("done", [])) for t, v in self.data["tables"].items()}
+
+    def table(self, name):
+        self._done.setdefault(name, set())
+        t = self.data["tables"].setdefault(name, {"done": [], "failed": {}})
+        t.setdefault("id_map", {})
+        return t
+
+    def is_done(self, table, old_id):
+        return str(old_id) in self._done.get(table, ())
+
+    def mark(self, table, done, failed=None):
+        """done = [(id เก่า, id ใหม่), ...]"""
+        with self.lock:
+            t = self.table(table)
+            for old_id, new_id in done:
+                key = str(old_id)
+                if key not in self._done[table]:
+                    self._done[table].add(key)
+                    t["done"].append(key)
+                t["id_map"][key] = new_id
+                t["failed"].pop(key, None)
+            for old_id, msg in (failed or {}).items():
+                t["failed"][str(old_id)] = msg
+            # ถ้าเป็นตาราง medicine ให้เก็บ ID ใหม่ไว้ใช้งาน (medicine_lot อ้างถึง)
+            if table == 'medicine':
+                self.data["medicine_id_map"].update({str(o): n for o, n in done})
+            self._save()
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+# ============================================
+# RATE LIMIT (ปรับตามผลตอบกลับ)
+# ============================================
+class AdaptiveLimiter:
+    """
+    ระยะห่างระหว่าง request ใช้ร่วมทุก worker
+    สำเร็จ -> ลดระยะห่างลงครึ่งหนึ่ง / ล้ม (quota, 429, 5xx, timeout) -> เพิ่มเป็นเท่าตัว (exponential backoff + jitter)
+    """
+
+    def __init__(self, min_delay=0.0, max_delay=60.0):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.delay
+        if at > now:
+            time.sleep(at - now)
+
+    def success(self):
+        with self.lock:
+            self.delay = max(self.min_delay, self.delay / 2 if self.delay > 0.05 else 0.0)
+
+    def failure(self, attempt):
+        with self.lock:
+            self.delay = min(self.max_delay, max(self.delay * 2, 1.0))
+            backoff = min(self.max_delay, (2 ** attempt) + random.uniform(0, 1))
+            self.next_at = max(self.next_at, time.monotonic() + backoff)
+            return backoff
+
+
+# ============================================
+# GAS
+# ============================================
+class GasBusy(RuntimeError):
+    """GAS ตอบว่ายุ่ง (429 / quota / lock) = ยังไม่ได้เขียน ลองใหม่ได้เลย"""
+
+
+def gas_post(body, limiter, landed=None, check_first=False):
+    """
+    POST ไป GAS พร้อม retry -> (ok, result|message)
+    landed() = ตรวจว่า request นี้ลงชีตไปแล้วหรือยัง (คืน result แบบเดียวกับที่ GAS ตอบ หรือ None)
+      ผลไม่ชัด (timeout / 5xx / ขาดการเชื่อมต่อ หลัง GAS อาจเขียนไปแล้ว) -> ตรวจก่อนส่งซ้ำทุกครั้ง กันแถวซ้ำ
+      check_first=True = ตรวจก่อนส่งครั้งแรกด้วย (ส่งซ้ำของที่เคยล้ม/ค้างจากรอบก่อน)
     """
     import requests
-    max_retries = 3
-    for attempt in range(max_retries):
+    unsure = check_first and landed is not None
+    last = "ครบจำนวนครั้งการลองใหม่แล้ว (Max retries reached)"
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt == MAX_RETRIES and not unsure:
+            break
+        limiter.wait()
         try:
-            # แก้ไข: เปลี่ยน data -> payload
-            body = {
-                "action": "append",
-                "table": table,
-                "payload": payload_data 
-            }
-            
-            response = requests.post(GAS_URL, json=body, timeout=60)
+            if unsure and landed is not None:
+                found = landed()
+                if found is not None:
+                    log(f"  พบข้อมูลลงชีตแล้ว ไม่ส่งซ้ำ ({body.get('action')} {body.get('table')})")
+                    limiter.success()
+                    return True, found
+                unsure = False
+            if attempt == MAX_RETRIES:
+                break
+
+            response = requests.post(GAS_URL, json=body, timeout=TIMEOUT)
+            if response.status_code == 429:
+                raise GasBusy(f"HTTP {response.status_code}")
+            if response.status_code >= 500:
+                raise RuntimeError(f"HTTP {response.status_code}")
             response.raise_for_status()
             result = response.json()
             if result.get("ok"):
+                limiter.success()
                 return True, result
-            else:
-                return False, result.get("message", "Unknown error")
+            msg = str(result.get("message", "Unknown error"))
+            # quota / lock timeout ของ Apps Script = ชั่วคราว ลองใหม่ได้
+            if not any(s in msg.lower() for s in ("too many", "quota", "lock", "timeout", "service")):
+                return False, msg
+            raise GasBusy(msg)
         except Exception as e:
-            if attempt < max_retries - 1:
-                time.sleep(2)
-                continue
-            return False, str(e)
-    return False, "ครบจำนวนครั้งการลองใหม่แล้ว (Max retries reached)"
-
-def migrate_table(conn, table_name):
-    log(f"--- กำลังเริ่มย้ายข้อมูลตาราง: {table_name} ---")
-    try:
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT * FROM {table_name}")
-        rows = cursor.fetchall()
-    except sqlite3.OperationalError as e:
-        log(f"ข้ามตาราง '{table_name}': {e}")
-        return
-
-    total = len(rows)
-    log(f"พบข้อมูลจำนวน {total} รายการ")
-    
-    success_count = 0
-    fail_count = 0
-
-    for i, row in enumerate(rows):
-        row_dict = dict(row)
-        old_id = row_dict.get('id')
-        
-        # จัดการประเภทข้อมูลให้ถูกต้อง
-        for key, value in row_dict.items():
-            if value is None:
-                row_dict[key] = ""
-            elif isinstance(value, bytes):
-                try:
-                    row_dict[key] = value.decode('utf-8')
-                except:
-                    row_dict[key] = str(value)
-
-        # ถ้าเป็นตาราง medicine_lot ต้องแก้ medicine_id ให้ตรงกับ ID ใหม่
-        if table_name == 'medicine_lot':
-            old_med_id = row_dict.get('medicine_id')
-            if old_med_id in medicine_id_map:
-                row_dict['medicine_id'] = medicine_id_map[old_med_id]
-            else:
-                # ถ้าหาไม่เจอ อาจจะเก็บ log ไว้ หรือปล่อยไป
-                pass
-
-        # ส่งข้อมูลไปยัง GAS
-        success, res = gas_append(table_name, row_dict)
-        
-        if success:
-            success_count += 1
-            new_id = res.get('id')
-            
-            # ถ้าเป็นตาราง medicine ให้เก็บ ID ใหม่ไว้ใช้งาน
-            if table_name == 'medicine' and old_id is not None:
-                medicine_id_map[old_id] = new_id
-                
-            if (i + 1) % 5 == 0:
-                log(f"ความคืบหน้า: {i+1}/{total} - สำเร็จ (OK)")
+            last = str(e)
+            # ไม่ได้คำตอบชัด ๆ จาก GAS -> อาจเขียนไปแล้ว (ตรวจก่อนส่งรอบหน้า)
+            if not isinstance(e, GasBusy):
+                unsure = True
+            if attempt < MAX_RETRIES - 1 or (unsure and attempt < MAX_RETRIES):
+                wait = limiter.failure(attempt)
+                log(f"  ลองใหม่ใน {wait:.1f} วินาที ({e})")
+    return False, last
+
+
+def gas_append(table, payload_data, limiter, check_first=False, tail=1):
+    """
+    ส่งข้อมูลไปยัง Google Sheet ผ่าน GAS API
+    แก้ไข: ส่งใน key 'payload' แทน 'data' ตามที่ GAS ต้องการ
+    """
+    def landed():
+        ids = find_landed(table, [payload_data], tail)
+        return {"ok": True, "id": ids[0]} if ids else None
+    return gas_post({"action": "append", "table": table, "payload": payload_data}, limiter,
+                    landed=landed, check_first=check_first)
+
+
+def gas_batch_append(table, rows, limiter, check_first=False, tail=None):
+    """
+    หลายแถวใน 1 request -> (ok, [id ใหม่ ...] | message)
+    ส่งซ้ำหลังผลไม่ชัด -> อ่านท้ายชีตก่อน ถ้า batch นี้ลงไปแล้วใช้ id ที่อยู่ในชีต (ไม่ append ซ้ำ)
+    tail = จำนวนแถวท้ายชีตที่ตรวจ (batch อื่นที่ส่งพร้อมกันอาจต่อท้ายตามมา)
+    """
+    def landed():
+        ids = find_landed(table, rows, tail or len(rows))
+        return {"ok": True, "ids": ids} if ids else None
+    ok, res = gas_post({"action": "batch_append", "table": table, "payload": {"rows": rows}}, limiter,
+                       landed=landed, check_first=check_first)
+    if not ok:
+        return False, res
+    ids = res.get("ids") or []
+    if len(ids) != len(rows):
+        return False, f"ได้ id กลับมา {len(ids)} จาก {len(rows)} แถว"
+    return True, ids
+
+
+def _landed_cols(payload, sheet_cols):
+    # id ชีตให้ใหม่ / ช่องว่างอาจถูกเติม (created_at) / คอลัมน์ที่ชีตไม่มีถูกทิ้ง
+    return [c for c in payload if c not in IGNORE_COLS and c in sheet_cols and payload[c] not in ("", None)]
+
+
+def find_landed(table, rows, tail):
+    """
+    หา rows (ตามลำดับ ติดกัน = batch_append 1 ครั้ง) ใน tail แถวท้ายชีต -> [id ใหม่ ...] หรือ None
+    เทียบค่าแบบ normalize เดียวกับ verify_data (วันที่ที่ชีตแปลง / 10 กับ 10.0)
+    อ่านชีตไม่ได้ -> raise (ไม่รู้ผล ห้ามส่งซ้ำ)
+    """
+    import requests
+    res = requests.get(GAS_URL, params={"action": "list", "table": table, "order": "desc", "limit": tail + len(rows)},
+                       timeout=TIMEOUT).json()
+    if not res.get("ok"):
+        raise RuntimeError(f"ตรวจท้ายชีต {table} ไม่สำเร็จ: {res.get('message')}")
+    data = list(reversed(res.get("data") or []))   # เก่า -> ใหม่
+    if len(data) < len(rows):
+        return None
+    sheet_cols = set(data[0].keys())
+    want = []
+    for p in rows:
+        cols = _landed_cols(p, sheet_cols)
+        want.append((cols, row_digest(p, cols)))
+    # ใหม่สุดก่อน (ส่งซ้ำมักเป็น batch ล่าสุด)
+    for start in range(len(data) - len(rows), -1, -1):
+        if all(row_digest(data[start + k], cols) == h for k, (cols, h) in enumerate(want)):
+            return [data[start + k].get("id") for k in range(len(rows))]
+    return None
+
+
+# ============================================
+# MIGRATE
+# ============================================
+def clean_row(table_name, row):
+    row_dict = dict(row)
+
+    # จัดการประเภทข้อมูลให้ถูกต้อง
+    for key, value in row_dict.items():
+        if value is None:
+            row_dict[key] = ""
+        elif isinstance(value, bytes):
+            try:
+                row_dict[key] = value.decode('utf-8')
+            except:
+                row_dict[key] = str(value)
+
+    # ถ้าเป็นตาราง medicine_lot ต้องแก้ medicine_id ให้ตรงกับ ID ใหม่
+    if table_name == 'medicine_lot':
+        old_med_id = str(row_dict.get('medicine_id', ''))
+        if old_med_id in medicine_id_map:
+            row_dict['medicine_id'] = medicine_id_map[old_med_id]
         else:
-            fail_count += 1
-            msg = res if isinstance(res, str) else res.get('message', str(res))
-            log(f"รายการ ID {old_id} ล้มเหลว: {msg}")
-            
-        time.sleep(0.5)
+            log(f"medicine_lot ID {row_dict.get('id')}: ไม่พบ medicine_id {old_med_id} ใน medicine_id_map")
+    return row_dict
+
+
+def make_batches(rows, batch_size, max_bytes):
+    """แบ่งตามจำนวนแถวและขนาด JSON (แถวเดียวที่ใหญ่เกินส่งเดี่ยว ๆ)"""
+    batch, size = [], 0
+    for old_id, payload in rows:
+        n = len(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        if batch and (len(batch) >= batch_size or size + n > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append((old_id, payload))
+        size += n
+    if batch:
+        yield batch
 
-    log(f"เสร็จสิ้นตาราง {table_name}. สำเร็จ: {success_count}, ล้มเหลว: {fail_count}")
 
-def main():
+class Migrator:
+    def __init__(self, conn, state, limiter, batch_size=BATCH_SIZE, workers=WORKERS, max_bytes=MAX_BATCH_BYTES):
+        self.conn = conn
+        self.state = state
+        self.limiter = limiter
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.batch_supported = True
+
+    def send(self, table, batch, check_first=False):
+        """
+        ส่ง 1 batch -> (done [(old_id, new_id)], failed {old_id: msg})
+        ล้ม -> แบ่งครึ่งส่งใหม่ จนเหลือแถวเดียว (หาแถวที่เสียโดยไม่ทิ้งทั้ง batch)
+        check_first = batch นี้อาจลงชีตไปแล้ว (ส่งซ้ำหลังล้ม / ค้างจากรอบก่อน) -> อ่านท้ายชีตก่อนส่ง
+        """
+        # batch อื่นที่ส่งพร้อมกันต่อท้ายหลัง batch นี้ได้ไม่เกิน workers batch
+        tail = len(batch) + self.workers * self.batch_size
+        if self.batch_supported:
+            ok, res = gas_batch_append(table, [p for _, p in batch], self.limiter, check_first=check_first, tail=tail)
+            if ok:
+                return list(zip([o for o, _ in batch], res)), {}
+            if "unknown action" in str(res).lower():
+                # GAS รุ่นเก่ายังไม่มี batch_append -> ทีละแถวแบบเดิม
+                log("GAS ไม่รองรับ batch_append ใช้ append ทีละแถว")
+                self.batch_supported = False
+            elif len(batch) > 1:
+                # ครั้งสุดท้ายอาจลงชีตไปแล้วบางส่วน (คำตอบหาย) -> ครึ่งที่ส่งใหม่ตรวจท้ายชีตก่อน
+                mid = len(batch) // 2
+                d1, f1 = self.send(table, batch[:mid], check_first=True)
+                d2, f2 = self.send(table, batch[mid:], check_first=True)
+                return d1 + d2, {**f1, **f2}
+            else:
+                return [], {batch[0][0]: res}
+
+        done, failed = [], {}
+        for old_id, payload in batch:
+            ok, res = gas_append(table, payload, self.limiter, check_first=check_first, tail=tail)
+            if ok:
+                done.append((old_id, res.get('id')))
+            else:
+                failed[old_id] = res if isinstance(res, str) else res.get('message', str(res))
+        return done, failed
+
+    def migrate_table(self, table_name):
+        log(f"--- กำลังเริ่มย้ายข้อมูลตาราง: {table_name} ---")
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(f"SELECT * FROM {table_name} ORDER BY rowid")
+            rows = cursor.fetchall()
+        except sqlite3.OperationalError as e:
+            log(f"ข้ามตาราง '{table_name}': {e}")
+            return 0, 0, 0.0
+
+        total = len(rows)
+        pending = []
+        for i, row in enumerate(rows):
+            old_id = row['id'] if 'id' in row.keys() and row['id'] is not None else f"row{i}"
+            if not self.state.is_done(table_name, old_id):
+                pending.append((old_id, clean_row(table_name, row)))
+        log(f"พบข้อมูลจำนวน {total} รายการ (ย้ายแล้ว {total - len(pending)}, เหลือ {len(pending)})")
+        if not pending:
+            return 0, 0, 0.0
+
+        # รอบก่อนล้ม/ถูกหยุดกลางทาง: แถวที่ล้ม และ batch แรก ๆ (ที่อาจกำลังส่งอยู่ตอนหยุด ก่อนบันทึก checkpoint)
+        # อาจลงชีตไปแล้ว -> batch เหล่านี้อ่านท้ายชีตก่อนส่ง (ชีตว่าง/ไม่เจอ = ส่งตามปกติ)
+        failed_before = set((self.state.data["tables"].get(table_name) or {}).get("failed", {}))
+
+        started = time.monotonic()
+        success_count = fail_count = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = []
+            for i, b in enumerate(make_batches(pending, self.batch_size, self.max_bytes)):
+                check = i < self.workers or any(str(o) in failed_before for o, _ in b)
+                futures.append(pool.submit(self.send, table_name, b, check))
+            for fut in as_completed(futures):
+                done, failed = fut.result()
+                if table_name == 'medicine':
+                    medicine_id_map.update({str(o): n for o, n in done})
+                self.state.mark(table_name, done, failed=failed)
+
+                success_count += len(done)
+                fail_count += len(failed)
+                for old_id, msg in failed.items():
+                    log(f"รายการ ID {old_id} ล้มเหลว: {msg}")
+                elapsed = max(time.monotonic() - started, 1e-6)
+                log(f"ความคืบหน้า: {success_count + fail_count}/{len(pending)} "
+                    f"({success_count / elapsed:.1f} แถว/วินาที)")
+
+        elapsed = time.monotonic() - started
+        log(f"เสร็จสิ้นตาราง {table_name}. สำเร็จ: {success_count}, ล้มเหลว: {fail_count}, "
+            f"ใช้เวลา {elapsed:.1f} วินาที ({success_count / max(elapsed, 1e-6):.1f} แถว/วินาที)")
+        return success_count, fail_count, elapsed
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description="ย้ายข้อมูล offline.db ขึ้น Google Sheet (ทำต่อจาก checkpoint ได้)")
+    p.add_argument("--db", default=DB_PATH)
+    p.add_argument("--state", default=STATE_FILE, help="ไฟล์ checkpoint")
+    p.add_argument("--tables", default=",".join(TABLES_ORDER), help="ตารางคั่นด้วย , (ตามลำดับ)")
+    p.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    p.add_argument("--max-bytes", type=int, default=MAX_BATCH_BYTES)
+    p.add_argument("--workers", type=int, default=WORKERS)
+    p.add_argument("--min-delay", type=float, default=0.0, help="ระยะห่างขั้นต่ำระหว่าง request (วินาที)")
+    p.add_argument("--reset", action="store_true", help="ลบ checkpoint แล้วเริ่มใหม่ทั้งหมด")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
     try:
-        with open(LOG_FILE, "w", encoding="utf-8") as f:
+        with open(LOG_FILE, "a", encoding="utf-8") as f:
             f.write(f"เริ่มการทำงานเมื่อ {datetime.datetime.now()}\n")
     except Exception as e:
         print(f"คำเตือน: ไม่สามารถสร้างไฟล์ log ได้: {e}")
@@ -138,20 +430,46 @@ def main():
         import requests
     except ImportError:
         log("ข้อผิดพลาด: ไม่พบโมดูล 'requests' กรุณาติดตั้งด้วยคำสั่ง: pip install requests")
-        return
+        return 1
 
-    log(f"กำลังเชื่อมต่อฐานข้อมูล: {DB_PATH}")
+    if args.reset and os.path.exists(args.state):
+        os.remove(args.state)
+    state = Checkpoint(args.state)
+    medicine_id_map.update(state.data["medicine_id_map"])
+    if medicine_id_map:
+        log(f"โหลด medicine_id_map จาก checkpoint {len(medicine_id_map)} รายการ")
+
+    log(f"กำลังเชื่อมต่อฐานข้อมูล: {args.db}")
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(args.db)
     except Exception as e:
         log(f"เกิดข้อผิดพลาดในการเปิดฐานข้อมูล: {e}")
-        return
+        return 1
 
-    for table in TABLES_ORDER:
-        migrate_table(conn, table)
+    migrator = Migrator(conn, state, AdaptiveLimiter(min_delay=args.min_delay),
+                        batch_size=max(1, args.batch_size), workers=max(1, args.workers),
+                        max_bytes=args.max_bytes)
+    started = time.monotonic()
+    total_ok = total_fail = 0
+    for table in [t.strip() for t in args.tables.split(",") if t.strip()]:
+        ok, fail, _ = migrator.migrate_table(table)
+        total_ok += ok
+        total_fail += fail
+        # medicine_lot อ้าง medicine_id ใหม่ -> medicine ต้องครบก่อน
+        if table == 'medicine' and fail:
+            log("medicine ย้ายไม่ครบ หยุดก่อนย้ายตารางที่อ้างอิง (รันใหม่เพื่อทำต่อ)")
+            break
 
     conn.close()
+    elapsed = time.monotonic() - started
+    log(f"รวม: สำเร็จ {total_ok}, ล้มเหลว {total_fail}, ใช้เวลา {elapsed:.1f} วินาที "
+        f"({total_ok / max(elapsed, 1e-6):.1f} แถว/วินาที)")
+    if total_fail:
+        log(f"ยังมีรายการล้มเหลว รันคำสั่งเดิมอีกครั้งเพื่อลองเฉพาะที่ค้าง (checkpoint: {args.state})")
+        return 1
     log("การย้ายข้อมูลเสร็จสมบูรณ์ (Migration complete).")
+    return 0
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,28 @@
+import sys
+
+from app import migrate_waste_photos, BLOB_DIR
+
+# ย้ายรูปขยะติดเชื้อ (data URL ในชีต waste) ไปเก็บใน blob store บนดิสก์
+# ใช้: BLOB_DIR=/path/to/persistent/disk python migrate_waste_photos.py [--dry-run]
+# ⚠️ หลังย้าย ชีตเก็บแค่ hash -> ไฟล์ใน BLOB_DIR เป็นสำเนาเดียวของรูป
+#    ต้องตั้ง BLOB_DIR เป็นดิสก์ถาวรที่ทุก worker เห็น (ไม่ตั้ง = ไม่ยอมย้าย ยกเว้น --dry-run)
+#    ควร backup ชีต waste ก่อนรัน
+
+
+def main():
+    dry_run = "--dry-run" in sys.argv[1:]
+    print(f"blob store: {BLOB_DIR}" + (" (dry run: ไม่แก้ชีต)" if dry_run else ""))
+
+    res = migrate_waste_photos(dry_run=dry_run)
+    if not res.get("ok"):
+        print(f"ผิดพลาด: {res.get('message')}")
+        sys.exit(1)
+
+    print(f"ย้ายแล้ว {res['moved']} แถว / ข้าม {res['skipped']} / ล้มเหลว {res['failed']}")
+    print(f"ลดขนาดข้อมูลในชีตประมาณ {res['bytes_saved'] / 1024:.1f} KB")
+    if res["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import sqlite3
+import json
+import os
+import re
+import sys
+import argparse
+import hashlib
+import datetime
+
+# ตรวจว่าข้อมูล 2 ฝั่งตรงกัน (offline.db <-> Google Sheet หรือ replica/cache อื่น) ด้วย hash
+# - hash ต่อแถว -> รวมเป็น block ตาม hash ของ key (แถวหาย/เกินไม่ทำให้ block อื่นเลื่อน) -> root ต่อตาราง
+# - root ตรง = ทั้งตารางตรง จบ / ไม่ตรง -> เทียบเฉพาะ block ที่ต่าง -> แถวที่ต่าง -> field diff เฉพาะแถวนั้น
+# ใช้: python verify_data.py [--left sqlite:offline.db] [--right sheet] [--state migration_state.json]
+#      source: sheet | sqlite:<path> | json:<path> (path ใส่ {table} ได้ เช่น json:dump/{table}.json)
+
+DB_PATH = 'offline.db'
+GAS_URL = os.getenv("GAS_URL", "https://script.google.com/macros/s/AKfycbyFLXNjy21R8gVHfWecWCwKKLAAnnfOsbi5ex4hJDaMR_kkoZKNIC53DVbBOUrszdUH/exec")
+STATE_FILE = 'migration_state.json'
+
+TABLES = ['users', 'medicine', 'medical_certificate', 'waste', 'treatment', 'medicine_lot']
+IGNORE_COLS = {'id', 'ledger_seq'}
+BLOCKS = 256
+SHEET_LIMIT = 100000
+
+_TH_OFFSET = datetime.timedelta(hours=7)
+_ISO_UTC = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?Z")
+_NUMBER = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?")
+
+
+# ============================================
+# HASH
+# ============================================
+def _h(data):
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def normalize_value(v):
+    """
+    ค่าให้อยู่รูปเดียวกันทั้ง 2 ฝั่ง:
+    - None -> ""  / 10, 10.0, "10" -> "10" (เลขขึ้นต้นด้วย 0 เช่นเบอร์โทร ไม่แปลง)
+    - วันที่ที่ชีตส่งมาเป็น ISO UTC -> เวลาไทย (เที่ยงคืน = เฉพาะวันที่)
+    """
+    if v is None:
+        return ""
+    if isinstance(v, bytes):
+        v = v.decode("utf-8", errors="replace")
+    if isinstance(v, bool):
+        return "TRUE" if v else "FALSE"
+    if isinstance(v, (int, float)):
+        v = repr(v)
+    s = str(v).strip().replace("\r\n", "\n")
+    if _NUMBER.fullmatch(s):
+        f = float(s)
+        return str(int(f)) if f.is_integer() else format(f, ".10g")
+    if _ISO_UTC.fullmatch(s):
+        dt = datetime.datetime.strptime(s[:19], "%Y-%m-%dT%H:%M:%S") + _TH_OFFSET
+        return dt.strftime("%Y-%m-%d") if dt.time() == datetime.time(0) else dt.strftime("%Y-%m-%d %H:%M:%S")
+    return s
+
+
+def row_digest(row, cols):
+    return _h(json.dumps([normalize_value(row.get(c)) for c in cols], ensure_ascii=False))
+
+
+class TableDigest:
+    """
+    rows = {key: row}  -> hash ต่อแถว, block (bucket ตาม hash ของ key) และ root
+    2 ฝั่งต้องใช้ cols และ blocks ชุดเดียวกัน
+    """
+
+    def __init__(self, rows, cols, blocks=BLOCKS):
+        self.rows = rows
+        self.row_hash = {k: row_digest(r, cols) for k, r in rows.items()}
+        buckets = [[] for _ in range(blocks)]
+        for k, h in self.row_hash.items():
+            buckets[int(_h(k)[:8], 16) % blocks].append(f"{k}:{h}")
+        self.block_hash = [_h("\n".join(sorted(items))) for items in buckets]
+        self.root = _h("".join(self.block_hash))
+        self.blocks = blocks
+
+
+def compare(left, right, cols):
+    """
+    เทียบ TableDigest 2 ฝั่ง -> {"match", "blocks", "missing_right", "missing_left", "mismatched": {key: {col: [l, r]}}}
+    field diff ทำเฉพาะแถวที่ hash ต่าง
+    """
+    out = {"match": left.root == right.root, "root_left": left.root, "root_right": right.root,
+           "rows_left": len(left.rows), "rows_right": len(right.rows),
+           "blocks": 0, "blocks_total": left.blocks, "missing_right": [], "missing_left": [], "mismatched": {}}
+    if out["match"]:
+        return out
+
+    diff_blocks = [i for i in range(left.blocks) if left.block_hash[i] != right.block_hash[i]]
+    out["blocks"] = len(diff_blocks)
+    want = set(diff_blocks)
+    lkeys = [k for k in left.row_hash if int(_h(k)[:8], 16) % left.blocks in want]
+    rkeys = {k for k in right.row_hash if int(_h(k)[:8], 16) % right.blocks in want}
+    for k in lkeys:
+        if k not in rkeys:
+            out["missing_right"].append(k)
+        elif left.row_hash[k] != right.row_hash[k]:
+            lr, rr = left.rows[k], right.rows[k]
+            out["mismatched"][k] = {c: [normalize_value(lr.get(c)), normalize_value(rr.get(c))]
+                                    for c in cols if normalize_value(lr.get(c)) != normalize_value(rr.get(c))}
+    lset = set(lkeys)
+    out["missing_left"] = sorted((k for k in rkeys if k not in lset), key=_key_sort)
+    out["missing_right"].sort(key=_key_sort)
+    return out
+
+
+def _key_sort(k):
+    return (0, int(k)) if str(k).isdigit() else (1, str(k))
+
+
+# ============================================
+# SOURCES
+# ============================================
+def load_sqlite(path, table):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        return [dict(r) for r in conn.execute(f"SELECT * FROM {table} ORDER BY rowid")]
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+
+
+def load_sheet(table):
+    import requests
+    r = requests.get(GAS_URL, params={"action": "list", "table": table, "limit": SHEET_LIMIT}, timeout=120)
+    r.raise_for_status()
+    res = r.json()
+    if not res.get("ok"):
+        return None
+    return res.get("data") or []
+
+
+def load_json(path, table):
+    path = path.replace("{table}", table)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        # ไฟล์เดียวหลายตาราง {table: [...]} หรือผล gas_list {"ok", "data": [...]}
+        data = data.get(table, data.get("data"))
+    return data if isinstance(data, list) else None
+
+
+def load_rows(source, table):
+    kind, _, path = source.partition(":")
+    if kind == "sheet":
+        return load_sheet(table)
+    if kind == "sqlite":
+        return load_sqlite(path or DB_PATH, table)
+    if kind == "json":
+        return load_json(path, table)
+    raise ValueError(f"source ไม่รู้จัก: {source}")
+
+
+def keyed(rows, table, state=None):
+    """
+    rows -> {key: row} โดย key = id
+    state (checkpoint ของ migrate_data.py) -> แปลง id เก่าเป็น id ใหม่ในชีต + medicine_id ของ medicine_lot
+    แถวที่ไม่อยู่ใน id_map (ยังไม่ได้ย้าย) ได้ key "unmapped:<id>" -> ขึ้นเป็นแถวที่หายอีกฝั่ง
+    """
+    id_map = med_map = None
+    if state is not None:
+        id_map = state.get("tables", {}).get(table, {}).get("id_map", {})
+        med_map = state.get("medicine_id_map", {})
+    out = {}
+    for i, r in enumerate(rows):
+        rid = str(r.get("id", "")).strip() or f"row{i}"
+        if id_map is not None:
+            rid = str(id_map[rid]) if rid in id_map else f"unmapped:{rid}"
+            if table == "medicine_lot" and str(r.get("medicine_id", "")) in med_map:
+                r = dict(r, medicine_id=med_map[str(r["medicine_id"])])
+        out[rid] = r
+    return out
+
+
+def verify_table(table, left_src, right_src, state=None, ignore=IGNORE_COLS, blocks=BLOCKS):
+    lrows = load_rows(left_src, table)
+    rrows = load_rows(right_src, table)
+    if lrows is None or rrows is None:
+        return {"table": table, "skipped": True,
+                "message": f"ไม่พบตาราง ({left_src if lrows is None else right_src})"}
+
+    lcols = {c for r in lrows for c in r}
+    rcols = {c for r in rrows for c in r}
+    cols = sorted((lcols & rcols) - set(ignore))
+    # id เก่าเทียบกับ id ใหม่ผ่าน state เฉพาะฝั่งที่เป็น offline.db
+    left = TableDigest(keyed(lrows, table, state if left_src.startswith("sqlite") else None), cols, blocks)
+    right = TableDigest(keyed(rrows, table, state if right_src.startswith("sqlite") else None), cols, blocks)
+    res = compare(left, right, cols)
+    res.update(table=table, cols=cols,
+               only_left=sorted(lcols - rcols - set(ignore)), only_right=sorted(rcols - lcols - set(ignore)))
+    return res
+
+
+def print_report(res, limit):
+    t = res["table"]
+    if res.get("skipped"):
+        print(f"[{t}] ข้าม: {res['message']}")
+        return
+    head = f"[{t}] {res['rows_left']} / {res['rows_right']} แถว root {res['root_left'][:12]}"
+    if res["match"]:
+        print(f"{head} ตรงกัน")
+    else:
+        print(f"{head} != {res['root_right'][:12]} ต่าง {res['blocks']}/{res['blocks_total']} block")
+        for label, keys in (("ไม่มีฝั่งขวา", res["missing_right"]), ("ไม่มีฝั่งซ้าย", res["missing_left"])):
+            if keys:
+                more = f" ... (+{len(keys) - limit})" if len(keys) > limit else ""
+                print(f"  {label} {len(keys)} แถว: {', '.join(keys[:limit])}{more}")
+        items = list(res["mismatched"].items())
+        if items:
+            print(f"  ค่าไม่ตรง {len(items)} แถว")
+            for k, cols in items[:limit]:
+                print(f"    id {k}: " + "; ".join(f"{c}: {l!r} != {r!r}" for c, (l, r) in cols.items()))
+    if res["only_left"] or res["only_right"]:
+        print(f"  คอลัมน์ที่ไม่ได้เทียบ: ซ้าย {res['only_left']} ขวา {res['only_right']}")
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description="ตรวจความตรงกันของข้อมูล 2 ฝั่งด้วย hash (Merkle ต่อตาราง)")
+    p.add_argument("--left", default=f"sqlite:{DB_PATH}")
+    p.add_argument("--right", default="sheet")
+    p.add_argument("--state", default=STATE_FILE,
+                   help="checkpoint ของ migrate_data.py (จับคู่ id เก่า -> id ใหม่) ใส่ '' ถ้า id 2 ฝั่งตรงกันอยู่แล้ว")
+    p.add_argument("--tables", default=",".join(TABLES))
+    p.add_argument("--ignore", default=",".join(sorted(IGNORE_COLS)), help="คอลัมน์ที่ไม่เทียบ")
+    p.add_argument("--blocks", type=int, default=BLOCKS)
+    p.add_argument("--limit", type=int, default=20, help="จำนวนแถวที่แสดงต่อหัวข้อ")
+    p.add_argument("--json", action="store_true", help="พิมพ์ผลเป็น JSON")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    state = None
+    if args.state and os.path.exists(args.state):
+        with open(args.state, encoding="utf-8") as f:
+            state = json.load(f)
+
+    ignore = {c.strip() for c in args.ignore.split(",") if c.strip()}
+    results = []
+    for table in [t.strip() for t in args.tables.split(",") if t.strip()]:
+        res = verify_table(table, args.left, args.right, state=state, ignore=ignore, blocks=max(1, args.blocks))
+        results.append(res)
+        if not args.json:
+            print_report(res, args.limit)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    return 0 if all(r.get("match") or r.get("skipped") for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())